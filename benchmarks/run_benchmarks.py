@@ -0,0 +1,385 @@
+"""
+Benchmarks of the profiling pipeline on synthetic data.
+
+A synthetic KO reference (random genes, sketched with sourmash at the requested ksizes and
+scaled) and synthetic metagenomes (reads sampled from a part of the genes, with sequencing
+errors) are generated locally at a range of sizes, so that no download is needed and every run
+uses the same data for the same seed.
+
+funcprofiler is run on every combination of size, ksize, scaled and mode (the sourmash command
+line tool, the in-process engine, and the KO index), and funcprofiler-many on a few copies of
+every metagenome. The per-stage metrics recorded by funcprofiler --metrics (wall time, CPU time,
+peak RSS, bytes read, hashes) are collected, with the throughput in reads/s and hashes/s.
+
+The results are written as JSON, and two result files (e.g. from two commits) are compared with
+the compare command:
+
+    python benchmarks/run_benchmarks.py run -o before.json
+    python benchmarks/run_benchmarks.py run -o after.json
+    python benchmarks/run_benchmarks.py compare before.json after.json
+"""
+
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+
+# name -> (number of KOs, number of reads)
+SIZES = {
+    'tiny': (100, 2000),
+    'small': (500, 20000),
+    'medium': (2000, 200000),
+    'large': (10000, 2000000),
+}
+MODES = ['cli', 'in_process', 'index']
+GENE_LENGTH = 900
+READ_LENGTH = 150
+ERROR_RATE = 0.005
+# fraction of the KOs that the reads are sampled from
+PRESENT_FRACTION = 0.2
+MANY_SAMPLES = 4
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def str_list(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks of the profiling pipeline on synthetic data.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Generate the synthetic data, run the benchmarks and write the results as JSON")
+    run.add_argument("-o", "--output", type=str, required=True, help="Output JSON file of the results")
+    run.add_argument("--sizes", type=str_list, default=['tiny', 'small'], help=f"Comma-separated data sizes, among {','.join(SIZES)} (default tiny,small)")
+    run.add_argument("--ksizes", type=int_list, default=[7, 11], help="Comma-separated protein kmer sizes (default 7,11)")
+    run.add_argument("--scaled", type=int_list, default=[10, 100], help="Comma-separated scaled values (default 10,100)")
+    run.add_argument("--modes", type=str_list, default=MODES, help=f"Comma-separated modes of funcprofiler, among {','.join(MODES)} (default all)")
+    run.add_argument("--threshold_bp", type=int, default=100, help="threshold_bp of the profiles (default 100)")
+    run.add_argument("--repeats", type=int, default=1, help="Number of times every benchmark is run (default 1)")
+    run.add_argument("--workdir", type=str, default='benchmark_data', help="Directory of the synthetic data, reused by later runs (default benchmark_data)")
+    run.add_argument("--seed", type=int, default=1, help="Seed of the synthetic data (default 1)")
+    run.add_argument("--no_many", action="store_true", help="Do not benchmark funcprofiler-many")
+
+    compare = subparsers.add_parser("compare", help="Compare the wall times of two result files")
+    compare.add_argument("baseline", type=str, help="Results of the baseline")
+    compare.add_argument("candidate", type=str, help="Results to compare against the baseline")
+    compare.add_argument("--tolerance", type=float, default=0.1, help="Relative slowdown reported as a regression (default 0.1)")
+    return parser.parse_args()
+
+
+def check_args(args):
+    for size in args.sizes:
+        if size not in SIZES:
+            print(f'Error: size {size} is not one of {", ".join(SIZES)}. Exiting...')
+            sys.exit(1)
+    for mode in args.modes:
+        if mode not in MODES:
+            print(f'Error: mode {mode} is not one of {", ".join(MODES)}. Exiting...')
+            sys.exit(1)
+    if any(ksize not in [7, 11, 15] for ksize in args.ksizes):
+        print(f'Error: Protein kmer sizes {args.ksizes} are not valid. Exiting...')
+        sys.exit(1)
+    if any(scaled < 1 for scaled in args.scaled):
+        print(f'Error: Scaled parameters {args.scaled} are not valid. Exiting...')
+        sys.exit(1)
+    if args.repeats < 1:
+        print(f'Error: number of repeats {args.repeats} is not valid. Exiting...')
+        sys.exit(1)
+    if 'cli' in args.modes and shutil.which('sourmash') is None:
+        print('Error: sourmash is not installed, the cli mode cannot be benchmarked. Exiting...')
+        sys.exit(1)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# synthetic data
+# ---------------------------------------------------------------------------
+
+def random_genes(rng, n_kos):
+    return {f'K{i:05d}': ''.join(rng.choices('ACGT', k=GENE_LENGTH)) for i in range(1, n_kos + 1)}
+
+
+"""
+Write a KO reference sketch of the genes, at all the ksizes, with the given scaled.
+"""
+def write_ko_sketch(genes, ksizes, scaled, filename):
+    import sourmash
+    from sourmash.save_load import SaveSignaturesToLocation
+    with SaveSignaturesToLocation(filename) as save_sigs:
+        for name, seq in genes.items():
+            for ksize in ksizes:
+                mh = sourmash.MinHash(0, ksize, is_protein=True, scaled=scaled, track_abundance=True)
+                mh.add_sequence(seq, force=True)
+                save_sigs.add(sourmash.SourmashSignature(mh, name=name))
+
+
+"""
+Write a FASTQ of n_reads reads sampled from the first PRESENT_FRACTION of the genes, with
+abundances following a geometric-like decay, and random substitution errors.
+"""
+def write_metagenome(genes, n_reads, filename, rng):
+    present = list(genes.values())[:max(1, int(len(genes) * PRESENT_FRACTION))]
+    weights = [1.0 / (i + 1) for i in range(len(present))]
+    with open(filename, 'w') as fp:
+        for i, gene in enumerate(rng.choices(present, weights=weights, k=n_reads)):
+            start = rng.randrange(0, len(gene) - READ_LENGTH)
+            read = list(gene[start:start + READ_LENGTH])
+            for position in range(READ_LENGTH):
+                if rng.random() < ERROR_RATE:
+                    read[position] = rng.choice('ACGT')
+            fp.write(f'@read{i}\n{"".join(read)}\n+\n{"I" * READ_LENGTH}\n')
+
+
+"""
+Generate (or reuse) the synthetic data of one size. Returns the metagenome filename and a
+dictionary scaled -> KO sketch filename.
+"""
+def prepare_data(workdir, size, ksizes, scaled_values, seed):
+    n_kos, n_reads = SIZES[size]
+    data_dir = os.path.join(workdir, f'{size}_seed{seed}')
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(seed)
+    genes = random_genes(rng, n_kos)
+
+    mg_filename = os.path.join(data_dir, 'metagenome.fastq')
+    if not os.path.exists(mg_filename):
+        print(f'Generating {n_reads} reads for size {size}...')
+        write_metagenome(genes, n_reads, mg_filename + '.tmp', rng)
+        os.replace(mg_filename + '.tmp', mg_filename)
+
+    ko_sketches = {}
+    for scaled in scaled_values:
+        ko_sketches[scaled] = os.path.join(data_dir, f'kos_k{"_".join(map(str, ksizes))}_s{scaled}.sig.zip')
+        if not os.path.exists(ko_sketches[scaled]):
+            print(f'Sketching {n_kos} KOs for size {size} at scaled={scaled}...')
+            write_ko_sketch(genes, ksizes, scaled, ko_sketches[scaled])
+    return mg_filename, ko_sketches
+
+
+# ---------------------------------------------------------------------------
+# benchmarks
+# ---------------------------------------------------------------------------
+
+def run_command(cmd):
+    start = time.perf_counter()
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    wall_seconds = time.perf_counter() - start
+    if res.returncode != 0:
+        print(f'Error: {" ".join(cmd)} failed with error code {res.returncode}. Its last output lines:')
+        for line in res.stdout.splitlines()[-10:]:
+            print(f'    {line}')
+        sys.exit(1)
+    return wall_seconds
+
+
+def read_records(filename):
+    with open(filename) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def count_reads(mg_filename):
+    with open(mg_filename) as fp:
+        return sum(1 for _ in fp) // 4
+
+
+"""
+Summarize the stage records of one run: the metrics of every stage, the peak RSS, and the
+throughput of the sketch and prefetch stages.
+"""
+def summarize(records, n_reads, total_wall_seconds):
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(record['stage'], {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'read_bytes': 0, 'hashes': 0, 'peak_rss_bytes': 0})
+        for field in ('wall_seconds', 'cpu_seconds', 'read_bytes', 'hashes'):
+            stage[field] += record.get(field, 0)
+        stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], record.get('peak_rss_bytes', 0))
+
+    def per_second(count, stage):
+        wall_seconds = stages.get(stage, {}).get('wall_seconds', 0)
+        return count / wall_seconds if count and wall_seconds > 0 else None
+
+    return {
+        'total_wall_seconds': total_wall_seconds,
+        'peak_rss_bytes': max((stage['peak_rss_bytes'] for stage in stages.values()), default=0),
+        'reads_per_second': per_second(n_reads, 'sketch'),
+        'sketch_hashes_per_second': per_second(stages.get('sketch', {}).get('hashes', 0), 'sketch'),
+        'prefetch_hashes_per_second': per_second(stages.get('prefetch', {}).get('hashes', 0), 'prefetch'),
+        'stages': stages,
+    }
+
+
+"""
+Run funcprofiler once on a metagenome. Returns the summary of its stages.
+"""
+def bench_funcprofiler(mg_filename, ko_sketch, ksize, scaled, threshold_bp, mode, run_dir, n_reads):
+    metrics_filename = os.path.join(run_dir, 'metrics.jsonl')
+    cmd = [sys.executable, '-m', 'fmhfunprofiler.funcprofiler', mg_filename, ko_sketch, str(ksize), str(scaled),
+           os.path.join(run_dir, 'ko_profiles.csv'), '-t', str(threshold_bp), '-p', os.path.join(run_dir, 'prefetch.csv'),
+           '--metrics', metrics_filename]
+    if mode == 'in_process':
+        cmd.append('--in_process')
+    elif mode == 'index':
+        cmd.append('--index')
+    total_wall_seconds = run_command(cmd)
+    return summarize(read_records(metrics_filename), n_reads, total_wall_seconds)
+
+
+"""
+Run funcprofiler-many on MANY_SAMPLES copies of a metagenome. Returns the summary of the
+stages of all the samples, and the number of samples profiled per second.
+"""
+def bench_funcprofiler_many(mg_filename, ko_sketch, ksize, scaled, threshold_bp, mode, run_dir, n_reads):
+    filelist = os.path.join(run_dir, 'filelist.csv')
+    with open(filelist, 'w') as fp:
+        for i in range(MANY_SAMPLES):
+            # every funcprofiler keeps its intermediate files in its own scratch directory, so the samples can share the input
+            fp.write(f'{os.path.abspath(mg_filename)},{os.path.join(run_dir, f"ko_profiles_{i}.csv")}\n')
+    metrics_filename = os.path.join(run_dir, 'metrics.jsonl')
+    cmd = [sys.executable, '-m', 'fmhfunprofiler.funcprofiler_many', ko_sketch, str(ksize), str(scaled), filelist,
+           str(threshold_bp), '--metrics', metrics_filename]
+    if mode == 'index':
+        cmd.append('--index')
+    total_wall_seconds = run_command(cmd)
+    # the per-sample records, without the summaries written after them
+    records = [record for record in read_records(metrics_filename) if 'samples' not in record]
+    summary = summarize(records, n_reads * MANY_SAMPLES, total_wall_seconds)
+    summary['samples_per_second'] = MANY_SAMPLES / total_wall_seconds
+    return summary
+
+
+def build_index(ko_sketch, ksize, scaled, run_dir):
+    index_filename = os.path.join(run_dir, f'kos_k{ksize}_s{scaled}.idx')
+    wall_seconds = run_command([sys.executable, '-m', 'fmhfunprofiler.ko_index', ko_sketch, str(ksize), str(scaled), index_filename])
+    return index_filename, wall_seconds
+
+
+def git_commit():
+    try:
+        res = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return res.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def environment():
+    try:
+        sourmash_version = importlib.metadata.version('sourmash')
+    except importlib.metadata.PackageNotFoundError:
+        sourmash_version = None
+    return {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sourmash': sourmash_version,
+    }
+
+
+def run_benchmarks(args):
+    results = []
+    for size in args.sizes:
+        n_kos, _ = SIZES[size]
+        mg_filename, ko_sketches = prepare_data(args.workdir, size, args.ksizes, args.scaled, args.seed)
+        n_reads = count_reads(mg_filename)
+        for scaled in args.scaled:
+            for ksize in args.ksizes:
+                for mode in args.modes:
+                    for repeat in range(args.repeats):
+                        run_dir = os.path.join(args.workdir, 'runs', f'{size}_k{ksize}_s{scaled}_{mode}_{repeat}')
+                        shutil.rmtree(run_dir, ignore_errors=True)
+                        os.makedirs(run_dir)
+                        ko_sketch = ko_sketches[scaled]
+                        key = {'size': size, 'n_kos': n_kos, 'n_reads': n_reads, 'ksize': ksize, 'scaled': scaled, 'mode': mode, 'repeat': repeat}
+
+                        index_seconds = None
+                        if mode == 'index':
+                            ko_sketch, index_seconds = build_index(ko_sketch, ksize, scaled, run_dir)
+
+                        print(f'funcprofiler: size={size} ksize={ksize} scaled={scaled} mode={mode} repeat={repeat}')
+                        summary = bench_funcprofiler(mg_filename, ko_sketch, ksize, scaled, args.threshold_bp, mode, run_dir, n_reads)
+                        results.append({'benchmark': 'funcprofiler', **key, 'build_index_seconds': index_seconds, **summary})
+
+                        if not args.no_many and mode != 'in_process':
+                            print(f'funcprofiler-many: size={size} ksize={ksize} scaled={scaled} mode={mode} repeat={repeat}')
+                            summary = bench_funcprofiler_many(mg_filename, ko_sketch, ksize, scaled, args.threshold_bp, mode, run_dir, n_reads)
+                            results.append({'benchmark': 'funcprofiler_many', **key, 'n_samples': MANY_SAMPLES, **summary})
+                        shutil.rmtree(run_dir, ignore_errors=True)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# comparison
+# ---------------------------------------------------------------------------
+
+def result_key(result):
+    return tuple(result[field] for field in ('benchmark', 'size', 'ksize', 'scaled', 'mode'))
+
+
+"""
+The best (smallest) total wall time of every benchmark, over its repeats.
+"""
+def best_times(results):
+    times = {}
+    for result in results:
+        key = result_key(result)
+        times[key] = min(times.get(key, float('inf')), result['total_wall_seconds'])
+    return times
+
+
+"""
+Compare two result files. Returns the keys of the benchmarks that are slower than the baseline
+by more than the tolerance.
+"""
+def compare_results(baseline, candidate, tolerance):
+    baseline_times = best_times(baseline['results'])
+    candidate_times = best_times(candidate['results'])
+    regressions = []
+    print(f'baseline: {baseline["environment"].get("commit")}, candidate: {candidate["environment"].get("commit")}')
+    for key in sorted(set(baseline_times) & set(candidate_times)):
+        ratio = candidate_times[key] / baseline_times[key] if baseline_times[key] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(f'{" ".join(map(str, key))}: {baseline_times[key]:.2f}s -> {candidate_times[key]:.2f}s ({ratio:.2f}x){flag}')
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        with open(args.candidate) as fp:
+            candidate = json.load(fp)
+        regressions = compare_results(baseline, candidate, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} benchmarks are more than {args.tolerance:.0%} slower than the baseline')
+            sys.exit(1)
+        return
+
+    check_args(args)
+    results = {'environment': environment(), 'parameters': {'threshold_bp': args.threshold_bp, 'seed': args.seed},
+               'results': run_benchmarks(args)}
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print(f'Results of {len(results["results"])} benchmarks have been written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
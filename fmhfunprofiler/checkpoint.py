@@ -0,0 +1,122 @@
+"""
+Checkpointing of batch runs. Outputs are written atomically: to a temporary file in the same
+directory, renamed over the output once complete, so that an output that exists is never
+partially written.
+
+funcprofiler-many records every sample it has profiled in a run manifest, a JSON lines file
+with one entry per finished sample: the metagenome and output files, the size, modification
+time and content hash of the metagenome, the hash of the output, and the parameters of the
+run. Entries are appended and flushed as samples finish, so the manifest survives the run
+being killed. With --resume, a sample is skipped when its entry is current: same parameters,
+same metagenome content, and an output that still has the recorded content. For a sample of
+several read files (see reads.py), the size is their total size, and the modification time the
+latest one.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from fmhfunprofiler.reads import content_digest, input_stat
+from fmhfunprofiler.sketch_cache import file_digest
+
+
+"""
+Write a file atomically: write_function(tmp_filename) writes a temporary file next to filename,
+which is then renamed to filename. The temporary name ends with the name of the output, so that
+writers that choose the format from the extension (e.g. compressed CSV) see the same extension.
+"""
+def atomic_write(filename, write_function):
+    tmp_filename = os.path.join(os.path.dirname(os.path.abspath(filename)), f'.tmp_{uuid.uuid4().hex}_{os.path.basename(filename)}')
+    try:
+        write_function(tmp_filename)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+"""
+The state of the metagenome of a sample, as recorded in the manifest: its size, modification
+time and content hash. The metagenome is only hashed if its size or modification time changed
+since previous, its previous manifest entry, whose hash is reused otherwise.
+"""
+def input_state(mg_filename, previous=None):
+    input_size, input_mtime_ns = input_stat(mg_filename)
+    if previous is not None and previous['input_size'] == input_size and previous['input_mtime_ns'] == input_mtime_ns:
+        input_digest = previous['input_digest']
+    else:
+        input_digest = content_digest(mg_filename)
+    return {'input_size': input_size, 'input_mtime_ns': input_mtime_ns, 'input_digest': input_digest}
+
+
+class Manifest:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # (metagenome filename, output filename) -> latest entry
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a run that was killed while writing it
+                        continue
+                    self.entries[(entry['mg_filename'], entry['output'])] = entry
+
+    """
+    Record a finished sample, with the parameters of the run (a JSON-serializable dictionary).
+    """
+    def record(self, mg_filename, output_filename, params):
+        self.append(self.make_entry(mg_filename, output_filename, params))
+
+    """
+    The entry of a finished sample. The state of its metagenome (see input_state) is given by
+    state if it was taken already, e.g. by the worker that sketched it, and is taken here
+    otherwise. Taking it may read the whole input, so the entry is meant to be made by the
+    worker that profiled the sample, and then appended: it does not change the manifest.
+    """
+    def make_entry(self, mg_filename, output_filename, params, state=None):
+        if state is None:
+            state = input_state(mg_filename, self.entries.get((mg_filename, output_filename)))
+        return {
+            'mg_filename': mg_filename,
+            'output': output_filename,
+            **state,
+            'output_digest': file_digest(output_filename),
+            'params': params,
+            'finished_at': time.time(),
+        }
+
+    """
+    Append an entry made by make_entry to the manifest. Safe to call from several threads.
+    """
+    def append(self, entry):
+        with self.lock:
+            with open(self.filename, 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.entries[(entry['mg_filename'], entry['output'])] = entry
+
+    """
+    Whether the sample was profiled with these parameters, from the current content of the
+    metagenome, into an output that is still intact. The metagenome is only hashed again if its
+    size or modification time changed.
+    """
+    def is_current(self, mg_filename, output_filename, params):
+        entry = self.entries.get((mg_filename, output_filename))
+        if entry is None or entry['params'] != params:
+            return False
+        try:
+            input_size, input_mtime_ns = input_stat(mg_filename)
+            if input_size != entry['input_size']:
+                return False
+            if input_mtime_ns != entry['input_mtime_ns'] and content_digest(mg_filename) != entry['input_digest']:
+                return False
+            return file_digest(output_filename) == entry['output_digest']
+        except OSError:
+            return False
@@ -0,0 +1,208 @@
+"""
+Array-job execution of funcprofiler-many over several nodes. The file list is split into
+shards, and every shard is one task of an array job, which runs funcprofiler-many on the
+samples of its shard and, when they all succeeded, leaves a marker file. The work directory
+holds:
+
+    shards/shard_<i>.csv        the file list of shard i
+    shards/shard_<i>.npz        with --matrix, the KO x sample matrix of shard i
+    shards/shard_<i>.jsonl      with --metrics, the stage metrics of shard i
+    done/shard_<i>.done         the marker of a finished shard
+    logs/shard_<i>.log          the output of shard i
+    array_job.sh                the array-job script
+
+Two backends run the script:
+
+    slurm: submitted with sbatch as an array job over the unfinished shards. The command
+        returns once the job is submitted; running it again when the job has finished merges
+        the results, or submits the shards that failed again.
+    local: the tasks run one after the other on this machine, as a stand-in for a cluster.
+
+Shards that already have a marker are never run again, so a run that was interrupted, or
+whose shards partly failed, is resumed by running the same command again. The shards are only
+split on the first run, and read back from the work directory on the next ones. Once all the shards
+are done, their matrices and metrics are merged into the outputs of funcprofiler-many.
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+from fmhfunprofiler import metrics, reads
+
+
+BACKENDS = ['local', 'slurm']
+# the environment variable that holds the shard of an array task, as set by SLURM
+TASK_ID_VARIABLE = 'SLURM_ARRAY_TASK_ID'
+SCRIPT_NAME = 'array_job.sh'
+
+
+def shard_path(workdir, shard, suffix):
+    return os.path.join(workdir, 'shards', f'shard_{shard}{suffix}')
+
+
+def marker_path(workdir, shard):
+    return os.path.join(workdir, 'done', f'shard_{shard}.done')
+
+
+"""
+Split the samples into at most n_shards shards of about the same total input size: the samples
+are dealt to the shards from the largest input to the smallest, always to the shard with the
+smallest total so far. Every shard keeps the samples in the order of the file list.
+"""
+def shard_samples(samples, n_shards):
+    n_shards = max(1, min(n_shards, len(samples)))
+    sizes = [reads.input_size(sample[0]) for sample in samples]
+    totals = [0] * n_shards
+    members = [[] for _ in range(n_shards)]
+    for i in sorted(range(len(samples)), key=lambda i: sizes[i], reverse=True):
+        shard = totals.index(min(totals))
+        members[shard].append(i)
+        totals[shard] += sizes[i]
+    return [[samples[i] for i in sorted(shard_members)] for shard_members in members]
+
+
+def _filelist_rows(samples):
+    return [[value for value in sample if value is not None] for sample in samples]
+
+
+"""
+Write the file lists of the shards to the work directory.
+"""
+def write_shards(workdir, shards):
+    import pandas as pd
+    for directory in ['shards', 'done', 'logs']:
+        os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+    for shard, samples in enumerate(shards):
+        pd.DataFrame(_filelist_rows(samples)).to_csv(shard_path(workdir, shard, '.csv'), header=False, index=False)
+
+
+def read_shard(workdir, shard):
+    import pandas as pd
+    # the shard of no sample is an empty file
+    if os.path.getsize(shard_path(workdir, shard, '.csv')) == 0:
+        return []
+    filelist = pd.read_csv(shard_path(workdir, shard, '.csv'), header=None, dtype=str)
+    return [[value for value in row if pd.notna(value)] for row in filelist.itertuples(index=False)]
+
+
+"""
+The shards of the samples in the work directory. A work directory that already holds shards
+keeps them: some of them may be done, and the input sizes they were split by may have changed
+since (or inputs may have been removed from scratch storage), so they are read back instead of
+split again. They must hold the same samples, in the same number of shards. Otherwise the
+samples are split with shard_samples, and the shards are written to the work directory.
+"""
+def prepare_shards(workdir, samples, n_shards):
+    n_existing = 0
+    if os.path.isdir(os.path.join(workdir, 'shards')):
+        n_existing = sum(1 for filename in os.listdir(os.path.join(workdir, 'shards')) if filename.endswith('.csv'))
+    if n_existing == 0:
+        shards = shard_samples(samples, n_shards)
+        write_shards(workdir, shards)
+        return shards
+
+    samples_by_row = {tuple(row): sample for row, sample in zip(_filelist_rows(samples), samples)}
+    shard_rows = [read_shard(workdir, shard) if os.path.exists(shard_path(workdir, shard, '.csv')) else None
+                  for shard in range(n_existing)]
+    existing_rows = sorted(tuple(row) for rows in shard_rows if rows is not None for row in rows)
+    if (None in shard_rows or n_existing != max(1, min(n_shards, len(samples)))
+            or existing_rows != sorted(tuple(row) for row in _filelist_rows(samples))):
+        print(f'Error: {workdir} holds the shards of another file list or number of shards. Use another --workdir. Exiting...')
+        sys.exit(1)
+    return [[samples_by_row[tuple(row)] for row in rows] for rows in shard_rows]
+
+
+def pending_shards(workdir, n_shards):
+    return [shard for shard in range(n_shards) if not os.path.exists(marker_path(workdir, shard))]
+
+
+"""
+The array-job script. Every task runs funcprofiler-many with shard_args on the shard given by
+$SLURM_ARRAY_TASK_ID, and writes the marker of the shard if it succeeded. sbatch_options are
+added as #SBATCH lines.
+"""
+def array_script(workdir, funcprofiler_many_args, matrix=False, with_metrics=False, sbatch_options=()):
+    workdir = os.path.abspath(workdir)
+    task = f'${{{TASK_ID_VARIABLE}}}'
+    shard = f'{shlex.quote(os.path.join(workdir, "shards"))}/shard_{task}'
+    command = [shlex.quote(sys.executable), '-m', 'fmhfunprofiler.funcprofiler_many']
+    command += [shlex.quote(arg) for arg in funcprofiler_many_args[:3]]
+    command += [f'{shard}.csv']
+    command += [shlex.quote(arg) for arg in funcprofiler_many_args[3:]]
+    if matrix:
+        command += ['--matrix', f'{shard}.npz']
+    if with_metrics:
+        command += ['--metrics', f'{shard}.jsonl']
+    lines = ['#!/bin/bash',
+             '#SBATCH --job-name=fmhfunprofiler',
+             f'#SBATCH --output={os.path.join(workdir, "logs")}/shard_%a.log']
+    lines += [f'#SBATCH {option}' for option in sbatch_options]
+    lines += ['set -e',
+              f'cd {shlex.quote(os.getcwd())}',
+              f'if [ -e {shlex.quote(os.path.join(workdir, "done"))}/shard_{task}.done ]; then exit 0; fi',
+              ' '.join(command),
+              f'touch {shlex.quote(os.path.join(workdir, "done"))}/shard_{task}.done']
+    return '\n'.join(lines) + '\n'
+
+
+def write_script(workdir, script):
+    filename = os.path.join(workdir, SCRIPT_NAME)
+    with open(filename, 'w') as fp:
+        fp.write(script)
+    os.chmod(filename, 0o755)
+    return filename
+
+
+"""
+Run the shards with the local stand-in: the tasks of the array-job script, one after the other.
+Returns the shards that failed.
+"""
+def run_local(workdir, script_filename, shards):
+    failed = []
+    for n_done, shard in enumerate(shards, start=1):
+        with open(os.path.join(workdir, 'logs', f'shard_{shard}.log'), 'w') as log:
+            res = subprocess.call(['bash', script_filename], stdout=log, stderr=subprocess.STDOUT,
+                                  env={**os.environ, TASK_ID_VARIABLE: str(shard)})
+        if res != 0:
+            failed.append(shard)
+        print(f'[{n_done}/{len(shards)}] shard {shard}: {"done" if res == 0 else "FAILED"}')
+    return failed
+
+
+"""
+Submit the array-job script over the given shards with sbatch. Returns the output of sbatch.
+"""
+def submit_slurm(script_filename, shards, sbatch_args=()):
+    if shutil.which('sbatch') is None:
+        print('Error: sbatch is not available. Please run on a SLURM submission host, or use --backend local. Exiting...')
+        sys.exit(1)
+    cmd = ['sbatch', '--array=' + ','.join(str(shard) for shard in shards), *sbatch_args, script_filename]
+    print(' '.join(shlex.quote(arg) for arg in cmd))
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    if res.returncode != 0:
+        print(f'Error: sbatch failed: {res.stderr.strip()}. Exiting...')
+        sys.exit(1)
+    return res.stdout.strip()
+
+
+"""
+Merge the matrices of all the shards, with the columns in the order of sample_order.
+"""
+def merge_shard_matrices(workdir, n_shards, sample_order):
+    from fmhfunprofiler import cohort
+    parts = [cohort.load_matrix_npz(shard_path(workdir, shard, '.npz')) for shard in range(n_shards)]
+    return cohort.merge_matrices(parts, sample_order)
+
+
+"""
+The stage records of all the shards, without the per-shard summaries.
+"""
+def merge_shard_metrics(workdir, n_shards):
+    records = []
+    for shard in range(n_shards):
+        filename = shard_path(workdir, shard, '.jsonl')
+        if os.path.exists(filename):
+            records += [record for record in metrics.read_metrics(filename) if 'samples' not in record]
+    return records
@@ -0,0 +1,178 @@
+"""
+Cohort-level profiling: all the samples of a cohort are profiled against one loaded KO database,
+and their KO profiles are gathered into a single sparse KO x sample abundance matrix, instead of
+one small CSV per sample.
+
+The reads of the samples are sketched by a pool of worker processes, and the sketches are
+matched in this process against the KO database, which is loaded once (with a KO index, it is
+memory-mapped). The matrix holds the relative abundance of every KO found in at least one sample,
+one column per sample.
+
+The matrix is written as a scipy.sparse .npz file (CSR, readable with scipy.sparse.load_npz,
+with the KO ids and sample ids stored alongside as row_ids and column_ids), or as a BIOM/HDF5
+file when the filename ends in .biom. BIOM output needs the biom-format package.
+"""
+
+from functools import partial
+import numpy as np
+import scipy.sparse
+from fmhfunprofiler import checkpoint, engine, pipeline, sketch_cache
+
+
+MATRIX_FORMATS = ['.npz', '.biom']
+
+
+"""
+The format of a matrix file, from the extension of its name. Returns None if it is not supported.
+"""
+def matrix_format(filename):
+    for suffix in MATRIX_FORMATS:
+        if filename.endswith(suffix):
+            return suffix
+    return None
+
+
+"""
+Sketch one sample in a worker process, from the sketch cache if a cache directory is given.
+"""
+def sketch_sample(mg_filename, ksize, scaled, cache_dir=None, content_digest=None):
+    if cache_dir is None:
+        return engine.sketch_metagenome(mg_filename, ksize, scaled)
+    cache = sketch_cache.SketchCache(cache_dir)
+    return sketch_cache.cached_sketch(cache, mg_filename, ksize, scaled, engine.sketch_metagenome, content_digest)
+
+
+# the previous manifest entries of the metagenomes, set once per worker by init_manifest_worker
+_worker_previous_entries = {}
+
+
+def init_manifest_worker(previous_entries):
+    global _worker_previous_entries
+    _worker_previous_entries = previous_entries
+
+
+"""
+Sketch one sample in a worker process like sketch_sample, and take the state of its input for
+the run manifest (see checkpoint.input_state) in the same worker, so that hashing the inputs
+runs in parallel. The hash is reused from the previous manifest entry of the metagenome (see
+init_manifest_worker) if the input did not change, and is then also the key of the sketch
+cache. Returns the minhash and the input state.
+"""
+def sketch_sample_with_state(mg_filename, ksize, scaled, cache_dir=None):
+    state = checkpoint.input_state(mg_filename, _worker_previous_entries.get(mg_filename))
+    return sketch_sample(mg_filename, ksize, scaled, cache_dir, state['input_digest']), state
+
+
+"""
+Relative KO abundances of one prefetch table, as a dictionary KO id -> abundance.
+"""
+def ko_abundances(df):
+    sum_weights = df['f_match_query'].sum()
+    if len(df) == 0 or sum_weights == 0:
+        return {}
+    return dict(zip(df['match_name'], df['f_match_query'] / sum_weights))
+
+
+"""
+Build the sparse KO x sample matrix from the per-sample KO abundances, a list of dictionaries
+KO id -> abundance in the order of the samples. Only the KOs found in some sample get a row,
+in sorted order. Returns the list of KO ids and the CSR matrix.
+"""
+def build_matrix(profiles):
+    ko_ids = sorted(set().union(*profiles)) if profiles else []
+    row_of_ko = {ko_id: row for row, ko_id in enumerate(ko_ids)}
+    rows, cols, values = [], [], []
+    for col, profile in enumerate(profiles):
+        for ko_id, abundance in profile.items():
+            rows.append(row_of_ko[ko_id])
+            cols.append(col)
+            values.append(abundance)
+    matrix = scipy.sparse.csr_matrix((np.array(values, dtype=np.float64), (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))),
+                                     shape=(len(ko_ids), len(profiles)))
+    return ko_ids, matrix
+
+
+"""
+Profile all the samples against the KO database (a server.KODatabase), sketching the reads
+with n_workers processes, pipelined with the matching (see pipeline.py). samples is a list of
+(mg_filename, sample_id) pairs, in the order of the columns of the matrix, and submit_order the
+same samples in the order to sketch them. Returns the KO ids, the sample ids, the KO x sample
+CSR matrix, and the list of samples that failed.
+"""
+def profile_cohort(samples, ko_database, threshold_bp, n_workers=1, cache_dir=None, submit_order=None):
+    profiles = {}
+
+    def match(sample, query_minhash):
+        return ko_abundances(ko_database.prefetch(query_minhash, threshold_bp, query_name=sample[0]))
+
+    def collect(sample, profile):
+        profiles[sample[1]] = profile
+        return f'{len(profile)} KOs'
+
+    sketch_function = partial(sketch_sample, ksize=ko_database.ksize, scaled=ko_database.scaled, cache_dir=cache_dir)
+    failed_set = set(pipeline.run_pipeline(submit_order or samples, sketch_function, match, collect, n_workers))
+    failed = [sample for sample in samples if sample in failed_set]
+
+    sample_ids = [sample_id for _, sample_id in samples if sample_id in profiles]
+    ko_ids, matrix = build_matrix([profiles[sample_id] for sample_id in sample_ids])
+    return ko_ids, sample_ids, matrix, failed
+
+
+"""
+Merge KO x sample matrices of disjoint sets of samples, given as (ko_ids, sample_ids, matrix)
+triples, into one matrix with the union of the KOs as rows, in sorted order. The columns are
+in the order of sample_order if it is given (the samples missing from all the parts are left
+out), and in the order of the parts otherwise. Returns the KO ids, the sample ids and the CSR
+matrix.
+"""
+def merge_matrices(parts, sample_order=None):
+    ko_ids = sorted(set().union(*(part_ko_ids for part_ko_ids, _, _ in parts)))
+    row_of_ko = {ko_id: row for row, ko_id in enumerate(ko_ids)}
+    columns = []
+    sample_ids = []
+    for part_ko_ids, part_sample_ids, matrix in parts:
+        # move the rows of the part to the merged KO ids
+        rows = np.array([row_of_ko[ko_id] for ko_id in part_ko_ids], dtype=np.int64)
+        matrix = matrix.tocoo()
+        columns.append(scipy.sparse.csr_matrix((matrix.data, (rows[matrix.row], matrix.col)), shape=(len(ko_ids), matrix.shape[1])))
+        sample_ids += part_sample_ids
+    matrix = scipy.sparse.hstack(columns, format='csr') if columns else scipy.sparse.csr_matrix((0, 0))
+    if sample_order is not None:
+        column_of_sample = {sample_id: col for col, sample_id in enumerate(sample_ids)}
+        sample_ids = [sample_id for sample_id in sample_order if sample_id in column_of_sample]
+        matrix = matrix[:, [column_of_sample[sample_id] for sample_id in sample_ids]].tocsr()
+    return ko_ids, sample_ids, matrix
+
+
+def save_matrix_npz(filename, ko_ids, sample_ids, matrix):
+    matrix = matrix.tocsr()
+    # the layout of scipy.sparse.save_npz, with the row and column ids added
+    with open(filename, 'wb') as fp:
+        np.savez_compressed(fp, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                            format=np.array('csr'), shape=np.array(matrix.shape),
+                            row_ids=np.array(ko_ids, dtype=str), column_ids=np.array(sample_ids, dtype=str))
+
+
+"""
+Load a matrix saved with save_matrix_npz. Returns the KO ids, the sample ids and the CSR matrix.
+"""
+def load_matrix_npz(filename):
+    matrix = scipy.sparse.load_npz(filename).tocsr()
+    with np.load(filename, allow_pickle=False) as data:
+        return [str(ko_id) for ko_id in data['row_ids']], [str(sample_id) for sample_id in data['column_ids']], matrix
+
+
+def save_matrix_biom(filename, ko_ids, sample_ids, matrix):
+    from biom.table import Table
+    from biom.util import biom_open
+    table = Table(matrix, ko_ids, sample_ids, type='Ortholog table')
+    with biom_open(filename, 'w') as fp:
+        table.to_hdf5(fp, 'fmhfunprofiler')
+
+
+"""
+Save the matrix, atomically, in the format given by the extension of the filename, .npz or .biom.
+"""
+def save_matrix(filename, ko_ids, sample_ids, matrix):
+    save_function = save_matrix_biom if matrix_format(filename) == '.biom' else save_matrix_npz
+    checkpoint.atomic_write(filename, lambda tmp_filename: save_function(tmp_filename, ko_ids, sample_ids, matrix))
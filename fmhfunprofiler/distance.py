@@ -0,0 +1,255 @@
+"""
+Pairwise functional distances between the samples of a cohort, from their KO profiles or from
+the KO x sample matrix of funcprofiler-many --matrix:
+
+    braycurtis: sum_k |u_k - v_k| / sum_k (u_k + v_k)
+    weighted_jaccard: 1 - sum_k min(u_k, v_k) / sum_k max(u_k, v_k)
+
+Both are computed from the sums of the minima of every pair of samples, since
+|u - v| = u + v - 2 min(u, v) and max(u, v) = u + v - min(u, v). The samples are split into
+blocks of block_size samples, and every block of rows of the (symmetric) distance matrix is
+computed by a worker process, against the blocks that follow it. For a pair of blocks, the
+minima are summed KO by KO, over the samples of the two blocks that hold the KO only, so rare
+KOs cost little. Two samples with no KO are at distance 0 from each other, and 1 from the
+others.
+
+The distance matrix is written as a .npy file, filled in place through a memory map, so that it
+never has to fit in memory, and can be opened with numpy.load(filename, mmap_mode='r'). The
+sample ids are written next to it, one per line, in <output>.samples.txt.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from fmhfunprofiler import checkpoint, cohort
+from fmhfunprofiler.funcprofiler import profile_format
+
+
+DISTANCES = ['braycurtis', 'weighted_jaccard']
+DEFAULT_BLOCK_SIZE = 256
+SAMPLE_IDS_SUFFIX = '.samples.txt'
+
+
+"""
+Read the file list of KO profiles: a CSV file with no header, with a KO profile file per line,
+and optionally the id of the sample in a second column (the name of the profile file otherwise).
+A line with more than two columns is an error. Returns a list of (profile_filename, sample_id)
+pairs.
+"""
+def read_filelist(filelist_filename):
+    samples = []
+    with open(filelist_filename, newline='') as fp:
+        reader = csv.reader(fp)
+        for row in reader:
+            row = [value.strip() for value in row]
+            if not any(row):
+                continue
+            if len(row) > 2:
+                print(f'Error: line {reader.line_num} of {filelist_filename} has {len(row)} columns, instead of a KO profile '
+                      'and a sample id. Exiting...')
+                sys.exit(1)
+            sample_id = row[1] if len(row) > 1 and row[1] else os.path.basename(row[0])
+            samples.append((row[0], sample_id))
+    return samples
+
+
+def read_profile(profile_filename):
+    if profile_format(profile_filename) == 'parquet':
+        return pd.read_parquet(profile_filename, columns=['ko_id', 'abundance'])
+    return pd.read_csv(profile_filename, usecols=['ko_id', 'abundance'], dtype={'ko_id': str, 'abundance': np.float64})
+
+
+"""
+Load the KO profiles of the samples into a sparse sample x KO matrix, with the KOs in sorted
+order. Returns the KO ids and the CSR matrix.
+"""
+def load_profiles(profile_filenames):
+    profiles = [read_profile(filename) for filename in profile_filenames]
+    ko_names = np.concatenate([profile['ko_id'].to_numpy(dtype=str) for profile in profiles]) if profiles else np.zeros(0, dtype=str)
+    ko_ids, columns = np.unique(ko_names, return_inverse=True)
+    rows = np.repeat(np.arange(len(profiles)), [len(profile) for profile in profiles])
+    values = np.concatenate([profile['abundance'].to_numpy(dtype=np.float64) for profile in profiles]) if profiles else np.zeros(0)
+    matrix = scipy.sparse.csr_matrix((values, (rows, columns)), shape=(len(profiles), len(ko_ids)))
+    return [str(ko_id) for ko_id in ko_ids], matrix
+
+
+"""
+Load the samples to compare, from a KO x sample matrix (.npz or .biom, see cohort.py), or from
+a file list of KO profiles. Returns the sample ids and the sample x KO CSR matrix.
+"""
+def load_samples(input_filename):
+    if cohort.matrix_format(input_filename) == '.npz':
+        _, sample_ids, matrix = cohort.load_matrix_npz(input_filename)
+        return sample_ids, matrix.T.tocsr()
+    if cohort.matrix_format(input_filename) == '.biom':
+        import biom
+        table = biom.load_table(input_filename)
+        return [str(sample_id) for sample_id in table.ids(axis='sample')], table.matrix_data.T.tocsr()
+    samples = read_filelist(input_filename)
+    _, matrix = load_profiles([profile_filename for profile_filename, _ in samples])
+    return [sample_id for _, sample_id in samples], matrix
+
+
+"""
+Sums of the minima of every pair of rows of the sparse matrices a and b (with the same KO
+columns), in a dense a x b matrix. A KO only adds to the pairs of samples that both hold it.
+"""
+def sum_of_minima(a, b):
+    a, b = scipy.sparse.csc_matrix(a), scipy.sparse.csc_matrix(b)
+    sums = np.zeros((a.shape[0], b.shape[0]))
+    a_counts, b_counts = np.diff(a.indptr), np.diff(b.indptr)
+    for ko in np.flatnonzero((a_counts > 0) & (b_counts > 0)):
+        a_slice = slice(a.indptr[ko], a.indptr[ko + 1])
+        b_slice = slice(b.indptr[ko], b.indptr[ko + 1])
+        sums[np.ix_(a.indices[a_slice], b.indices[b_slice])] += np.minimum.outer(a.data[a_slice], b.data[b_slice])
+    return sums
+
+
+"""
+Distances between the samples (rows of the CSR matrix samples) of the rows and the columns.
+"""
+def block_distances(samples, rows, columns, distance='braycurtis'):
+    a, b = samples[rows], samples[columns]
+    minima = sum_of_minima(a, b)
+    totals = np.asarray(a.sum(axis=1)).ravel()[:, None] + np.asarray(b.sum(axis=1)).ravel()[None, :]
+    if distance == 'weighted_jaccard':
+        # sum of the maxima
+        totals = totals - minima
+        similarity = np.divide(minima, totals, out=np.ones_like(minima), where=totals > 0)
+    else:
+        similarity = np.divide(2 * minima, totals, out=np.ones_like(minima), where=totals > 0)
+    return np.clip(1.0 - similarity, 0.0, 1.0)
+
+
+_worker_samples = None
+_worker_distances = None
+
+
+def _init_worker(samples, filename):
+    global _worker_samples, _worker_distances
+    _worker_samples = samples
+    _worker_distances = np.load(filename, mmap_mode='r+')
+
+
+"""
+Fill the block of rows start:stop of the distance matrix, against this block and the following
+ones, and the symmetric blocks. Different blocks of rows write to disjoint parts of the matrix.
+"""
+def _distance_rows_in_worker(start, stop, distance, block_size):
+    n_samples = _worker_samples.shape[0]
+    rows = np.arange(start, stop)
+    for column_start in range(start, n_samples, block_size):
+        columns = np.arange(column_start, min(column_start + block_size, n_samples))
+        block = block_distances(_worker_samples, rows, columns, distance)
+        _worker_distances[start:stop, columns[0]:columns[-1] + 1] = block
+        _worker_distances[columns[0]:columns[-1] + 1, start:stop] = block.T
+    _worker_distances.flush()
+    return stop - start
+
+
+"""
+Compute the distance matrix of the samples (rows of a CSR matrix) into the .npy file filename,
+block_size rows at a time, with the given number of processes.
+"""
+def compute_distances(samples, filename, distance='braycurtis', block_size=DEFAULT_BLOCK_SIZE, processes=1):
+    n_samples = samples.shape[0]
+    distances = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64, shape=(n_samples, n_samples))
+    del distances
+    blocks = [(start, min(start + block_size, n_samples)) for start in range(0, n_samples, block_size)]
+    if processes == 1:
+        _init_worker(samples, filename)
+        for start, stop in blocks:
+            _distance_rows_in_worker(start, stop, distance, block_size)
+        return
+
+    n_done = 0
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(samples, filename)) as pool:
+        futures = [pool.submit(_distance_rows_in_worker, start, stop, distance, block_size) for start, stop in blocks]
+        for future in as_completed(futures):
+            n_done += future.result()
+            print(f'[{n_done}/{n_samples}] rows of the distance matrix done ({time.time() - start_time:.1f}s elapsed)')
+
+
+"""
+Write the distance matrix of the samples to output (a .npy file), and their ids to
+output.samples.txt, both atomically.
+"""
+def write_distance_matrix(output_filename, sample_ids, samples, distance='braycurtis', block_size=DEFAULT_BLOCK_SIZE, processes=1):
+    checkpoint.atomic_write(output_filename, lambda tmp_filename: compute_distances(samples, tmp_filename, distance, block_size, processes))
+    def write_ids(tmp_filename):
+        with open(tmp_filename, 'w') as fp:
+            fp.writelines(f'{sample_id}\n' for sample_id in sample_ids)
+    checkpoint.atomic_write(output_filename + SAMPLE_IDS_SUFFIX, write_ids)
+
+
+"""
+Open a distance matrix written by write_distance_matrix. Returns the sample ids, and the
+read-only memory-mapped matrix.
+"""
+def load_distance_matrix(filename):
+    with open(filename + SAMPLE_IDS_SUFFIX) as fp:
+        sample_ids = [line.rstrip('\n') for line in fp]
+    return sample_ids, np.load(filename, mmap_mode='r')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compute the pairwise functional distances between samples, from their KO profiles or from a KO x sample matrix, into a memory-mapped .npy matrix.")
+    parser.add_argument("input", type=str, help="KO x sample matrix of funcprofiler-many --matrix (.npz or .biom), or a CSV file with no header listing a KO profile per line, and optionally the sample id in a second column")
+    parser.add_argument("output", type=str, help="Output .npy file of the distance matrix. The sample ids are written to <output>.samples.txt")
+    parser.add_argument("--distance", type=str, choices=DISTANCES, default='braycurtis', help="Distance between two KO profiles (default braycurtis)")
+    parser.add_argument("--block_size", type=int, default=DEFAULT_BLOCK_SIZE, help=f"Number of samples per block of the distance matrix (default {DEFAULT_BLOCK_SIZE})")
+    parser.add_argument('-j', "--jobs", type=int, default=1, help="Number of processes computing blocks of rows at the same time (default 1)")
+    return parser.parse_args()
+
+
+def check_args(args):
+    # check if the input file exists
+    if not os.path.exists(args.input):
+        print(f'Error: input file {args.input} does not exist. Exiting...')
+        sys.exit(1)
+
+    # check if the matrix can be read
+    if cohort.matrix_format(args.input) == '.biom':
+        try:
+            import biom
+        except ImportError:
+            print('Error: biom-format is not installed. Please install biom-format to read .biom matrices.')
+            sys.exit(1)
+
+    # check if the output is a .npy file
+    if not args.output.endswith('.npy'):
+        print(f'Error: output {args.output} must end in .npy. Exiting...')
+        sys.exit(1)
+
+    # check if the block size is valid
+    if args.block_size < 1:
+        print(f'Error: block size {args.block_size} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the number of jobs is valid
+    if args.jobs < 1:
+        print(f'Error: number of jobs {args.jobs} is not valid. Exiting...')
+        sys.exit(1)
+
+    return True
+
+
+def main():
+    args = parse_args()
+    check_args(args)
+    print(f'Loading the samples from {args.input}...')
+    sample_ids, samples = load_samples(args.input)
+    print(f'Computing the {args.distance} distances between {len(sample_ids)} samples over {samples.shape[1]} KOs...')
+    write_distance_matrix(args.output, sample_ids, samples, args.distance, args.block_size, args.jobs)
+    print(f'Distance matrix has been written to {args.output}, and the sample ids to {args.output}{SAMPLE_IDS_SUFFIX}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""
+In-process profiling engine. Instead of launching `sourmash sketch translate` and
+`sourmash prefetch` as separate programs, the metagenome is translated and sketched,
+the KO sketch is loaded, and the containment of the sample in every KO is computed
+with the sourmash Python API, all inside the running interpreter.
+
+The prefetch results are returned as a pandas DataFrame that carries the same
+column names as the CSV written by `sourmash prefetch`, so the downstream KO
+abundance extraction does not need to know which engine produced them.
+"""
+
+import functools
+import numpy as np
+import pandas as pd
+import screed
+import sourmash
+from sourmash.distance_utils import containment_to_distance
+from sourmash.minhash import set_size_exact_prob
+from sourmash.save_load import SaveSignaturesToLocation
+from fmhfunprofiler import reads
+
+
+# columns of the in-process prefetch table, the ones of the `sourmash prefetch` CSV (without the
+# ANI confidence intervals, which sourmash prefetch does not write by default either).
+# match_md5 and match_bp describe the KO sketches after they are downsampled to scaled.
+PREFETCH_COLUMNS = ['intersect_bp', 'jaccard', 'max_containment', 'f_query_match', 'f_match_query',
+                    'match_filename', 'match_name', 'match_md5', 'match_bp',
+                    'query_filename', 'query_name', 'query_md5', 'query_bp',
+                    'ksize', 'moltype', 'scaled', 'query_n_hashes', 'query_abundance',
+                    'query_containment_ani', 'match_containment_ani', 'average_containment_ani', 'max_containment_ani',
+                    'potential_false_negative']
+# columns added to the prefetch table of abundance-weighted profiles: the sum and the mean of the
+# multiplicities in the sample of the hashes it shares with every KO
+WEIGHTED_COLUMNS = ['sum_abund', 'average_abund']
+
+
+"""
+Create an empty protein FracMinHash that translates the DNA sequences added to it,
+exactly like `sourmash sketch translate -p scaled=<scaled>,k=<ksize>,abund`.
+"""
+def new_translate_minhash(ksize, scaled):
+    return sourmash.MinHash(n=0, ksize=ksize, is_protein=True, scaled=scaled, track_abundance=True)
+
+
+"""
+The largest hash kept in a FracMinHash with the given scaled, computed as sourmash does.
+"""
+def max_hash_for_scaled(scaled):
+    if scaled == 1:
+        return sourmash.get_minhash_max_hash()
+    return min(int(round(sourmash.get_minhash_max_hash() / scaled, 0)), sourmash.get_minhash_max_hash())
+
+
+"""
+Return the hashes of a minhash as a sorted uint64 array, with their abundances as an int64
+array (all ones if the minhash does not track abundances). If scaled is given, only the hashes
+that a FracMinHash with that scaled would keep are returned.
+"""
+def minhash_to_arrays(minhash, scaled=None):
+    hashes_dict = minhash.hashes
+    hashes = np.fromiter(hashes_dict.keys(), dtype=np.uint64, count=len(hashes_dict))
+    abunds = np.fromiter(hashes_dict.values(), dtype=np.int64, count=len(hashes_dict))
+    order = np.argsort(hashes)
+    hashes, abunds = hashes[order], abunds[order]
+    if scaled is not None:
+        keep = hashes <= np.uint64(max_hash_for_scaled(scaled))
+        hashes, abunds = hashes[keep], abunds[keep]
+    return hashes, abunds
+
+
+"""
+Sketch the metagenome sample in memory. Returns the FracMinHash (with abundances) of the
+six-frame translation of all the reads in the FASTA/FASTQ file (gzip is handled by screed), or
+in all the read files of the sample (see reads.py).
+"""
+def sketch_metagenome(mg_filename, ksize, scaled):
+    minhash = new_translate_minhash(ksize, scaled)
+    for filename in reads.read_files(mg_filename):
+        with screed.open(filename) as records:
+            for record in records:
+                minhash.add_sequence(record.sequence, force=True)
+    return minhash
+
+
+"""
+Save a metagenome sketch as a signature, so that it can be reused by the sourmash CLI.
+"""
+def save_sketch(minhash, mg_filename, sketch_filename):
+    sig = sourmash.SourmashSignature(minhash, name=mg_filename, filename=mg_filename)
+    with SaveSignaturesToLocation(sketch_filename) as save_sigs:
+        save_sigs.add(sig)
+
+
+"""
+Load a metagenome sketch saved with save_sketch (or by `sourmash sketch translate`). Returns
+its minhash with the given protein kmer size.
+"""
+def load_sketch(sketch_filename, ksize):
+    sigs = list(sourmash.load_file_as_signatures(sketch_filename, ksize=ksize, select_moltype='protein'))
+    if len(sigs) != 1:
+        raise ValueError(f'{sketch_filename} must contain exactly one protein sketch with ksize {ksize}')
+    return sigs[0].minhash
+
+
+"""
+Load the KO signatures with the given protein kmer size from a .sig.zip, .sbt.zip or any
+other location understood by sourmash. Returns a list of signatures whose minhashes are
+flattened and downsampled to the given scaled.
+"""
+def load_ko_sketches(ko_sketch, ksize, scaled):
+    ko_sigs = []
+    for sig in sourmash.load_file_as_signatures(ko_sketch, ksize=ksize, select_moltype='protein'):
+        minhash = sig.minhash.flatten()
+        if minhash.scaled < scaled:
+            minhash = minhash.downsample(scaled=scaled)
+        with sig.update() as sig:
+            sig.minhash = minhash
+        ko_sigs.append(sig)
+    return ko_sigs
+
+
+"""
+The (query hash, KO) pairs of the query hashes found in the KOs: the positions in the sorted
+query hashes, and the KO ids (positions in ko_hashes). The hashes of all the KOs are looked up
+in the query hashes at once, with np.searchsorted.
+"""
+def shared_hash_pairs(query_hashes, ko_hashes):
+    if len(ko_hashes) == 0 or len(query_hashes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    all_hashes = np.concatenate(ko_hashes).astype(np.uint64)
+    all_ko_ids = np.repeat(np.arange(len(ko_hashes)), [len(h) for h in ko_hashes])
+    positions = np.minimum(np.searchsorted(query_hashes, all_hashes), len(query_hashes) - 1)
+    found = query_hashes[positions] == all_hashes
+    return positions[found], all_ko_ids[found]
+
+
+"""
+Number of query hashes found in every KO, and the sum of their abundances in the query,
+counted per KO with np.bincount. Returns two int64 arrays, in the order of ko_hashes.
+"""
+def count_shared_abundances(query_hashes, query_abunds, ko_hashes):
+    n_kos = len(ko_hashes)
+    positions, ko_ids = shared_hash_pairs(query_hashes, ko_hashes)
+    n_common = np.bincount(ko_ids, minlength=n_kos)
+    sum_abund = np.bincount(ko_ids, weights=query_abunds[positions], minlength=n_kos)
+    return n_common.astype(np.int64), sum_abund.astype(np.int64)
+
+
+"""
+Containment of a sketch in another one, given the number of shared hashes: the shared
+fraction of the sketch, debiased and clipped to [0, 1] the same way sourmash does it.
+Works elementwise on numpy arrays.
+"""
+def debiased_containment(n_common, n_hashes, scaled):
+    n_common = np.asarray(n_common, dtype=np.float64)
+    n_hashes = np.asarray(n_hashes, dtype=np.float64)
+    bias_factor = 1.0 - (1.0 - 1.0 / scaled) ** (n_hashes * scaled)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        containment = n_common / (n_hashes * bias_factor)
+    return np.clip(np.nan_to_num(containment), 0.0, 1.0)
+
+
+"""
+Whether the size of a set can be estimated from a FracMinHash sketch of n_hashes hashes, as
+sourmash checks it before estimating an ANI (see MinHash.size_is_accurate). The answer is
+cached, since the same KO sizes come back for every threshold and sample.
+"""
+@functools.lru_cache(maxsize=None)
+def size_is_accurate(n_hashes, scaled, relative_error=0.20, confidence=0.95):
+    return set_size_exact_prob(n_hashes * scaled, scaled, relative_error=relative_error) >= confidence
+
+
+"""
+The containment ANI columns of the prefetch table, estimated from the containments in both
+directions the same way `sourmash prefetch` does it (see sourmash.distance_utils). An ANI is
+left empty (NaN) when the size of the query or of the KO cannot be estimated accurately from
+its sketch. Works on numpy arrays, one value per KO. Returns a dictionary column -> values.
+"""
+def containment_ani_columns(f_match_query, f_query_match, ko_n_hashes, query_n_hashes, ksize, scaled):
+    query_containment_ani = np.full(len(ko_n_hashes), np.nan)
+    match_containment_ani = np.full(len(ko_n_hashes), np.nan)
+    potential_false_negative = np.zeros(len(ko_n_hashes), dtype=bool)
+    query_size_is_accurate = size_is_accurate(int(query_n_hashes), int(scaled))
+    for i, ko_n in enumerate(ko_n_hashes):
+        accurate = query_size_is_accurate and size_is_accurate(int(ko_n), int(scaled))
+        for containment, n_hashes, ani in [(f_match_query[i], query_n_hashes, query_containment_ani),
+                                           (f_query_match[i], ko_n, match_containment_ani)]:
+            result = containment_to_distance(containment, ksize, scaled, n_unique_kmers=int(n_hashes) * scaled)
+            if accurate:
+                ani[i] = result.ani
+            potential_false_negative[i] |= result.p_exceeds_threshold
+    return {
+        'query_containment_ani': query_containment_ani,
+        'match_containment_ani': match_containment_ani,
+        'average_containment_ani': (query_containment_ani + match_containment_ani) / 2,
+        'max_containment_ani': np.maximum(query_containment_ani, match_containment_ani),
+        'potential_false_negative': potential_false_negative,
+    }
+
+
+"""
+Build the prefetch table from the number of hashes that the query shares with every
+KO. Only the KOs with at least threshold_bp of overlap are kept, as in `sourmash prefetch`.
+If sum_abund (the sum of the query abundances of the shared hashes of every KO) is given, the
+WEIGHTED_COLUMNS are added.
+"""
+def build_prefetch_table(n_common, ko_names, ko_n_hashes, query_n_hashes, ksize, scaled, threshold_bp,
+                         ko_md5s=None, ko_filename='', query_name='', query_md5='', sum_abund=None):
+    n_common = np.asarray(n_common, dtype=np.int64)
+    ko_n_hashes = np.asarray(ko_n_hashes, dtype=np.int64)
+    keep = np.flatnonzero((n_common > 0) & (n_common * scaled >= threshold_bp))
+    if query_n_hashes == 0 or threshold_bp > query_n_hashes * scaled:
+        # sourmash refuses an empty query or an unattainable threshold
+        keep = keep[:0]
+
+    n_common = n_common[keep]
+    ko_n_hashes = ko_n_hashes[keep]
+    f_query_match = debiased_containment(n_common, ko_n_hashes, scaled)
+    f_match_query = debiased_containment(n_common, query_n_hashes, scaled)
+    min_n_hashes = np.minimum(ko_n_hashes, query_n_hashes)
+    df = pd.DataFrame({
+        'intersect_bp': n_common * scaled,
+        'jaccard': n_common / (ko_n_hashes + query_n_hashes - n_common),
+        'max_containment': debiased_containment(n_common, min_n_hashes, scaled),
+        'f_query_match': f_query_match,
+        'f_match_query': f_match_query,
+        'match_filename': ko_filename,
+        'match_name': [ko_names[i] for i in keep],
+        'match_md5': [ko_md5s[i][:8] for i in keep] if ko_md5s is not None else '',
+        'match_bp': ko_n_hashes * scaled,
+        'query_filename': query_name,
+        'query_name': query_name,
+        'query_md5': query_md5[:8],
+        'query_bp': query_n_hashes * scaled,
+        'ksize': ksize,
+        'moltype': 'protein',
+        'scaled': scaled,
+        'query_n_hashes': query_n_hashes,
+        'query_abundance': sum_abund is not None,
+        **containment_ani_columns(f_match_query, f_query_match, ko_n_hashes, query_n_hashes, ksize, scaled),
+    }, columns=PREFETCH_COLUMNS)
+    if sum_abund is not None:
+        sum_abund = np.asarray(sum_abund, dtype=np.int64)[keep]
+        df['sum_abund'] = sum_abund
+        df['average_abund'] = sum_abund / np.maximum(n_common, 1)
+    return df
+
+
+"""
+Run the equivalent of `sourmash prefetch` in memory: compute the overlap between the
+metagenome sketch and every KO signature. Returns the prefetch table as a DataFrame.
+"""
+def prefetch(query_minhash, ko_sigs, ksize, scaled, threshold_bp, query_name='', weighted=False):
+    return prefetch_thresholds(query_minhash, ko_sigs, ksize, scaled, [threshold_bp], query_name, weighted)[threshold_bp]
+
+
+"""
+Like prefetch, for several values of threshold_bp at once: the overlaps are computed once, and
+only the filtering depends on the threshold. Returns a dictionary threshold_bp -> prefetch table.
+With weighted, the abundances of the query hashes are summed over the hashes of every KO, and
+the tables have the WEIGHTED_COLUMNS.
+"""
+def prefetch_thresholds(query_minhash, ko_sigs, ksize, scaled, thresholds, query_name='', weighted=False):
+    sum_abund = None
+    if weighted:
+        query_hashes, query_abunds = minhash_to_arrays(query_minhash, scaled=scaled)
+        n_common, sum_abund = count_shared_abundances(query_hashes, query_abunds,
+                                                      [minhash_to_arrays(sig.minhash)[0] for sig in ko_sigs])
+    query_flat = query_minhash.flatten()
+    if query_flat.scaled < scaled:
+        query_flat = query_flat.downsample(scaled=scaled)
+    if not weighted:
+        n_common = [query_flat.count_common(sig.minhash) for sig in ko_sigs]
+    query_sig = sourmash.SourmashSignature(query_flat, name=query_name)
+    ko_names = [sig.name for sig in ko_sigs]
+    ko_n_hashes = [len(sig.minhash) for sig in ko_sigs]
+    ko_md5s = [sig.md5sum() for sig in ko_sigs]
+    return {threshold_bp: build_prefetch_table(n_common, ko_names=ko_names, ko_n_hashes=ko_n_hashes,
+                                               query_n_hashes=len(query_flat),
+                                               ksize=ksize, scaled=scaled, threshold_bp=threshold_bp,
+                                               ko_md5s=ko_md5s,
+                                               ko_filename=ko_sigs[0].filename if ko_sigs else '',
+                                               query_name=query_name, query_md5=query_sig.md5sum(),
+                                               sum_abund=sum_abund)
+            for threshold_bp in thresholds}
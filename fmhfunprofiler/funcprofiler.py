@@ -2,58 +2,103 @@
 Functional profiler for a metagenome sample. The profiler will work with a FracMinHash sketch of KOs,
  and a metagenome sample. The profiler needs to know which parameters were used to obtain the
  KO sketch (protein kmer size, and scaled -- see sourmash documentations for more details about these parameters)
+
+funcprofiler-many starts one funcprofiler per sample, so the start-up is kept short: numpy,
+pandas and the sourmash Python API are imported by the functions that use them, and the
+environment is checked without running or importing anything (see sanity_check).
 """
 
 import argparse
-import time
+import functools
+import importlib.util
+import shutil
 import subprocess
-import pandas as pd
 import os
 import sys
+from fmhfunprofiler import checkpoint, metrics, reads, reassign, scratch, sketch_cache
+
+"""
+Parse a comma-separated list of integers, e.g. 7,11,15.
+"""
+def int_list(value):
+    try:
+        return [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a comma-separated list of integers')
+
+
 def parse_args():
     # create parser
     parser = argparse.ArgumentParser(description="Functional profiler for a metagenome sample. The profiler will work with a FracMinHash sketch of KOs, and a metagenome sample. The profiler needs to know which parameters were used to obtain the KO sketch (protein kmer size, and scaled -- see sourmash documentations for more details)")
     
     # required arguments
-    parser.add_argument("mg_filename", type=str, help="Name of the metagenome file")
+    parser.add_argument("mg_filename", type=str, help="Name of the metagenome file, or the read files of the sample separated by commas, e.g. sample_R1.fastq.gz,sample_R2.fastq.gz, sketched together without concatenating them")
     parser.add_argument("ko_sketch", type=str, help="Filename of KO sketch")
     parser.add_argument("ksize", type=int, help="Protein kmer size (7, 11, or 15) used to obtain the KO sketch")
     parser.add_argument("scaled", type=int, help="The scaled parameter used to obtain the KO sketch")
-    parser.add_argument("output", type=str, help="Output filename, where the KO profiles will be written")
+    parser.add_argument("output", type=str, help="Output filename, where the KO profiles will be written: CSV, compressed if the name ends in .gz, .bz2, .xz or .zst, or Parquet if it ends in .parquet (needs pyarrow)")
     
     # optional arguments
     parser.add_argument('-t', "--threshold_bp", type=int, help="The threshold_bp to run sourmash gather (1000 is preferred)", default=1000)
     parser.add_argument('-p', "--prefetch_file", type=str, help="The sourmash prefetch output")
+    parser.add_argument("--in_process", action="store_true", help="Sketch the metagenome and run prefetch with the sourmash Python API inside this process, instead of launching the sourmash command line tool")
+    parser.add_argument("--index", action="store_true", help="ko_sketch is an inverted KO index built with funcprofiler-index. Implies --in_process")
+    parser.add_argument("--processes", type=int, default=1, help="Number of processes translating and sketching the reads in parallel, with --in_process or --index (default 1)")
+    parser.add_argument("--ksizes", type=int_list, help="Comma-separated protein kmer sizes, e.g. 7,11,15, profiled from a single pass over the reads instead of ksize. Implies --in_process")
+    parser.add_argument("--thresholds", type=int_list, help="Comma-separated threshold_bp values, e.g. 100,500,1000, all computed from the same containment counts instead of -t. Implies --in_process")
+    parser.add_argument("--scaled_values", type=int_list, help="Comma-separated scaled values, e.g. 10,100,1000, profiled from a single sketch at the finest of them instead of scaled. ko_sketch may hold a {scaled} placeholder, replaced by every scaled value to find its KO sketch. Implies --in_process")
+    parser.add_argument("--abundance_weighted", action="store_true", help="Weight the KO abundances by the multiplicities of the sample hashes they share, instead of by their containment. Implies --in_process")
+    parser.add_argument("--reassign", type=str, choices=reassign.REASSIGN_METHODS, help="Split the hashes shared by several KOs between them, by EM or greedily as sourmash gather does, and profile from the reassigned hashes. Implies --in_process")
+    parser.add_argument("--em_tolerance", type=float, default=1e-6, help="With --reassign em, stop when no KO weight changes by more than this (default 1e-6)")
+    parser.add_argument("--em_max_iterations", type=int, default=1000, help="With --reassign em, maximum number of iterations (default 1000)")
+    parser.add_argument("--prefilter", action="store_true", help="Drop the hashes of the metagenome that no KO contains while sketching, so that the sample sketch only holds hashes that can match. Implies --in_process")
+    parser.add_argument("--ko_subset", type=str, help="File of the KO ids of interest, one per line (or the first column of a CSV file, such as a KO profile): the sample is only matched against these KOs, through a reduced index extracted from ko_sketch once and cached in --subset_dir. Implies --in_process")
+    parser.add_argument("--subset_dir", type=str, help="Directory of the cached reduced indexes of --ko_subset. Default: $FMHFUNPROFILER_SUBSET_DIR, or ~/.cache/fmhfunprofiler/ko_subsets")
+    parser.add_argument("--metrics", type=str, help="Write the wall time, CPU time, peak RSS, bytes read and hashes processed of every stage to this file")
+    parser.add_argument("--metrics_format", type=str, choices=metrics.METRICS_FORMATS, default='jsonl', help="Format of the --metrics file: JSON lines (default), or Prometheus text")
+    parser.add_argument("--cache", action="store_true", help="Reuse the sketch of the metagenome from the sketch cache, if the same file content was sketched before with the same ksize and scaled, and cache it otherwise")
+    parser.add_argument("--cache_dir", type=str, help="Directory of the sketch cache (implies --cache). Default: $FMHFUNPROFILER_CACHE_DIR, or ~/.cache/fmhfunprofiler/sketches")
+    parser.add_argument("--cache_max_size", type=str, help="Maximum size of the sketch cache, e.g. 20G. The least recently used sketches are removed when the cache grows larger")
+    parser.add_argument("--scratch_dir", type=str, help="Directory where a unique scratch directory of the run holds the intermediate sketch and prefetch table of the sourmash command line tool, removed when the run ends. Default: $TMPDIR, or the temporary directory of the system")
+    parser.add_argument("--pipe", action="store_true", help="Pipe the metagenome sketch from sourmash sketch into sourmash prefetch, and read the prefetch table from its output, so that no intermediate file is written. The in-process engine (--in_process) keeps them in memory as well")
+    parser.add_argument("--skip_checks", action="store_true", help="Do not check that sourmash, pandas and numpy are installed, e.g. when funcprofiler-many has checked them already")
     
     # parse arguments
     args = parser.parse_args()
     return args
 
 """
-Sanity check the environment. 
+Whether a command is found on the PATH, without running it. The answer is cached.
+"""
+@functools.lru_cache(maxsize=None)
+def command_available(command):
+    return shutil.which(command) is not None
+
+
+"""
+Whether a Python module can be imported, without importing it. The answer is cached.
+"""
+@functools.lru_cache(maxsize=None)
+def module_available(module):
+    return importlib.util.find_spec(module) is not None
+
+
 """
-def sanity_check():
+Sanity check the environment. With require_cli, the sourmash command line tool is needed,
+and the sourmash Python package otherwise.
+"""
+def sanity_check(require_cli=True):
     # check if sourmash is installed
     found_error = False
-    try:
-        res = subprocess.call( ['sourmash', '--help'] )
-    except:
+    if not (command_available('sourmash') if require_cli else module_available('sourmash')):
         print('Error: sourmash is not installed. Please install sourmash before running this script.')
         found_error = True
 
-    # check if pandas is installed
-    try:
-        import pandas as pd
-    except ImportError:
-        print('Error: pandas is not installed. Please install pandas before running this script.')
-        found_error = True
-
-    # check if numpy is installed
-    try:
-        import numpy as np
-    except ImportError:
-        print('Error: numpy is not installed. Please install numpy before running this script.')
-        found_error = True
+    # check if pandas and numpy are installed
+    for module in ['pandas', 'numpy']:
+        if not module_available(module):
+            print(f'Error: {module} is not installed. Please install {module} before running this script.')
+            found_error = True
 
     if found_error:
         sys.exit(1)
@@ -62,16 +107,21 @@ def sanity_check():
 Check the arguments for correctness.
 """
 def check_args(args):
-    # check if the metagenome file exists
-    if not os.path.exists(args.mg_filename):
-        print(f'Error: Metagenome file {args.mg_filename} does not exist. Exiting...')
+    # check if the metagenome files exist
+    if not reads.read_files(args.mg_filename):
+        print(f'Error: Metagenome file {args.mg_filename} is not valid. Exiting...')
         sys.exit(1)
-
-    # check if the KO sketch file exists
-    if not os.path.exists(args.ko_sketch):
-        print(f'Error: KO sketch file {args.ko_sketch} does not exist. Exiting...')
+    for mg_filename in reads.missing_read_files(args.mg_filename):
+        print(f'Error: Metagenome file {mg_filename} does not exist. Exiting...')
         sys.exit(1)
 
+    # check if the KO sketch files exist
+    for scaled in dict.fromkeys(args.scaled_values or [args.scaled]):
+        ko_sketch = ko_sketch_for_scaled(args.ko_sketch, scaled)
+        if not os.path.exists(ko_sketch):
+            print(f'Error: KO sketch file {ko_sketch} does not exist. Exiting...')
+            sys.exit(1)
+
     # check if the protein kmer size is valid
     if args.ksize not in [7, 11, 15]:
         print(f'Error: Protein kmer size {args.ksize} is not valid. Exiting...')
@@ -87,15 +137,85 @@ def check_args(args):
         print(f'Error: threshold_bp {args.threshold_bp} is not valid. Exiting...')
         sys.exit(1)
 
+    # check the lists of ksizes and thresholds
+    if args.ksizes is not None:
+        if not args.ksizes or any(ksize not in [7, 11, 15] for ksize in args.ksizes):
+            print(f'Error: Protein kmer sizes {args.ksizes} are not valid. Exiting...')
+            sys.exit(1)
+        if args.index and len(set(args.ksizes)) > 1:
+            print('Error: a KO index holds a single ksize, --ksizes cannot list several with --index. Exiting...')
+            sys.exit(1)
+    if args.scaled_values is not None:
+        if not args.scaled_values or any(scaled < 1 for scaled in args.scaled_values):
+            print(f'Error: Scaled values {args.scaled_values} are not valid. Exiting...')
+            sys.exit(1)
+        if args.index and len(set(args.scaled_values)) > 1 and SCALED_PLACEHOLDER not in args.ko_sketch:
+            print(f'Error: a KO index holds a single scaled, ko_sketch needs a {SCALED_PLACEHOLDER} placeholder to use several with --index. Exiting...')
+            sys.exit(1)
+    if args.thresholds is not None:
+        if not args.thresholds or any(threshold_bp < 1 for threshold_bp in args.thresholds):
+            print(f'Error: thresholds {args.thresholds} are not valid. Exiting...')
+            sys.exit(1)
+
+    # check the KO subset
+    if args.ko_subset is not None:
+        from fmhfunprofiler import ko_index
+        ko_index.check_ko_subset(args.ko_subset)
+
+    # check if the output format can be written
+    if profile_format(args.output) == 'parquet' and not module_available('pyarrow'):
+        print('Error: pyarrow is not installed. Please install pyarrow to write .parquet KO profiles.')
+        sys.exit(1)
+
+    # check the EM parameters
+    if args.em_tolerance <= 0:
+        print(f'Error: EM tolerance {args.em_tolerance} is not valid. Exiting...')
+        sys.exit(1)
+    if args.em_max_iterations < 1:
+        print(f'Error: EM maximum number of iterations {args.em_max_iterations} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the number of sketching processes is valid
+    if args.processes < 1:
+        print(f'Error: number of processes {args.processes} is not valid. Exiting...')
+        sys.exit(1)
+
+    # a prefiltered sketch depends on the KO sketch, and cannot be shared through the cache
+    if args.prefilter and (args.cache or args.cache_dir):
+        print('Error: --prefilter cannot be used with the sketch cache. Exiting...')
+        sys.exit(1)
+
+    # a piped sketch is never written, so it cannot be cached
+    if args.pipe and (args.cache or args.cache_dir):
+        print('Error: --pipe cannot be used with the sketch cache. Exiting...')
+        sys.exit(1)
+    if args.pipe and in_process_requested(args):
+        print('Error: --pipe runs the sourmash command line tool, and cannot be used with the in-process engine. Exiting...')
+        sys.exit(1)
+    if args.scratch_dir is not None and in_process_requested(args):
+        print('Error: --scratch_dir holds the intermediate files of the sourmash command line tool, and cannot be used with the in-process engine. Exiting...')
+        sys.exit(1)
+
+    # check if the cache size is valid
+    if args.cache_max_size is not None:
+        try:
+            sketch_cache.parse_size(args.cache_max_size)
+        except ValueError:
+            print(f'Error: cache size {args.cache_max_size} is not valid. Exiting...')
+            sys.exit(1)
+
     return True
 
 
 """
-Create a sketch of the metagenome sample. Returns the filename of the sketch.
+Create a sketch of the metagenome sample in output_dir, e.g. the scratch directory of the run.
+Returns the filename of the sketch. The reads of a sample of several read files are merged into
+a single sketch, named after the first file.
 """
-def create_sketch(mg_filename, ksize, scaled):
+def create_sketch(mg_filename, ksize, scaled, output_dir):
     print('Creating metagenome sketch...')
-    metagenome_sketch_filename = f'{mg_filename}_sketch_{int(time.time())}.sig.zip'
+    read_filenames = reads.read_files(mg_filename)
+    metagenome_sketch_filename = os.path.join(output_dir, f'{os.path.basename(read_filenames[0])}.sig.zip')
 
     # make sure that write permission is available on sketch filename
     if os.path.exists(metagenome_sketch_filename):
@@ -103,7 +223,9 @@ def create_sketch(mg_filename, ksize, scaled):
         sys.exit(1)
 
     # generate command and execute
-    cmd = f'sourmash sketch translate -p scaled={scaled},k={ksize},abund {mg_filename} -o {metagenome_sketch_filename}'
+    cmd = f'sourmash sketch translate -p scaled={scaled},k={ksize},abund {" ".join(read_filenames)} -o {metagenome_sketch_filename}'
+    if len(read_filenames) > 1:
+        cmd += f' --merge {os.path.basename(read_filenames[0])}'
     
     # execute command and check for errors
     res = subprocess.call( cmd.split(' ') )
@@ -121,12 +243,398 @@ def create_sketch(mg_filename, ksize, scaled):
     return metagenome_sketch_filename
 
     
-def main():
-    # sanity check the environment
-    sanity_check()
+PROFILE_COLUMNS = ['ko_id', 'abundance']
+SCALED_PLACEHOLDER = '{scaled}'
+FORMAT_EXTENSIONS = ['.csv', '.txt', '.parquet']
+COMPRESSION_EXTENSIONS = ['.gz', '.bz2', '.xz', '.zst']
+
+
+"""
+Format of a KO profile file, from its name: parquet for .parquet, and CSV otherwise (which pandas
+compresses when the name ends in .gz, .bz2, .xz or .zst).
+"""
+def profile_format(filename):
+    return 'parquet' if filename.endswith('.parquet') else 'csv'
+
+
+"""
+Read the prefetch output of the sourmash command line tool for write_ko_profiles. Only match_name
+and weight_column are parsed, so the other columns (the long signature names and md5s among them)
+are never held in memory. The table has at most one row per KO, so it is read at once.
+"""
+def read_prefetch_weights(prefetch_filename, weight_column='f_match_query'):
+    import numpy as np
+    import pandas as pd
+    return pd.read_csv(prefetch_filename, usecols=['match_name', weight_column],
+                       dtype={'match_name': str, weight_column: np.float64})
+
+
+"""
+Compute the KO relative abundances from a prefetch table, and write them to the output file.
+The abundances are the values of weight_column (f_match_query by default, see profile_weight_column)
+normalized to sum to 1. The output format is given by the name of the output file, see profile_format.
+"""
+def write_ko_profiles(df, output_filename, weight_column='f_match_query'):
+    import numpy as np
+    import pandas as pd
+    if len(df) == 0:
+        print('Prefetch output is empty. No matches in KEGG KOs found. Creating an empty KO profile')
+        write_profile_table(pd.DataFrame(columns=PROFILE_COLUMNS), output_filename)
+        return
+
+    print('Extracting KO abundances from prefetch output...')
+    weights = df[weight_column].to_numpy(dtype=np.float64)
+    df_out = pd.DataFrame({'ko_id': df['match_name'].to_numpy(), 'abundance': weights / weights.sum()}, copy=False)
+    write_profile_table(df_out, output_filename)
+    print(f'KO profiles have been written to {output_filename}')
+
+
+def write_profile_table(df_out, output_filename):
+    if profile_format(output_filename) == 'parquet':
+        checkpoint.atomic_write(output_filename, lambda tmp_filename: df_out.to_parquet(tmp_filename, index=False))
+    else:
+        checkpoint.atomic_write(output_filename, lambda tmp_filename: df_out.to_csv(tmp_filename, index=False))
+
+
+"""
+Open the sketch cache requested by the arguments. Returns None if the cache is not used.
+"""
+def open_cache(args):
+    if not (args.cache or args.cache_dir):
+        return None
+    max_size = sketch_cache.parse_size(args.cache_max_size) if args.cache_max_size else None
+    return sketch_cache.SketchCache(args.cache_dir, max_size)
+
+
+"""
+Sketch the metagenome in memory at every ksize, in one pass over the reads, with the given
+number of processes. Returns a dictionary ksize -> minhash. With keep_hashes (a dictionary
+ksize -> sorted KO hashes), only these hashes are kept. If a sketch cache is given, the
+sketches are taken from it when possible, and stored in it otherwise.
+"""
+def sketch_sample(mg_filename, ksizes, scaled, processes=1, cache=None, keep_hashes=None):
+    from fmhfunprofiler import sketching
+    print('Creating metagenome sketch in memory...')
+    def sketch_multi_function(mg_filename, ksizes, scaled):
+        return sketching.sketch_metagenome_multi(mg_filename, ksizes, scaled, processes, keep_hashes=keep_hashes)
+    if cache is None:
+        return sketch_multi_function(mg_filename, ksizes, scaled)
+    return sketch_cache.cached_sketches(cache, mg_filename, ksizes, scaled, sketch_multi_function)
+
+
+"""
+Profile the metagenome with the in-process engine: the reads are sketched, and the KO sketch
+is loaded and matched, with the sourmash Python API. With use_index, ko_sketch is an inverted
+KO index built with funcprofiler-index. All the ksizes are sketched from one pass over the
+reads, and all the thresholds are computed from one set of containment counts per ksize.
+With prefilter, the sample sketch only keeps the hashes found in the KOs, so the columns
+relative to the query (f_match_query, query_bp, ...) are relative to these hashes, while the
+KO profile stays the same.
+
+scaled is a single scaled value, or a list of them. The sample is then sketched once, at the
+finest scaled, and matched against the KO sketch of every scaled (see ko_sketch_for_scaled):
+a FracMinHash downsamples exactly to any coarser scaled, by keeping the hashes below its
+max_hash, so the profiles are the ones of separate runs at every scaled.
+
+With ko_subset (a list of KO ids), the sample is only matched against these KOs, through the
+reduced index of every (ksize, scaled), taken from (or built into) the subset directory
+subset_dir, see ko_index.cached_subset_index.
 
+Returns a dictionary (ksize, scaled, threshold_bp) -> prefetch table, with the
+abundance-weighted columns if weighted, and the reassigned columns with reassign_method (see
+match_sample). The stages are recorded in run_metrics, if given.
+"""
+def run_in_process(mg_filename, ko_sketch, ksizes, scaled, thresholds, processes=1, cache=None, use_index=False, run_metrics=None,
+                   weighted=False, reassign_method=None, em_tolerance=1e-6, em_max_iterations=1000, prefilter=False,
+                   ko_subset=None, subset_dir=None):
+    import numpy as np
+    from fmhfunprofiler import ko_index
+    if run_metrics is None:
+        run_metrics = metrics.Metrics()
+    scaled_values = list(dict.fromkeys(scaled if isinstance(scaled, (list, tuple)) else [scaled]))
+    # the KO sketch (or index) of every (ksize, scaled)
+    references = {(ksize, s): ko_sketch_for_scaled(ko_sketch, s) for ksize in dict.fromkeys(ksizes) for s in scaled_values}
+    if ko_subset is not None:
+        with run_metrics.stage('ko_subset') as record:
+            for (ksize, s), filename in references.items():
+                references[(ksize, s)] = ko_index.cached_subset_index(filename, ksize, s, ko_subset, use_index, subset_dir)
+            record['read_bytes'] = sum(os.path.getsize(filename) for filename in set(references.values()))
+        use_index = True
+    sketch_scaled = min(scaled_values)
+    keep_hashes = None
+    # the KOs loaded for the prefilter are kept, and matched without loading them again
+    loaded_references = {}
+    if prefilter:
+        with run_metrics.stage('prefilter') as record:
+            keep_hashes = {}
+            for ksize in dict.fromkeys(ksizes):
+                hash_sets = []
+                for s in scaled_values:
+                    filename = references[(ksize, s)]
+                    print(f'Loading the KO hashes from {filename}...')
+                    loaded_references[(ksize, s)] = ko_index.load_reference(filename, ksize, s, use_index)
+                    hash_sets.append(ko_index.reference_hash_set(loaded_references[(ksize, s)]))
+                keep_hashes[ksize] = hash_sets[0] if len(hash_sets) == 1 else np.unique(np.concatenate(hash_sets))
+            record['read_bytes'] = sum(os.path.getsize(filename) for filename in set(references.values()))
+            record['hashes'] = sum(len(hashes) for hashes in keep_hashes.values())
+    with run_metrics.stage('sketch') as record:
+        query_minhashes = sketch_sample(mg_filename, ksizes, sketch_scaled, processes, cache, keep_hashes)
+        record['read_bytes'] = reads.input_size(mg_filename)
+        record['hashes'] = sum(len(query_minhash) for query_minhash in query_minhashes.values())
+    tables = {}
+    for ksize, query_minhash in query_minhashes.items():
+        for s in scaled_values:
+            filename = references[(ksize, s)]
+            labels = {'ksize': ksize} if len(scaled_values) == 1 else {'ksize': ksize, 'scaled': s}
+            with run_metrics.stage('prefetch', **labels) as record:
+                # the sample hashes above the max_hash of s are dropped while matching
+                dfs = match_sample(mg_filename, query_minhash, filename, ksize, s, thresholds, use_index, weighted,
+                                   reassign_method, em_tolerance, em_max_iterations, loaded_references.pop((ksize, s), None))
+                record['read_bytes'] = os.path.getsize(filename)
+                record['hashes'] = len(query_minhash)
+            for threshold_bp, df in dfs.items():
+                tables[(ksize, s, threshold_bp)] = df
+    return tables
+
+
+"""
+The KO sketch of one scaled value: the {scaled} placeholder of ko_sketch, if any, is replaced by
+scaled, e.g. ko_sketches_{scaled}.zip. Without one, ko_sketch is used for every scaled value.
+"""
+def ko_sketch_for_scaled(ko_sketch, scaled):
+    return ko_sketch.replace(SCALED_PLACEHOLDER, str(scaled))
+
+
+"""
+Load the KO sketches (or KO index) of one ksize, and match the sample sketch against them.
+If reference is given, it holds these KOs already loaded (see ko_index.load_reference), and
+ko_sketch is not read again. With reassign_method (em or greedy), the hashes shared by several
+KOs of every table are then split between them, see reassign.py. Returns a dictionary
+threshold_bp -> prefetch table.
+"""
+def match_sample(mg_filename, query_minhash, ko_sketch, ksize, scaled, thresholds, use_index=False, weighted=False,
+                 reassign_method=None, em_tolerance=1e-6, em_max_iterations=1000, reference=None):
+    from fmhfunprofiler import engine, ko_index
+    sample_hashes, sample_abunds = engine.minhash_to_arrays(query_minhash, scaled=scaled)
+    if use_index:
+        if reference is None:
+            print(f'Loading KO index from {ko_sketch}...')
+            reference = ko_index.load_checked_index(ko_sketch, ksize, scaled)
+        index = reference
+        print(f'Matching the metagenome sketch against the KO index (ksize={ksize})...')
+        dfs = index.prefetch_thresholds(query_minhash, thresholds, query_name=mg_filename, weighted=weighted)
+        if reassign_method is not None:
+            ko_names = index.ko_names
+            hash_positions, ko_ids = index.shared_hash_pairs(sample_hashes)
+    else:
+        if reference is None:
+            print(f'Loading KO sketches with ksize={ksize} from {ko_sketch}...')
+            reference = engine.load_ko_sketches(ko_sketch, ksize, scaled)
+        ko_sigs = reference
+        print(f'Running prefetch in memory (ksize={ksize})...')
+        dfs = engine.prefetch_thresholds(query_minhash, ko_sigs, ksize, scaled, thresholds, query_name=mg_filename, weighted=weighted)
+        if reassign_method is not None:
+            ko_names = [sig.name for sig in ko_sigs]
+            hash_positions, ko_ids = engine.shared_hash_pairs(sample_hashes, [engine.minhash_to_arrays(sig.minhash)[0] for sig in ko_sigs])
+
+    if reassign_method is None:
+        return dfs
+    print(f'Reassigning the hashes shared by several KOs ({reassign_method})...')
+    reassigned = {}
+    for threshold_bp, df in dfs.items():
+        reassigned[threshold_bp], n_iterations = reassign.reassign_shared_hashes(
+            df, hash_positions, ko_ids, ko_names, sample_abunds, scaled, threshold_bp,
+            method=reassign_method, tolerance=em_tolerance, max_iterations=em_max_iterations, weighted=weighted)
+        if reassign_method == 'em':
+            print(f'EM has run {n_iterations} iterations (threshold_bp={threshold_bp})')
+    return reassigned
+
+
+"""
+The column of the prefetch table that the KO abundances are computed from.
+"""
+def profile_weight_column(args):
+    if args.reassign is not None:
+        return 'f_unique_weighted' if args.abundance_weighted else 'f_unique_to_query'
+    return 'sum_abund' if args.abundance_weighted else 'f_match_query'
+
+
+"""
+Split the format extension off a filename: .csv, .txt or .parquet, and/or a compression extension
+(see profile_format). Returns the rest of the filename, and the extension ('' if none).
+"""
+def split_format_extension(filename):
+    root, extension = os.path.splitext(filename)
+    if extension not in COMPRESSION_EXTENSIONS + FORMAT_EXTENSIONS:
+        return filename, ''
+    if extension in COMPRESSION_EXTENSIONS:
+        inner_root, inner_extension = os.path.splitext(root)
+        if inner_extension in FORMAT_EXTENSIONS:
+            return inner_root, inner_extension + extension
+    return root, extension
+
+
+"""
+Name of the output of one (ksize, threshold_bp) combination, or (ksize, scaled, threshold_bp)
+if several scaled values are profiled, e.g. ko_profiles_k7_t50.csv.gz for ko_profiles.csv.gz:
+the suffix goes before the format extension, so that the output keeps its format. When a
+single combination is profiled, the filename is used as it is.
+"""
+def combination_filename(filename, ksize, threshold_bp, n_combinations, scaled=None):
+    if n_combinations == 1:
+        return filename
+    root, extension = split_format_extension(filename)
+    if scaled is not None:
+        return f'{root}_k{ksize}_s{scaled}_t{threshold_bp}{extension}'
+    return f'{root}_k{ksize}_t{threshold_bp}{extension}'
+
+
+"""
+Profile the metagenome with the sourmash command line tool: sketch the metagenome into the
+scratch directory (or reuse its sketch from the cache), and run sourmash prefetch. The prefetch
+table is written to prefetch_output_filename if given, and to the scratch directory otherwise.
+Returns the prefetch table (a filename) and its size in bytes, or None if it is empty.
+"""
+def run_cli(mg_filename, ko_sketch, ksize, scaled, threshold_bp, prefetch_output_filename, cache, scratch_dir, run_metrics):
+    # create metagenome sketch, or reuse the cached one
+    with run_metrics.stage('sketch') as sketch_record:
+        metagenome_sketch_filename = None
+        if cache is not None:
+            cache_key = sketch_cache.cache_key(reads.content_digest(mg_filename), ksize, scaled)
+            metagenome_sketch_filename = cache.get(cache_key)
+            if metagenome_sketch_filename is not None:
+                print(f'Using the cached sketch {metagenome_sketch_filename}')
+        if metagenome_sketch_filename is None:
+            metagenome_sketch_filename = create_sketch(mg_filename, ksize, scaled, scratch_dir)
+            if cache is not None:
+                cached_filename = cache.put_file(cache_key, metagenome_sketch_filename)
+                print(f'Sketch of the metagenome has been cached to {cached_filename}')
+        sketch_record['read_bytes'] = reads.input_size(mg_filename)
+
+    # run sourmash prefetch
+    with run_metrics.stage('prefetch') as record:
+        if prefetch_output_filename is None:
+            prefetch_output_filename = os.path.join(scratch_dir, f'{os.path.basename(reads.read_files(mg_filename)[0])}_prefetch.csv')
+        print('Running sourmash prefetch...')
+        # command: sourmash prefetch <mg_sketch_name> <ko_sketch_name> -o <prefetch_output_filename> -k <ksize> --scaled <scaled> --protein --threshold-bp <threshold_bp>
+        cmd = f'sourmash prefetch {metagenome_sketch_filename} {ko_sketch} -o {prefetch_output_filename} -k {ksize} --scaled {scaled} --protein' + f' --threshold-bp {threshold_bp}'
+        print(cmd)
+        subprocess.call( cmd.split(' ') )
+        print(f'sourmash prefetch results have been stored to {prefetch_output_filename}')
+        record['read_bytes'] = os.path.getsize(metagenome_sketch_filename) + os.path.getsize(ko_sketch)
+        record['hashes'] = sketch_n_hashes(metagenome_sketch_filename, prefetch_output_filename, ksize)
+    # the sketch holds the hashes that prefetch processed, which are only counted now
+    sketch_record['hashes'] = record['hashes']
+
+    # check if file is empty
+    if os.path.exists(prefetch_output_filename) and os.stat(prefetch_output_filename).st_size > 0:
+        return prefetch_output_filename, os.path.getsize(prefetch_output_filename)
+    return None
+
+
+"""
+Number of sample hashes that sourmash prefetch compared to the KOs: the query_n_hashes column of
+its prefetch table (a filename or a file object), or None if the table has no rows.
+"""
+def prefetch_query_n_hashes(prefetch_table):
+    import pandas as pd
+    try:
+        df = pd.read_csv(prefetch_table, usecols=['query_n_hashes'], nrows=1)
+    except (pd.errors.EmptyDataError, FileNotFoundError):
+        return None
+    return int(df['query_n_hashes'].iloc[0]) if len(df) > 0 else None
+
+
+"""
+Number of hashes of the sample sketch written by the sourmash command line tool, from the
+prefetch table if it has rows, and from the sketch itself otherwise.
+"""
+def sketch_n_hashes(sketch_filename, prefetch_filename, ksize):
+    n_hashes = prefetch_query_n_hashes(prefetch_filename)
+    if n_hashes is None:
+        from fmhfunprofiler import engine
+        n_hashes = len(engine.load_sketch(sketch_filename, ksize))
+    return n_hashes
+
+
+"""
+Profile the metagenome with the sourmash command line tool, without intermediate files: the
+sketch is piped from sourmash sketch translate into sourmash prefetch, whose table is read from
+its output. The prefetch table is written to prefetch_output_filename only if given. Returns the
+prefetch table (a file object in memory) and its size in bytes, or None if it is empty.
+"""
+def run_piped(mg_filename, ko_sketch, ksize, scaled, threshold_bp, prefetch_output_filename, run_metrics):
+    import io
+    read_filenames = reads.read_files(mg_filename)
+    sketch_cmd = ['sourmash', 'sketch', 'translate', '-p', f'scaled={scaled},k={ksize},abund', *read_filenames, '-o', '-']
+    if len(read_filenames) > 1:
+        sketch_cmd += ['--merge', os.path.basename(read_filenames[0])]
+    prefetch_cmd = ['sourmash', 'prefetch', '-', ko_sketch, '-o', '-', '-k', str(ksize), '--scaled', str(scaled), '--protein',
+                    '--threshold-bp', str(threshold_bp)]
+
+    # the sketch and prefetch run at the same time, so they are recorded as a single stage
+    with run_metrics.stage('sketch_prefetch') as record:
+        print('Piping the metagenome sketch into sourmash prefetch...')
+        print(' '.join(sketch_cmd) + ' | ' + ' '.join(prefetch_cmd))
+        sketch_process = subprocess.Popen(sketch_cmd, stdout=subprocess.PIPE)
+        prefetch_process = subprocess.Popen(prefetch_cmd, stdin=sketch_process.stdout, stdout=subprocess.PIPE)
+        # let sourmash sketch receive SIGPIPE if sourmash prefetch exits early
+        sketch_process.stdout.close()
+        prefetch_output, _ = prefetch_process.communicate()
+        if sketch_process.wait() != 0 or prefetch_process.returncode != 0:
+            print('Error: Failed to sketch the metagenome and run sourmash prefetch. Exiting...')
+            sys.exit(1)
+        record['read_bytes'] = reads.input_size(mg_filename) + os.path.getsize(ko_sketch)
+        # the piped sketch is not kept, so its hashes are only known when the table has rows
+        record['hashes'] = prefetch_query_n_hashes(io.BytesIO(prefetch_output)) or 0
+
+    if prefetch_output_filename is not None:
+        def write_prefetch(tmp_filename):
+            with open(tmp_filename, 'wb') as fp:
+                fp.write(prefetch_output)
+        checkpoint.atomic_write(prefetch_output_filename, write_prefetch)
+        print(f'sourmash prefetch results have been stored to {prefetch_output_filename}')
+    if not prefetch_output.strip():
+        return None
+    return io.BytesIO(prefetch_output), len(prefetch_output)
+
+
+"""
+Whether the options ask for the in-process engine, which the sourmash command line tool cannot
+replace.
+"""
+def in_process_requested(args):
+    return bool(args.in_process or args.index or args.ksizes or args.scaled_values or args.thresholds or args.abundance_weighted or args.reassign or args.prefilter or args.ko_subset)
+
+
+"""
+The KO ids of --ko_subset, or None if the sample is matched against all the KOs.
+"""
+def read_ko_subset(args):
+    if args.ko_subset is None:
+        return None
+    from fmhfunprofiler import ko_index
+    return ko_index.read_ko_list(args.ko_subset)
+
+
+"""
+Write the stage metrics, if they were requested.
+"""
+def write_run_metrics(args, run_metrics):
+    if args.metrics is not None:
+        run_metrics.write(args.metrics, args.metrics_format)
+        print(f'Stage metrics have been written to {args.metrics}')
+
+
+def main():
     # parse arguments
     args = parse_args()
+    run_metrics = metrics.Metrics(sample=args.mg_filename)
+
+    # sanity check the environment
+    with run_metrics.stage('sanity_check'):
+        if not args.skip_checks:
+            sanity_check(require_cli=not in_process_requested(args))
 
     # check arguments
     check_args(args)
@@ -139,41 +647,50 @@ def main():
     output_filename = args.output
     threshold_bp = args.threshold_bp
     prefetch_output_filename = args.prefetch_file
+    cache = open_cache(args)
 
-    # create metagenome sketch
-    metagenome_sketch_filename = create_sketch(mg_filename, ksize, scaled)
+    if in_process_requested(args):
+        ksizes = list(dict.fromkeys(args.ksizes or [ksize]))
+        thresholds = list(dict.fromkeys(args.thresholds or [threshold_bp]))
+        scaled_values = list(dict.fromkeys(args.scaled_values or [scaled]))
+        tables = run_in_process(mg_filename, ko_sketch, ksizes, scaled_values, thresholds, args.processes, cache,
+                                use_index=args.index, run_metrics=run_metrics, weighted=args.abundance_weighted,
+                                reassign_method=args.reassign, em_tolerance=args.em_tolerance, em_max_iterations=args.em_max_iterations,
+                                prefilter=args.prefilter, ko_subset=read_ko_subset(args), subset_dir=args.subset_dir)
+        for (k, s, t), df in tables.items():
+            # the scaled value only appears in the names when several are profiled
+            name_scaled = s if len(scaled_values) > 1 else None
+            labels = {'ksize': k, 'threshold_bp': t} if name_scaled is None else {'ksize': k, 'scaled': s, 'threshold_bp': t}
+            if len(tables) > 1:
+                print(', '.join(f'{name}={value}' for name, value in labels.items()) + ':')
+            with run_metrics.stage('abundance', **labels):
+                if prefetch_output_filename is not None:
+                    prefetch_filename = combination_filename(prefetch_output_filename, k, t, len(tables), name_scaled)
+                    checkpoint.atomic_write(prefetch_filename, lambda tmp_filename: df.to_csv(tmp_filename, index=False))
+                    print(f'prefetch results have been stored to {prefetch_filename}')
+                write_ko_profiles(df, combination_filename(output_filename, k, t, len(tables), name_scaled),
+                                  weight_column=profile_weight_column(args))
+        write_run_metrics(args, run_metrics)
+        print('Exiting...')
+        return
 
-    # run sourmash prefetch
-    if prefetch_output_filename is None:
-        prefetch_output_filename = f'{mg_filename}_gather_{int(time.time())}.tmp'
-    print('Running sourmash prefetch...')
-    # command: sourmash prefetch <mg_sketch_name> <ko_sketch_name> -o <prefetch_output_filename> -k <ksize> --scaled <scaled> --protein --threshold-bp <threshold_bp>
-    cmd = f'sourmash prefetch {metagenome_sketch_filename} {ko_sketch} -o {prefetch_output_filename} -k {ksize} --scaled {scaled} --protein' + f' --threshold-bp {threshold_bp}'
-    print(cmd)
-    subprocess.call( cmd.split(' ') )
-    print(f'sourmash prefetch results have been stored to {prefetch_output_filename}')
-    
-    # check if file is empty
-    if os.path.exists(prefetch_output_filename) and os.stat(prefetch_output_filename).st_size > 0:
-        # extract ko info from prefetch output
-        print('Extracting KO abundances from prefetch output...')
-        df = pd.read_csv(prefetch_output_filename, delimiter=',')
-        df_new = df[ ['match_name', 'f_match_query'] ]
-        sum_weights = df_new['f_match_query'].sum(axis=0)
-        df_tmp = df_new['f_match_query'].divide(sum_weights)
-        df_out = pd.concat([df['match_name'], df_tmp], axis=1)
-        df_out.columns = ['ko_id', 'abundance']
-        df_out.to_csv(output_filename, index=False)
-        print(f'KO profiles have been written to {output_filename}')
-    else:
-        print('Prefetch output file is empty. No matches in KEGG KOs found. Creating an empty KO profile CSV')
-        df_out = pd.DataFrame(columns=['ko_id', 'abundance'])
-        df_out.to_csv(output_filename, index=False)
-
-    # remove tmps
-    # print('Removing temps...')
-    # subprocess.call( ['rm', metagenome_sketch_filename] )
-    print('Exiting...')
+    # the intermediate files go to a scratch directory of this run, removed on exit
+    with scratch.scratch_directory(args.scratch_dir) as scratch_dir:
+        if args.pipe:
+            prefetch_table = run_piped(mg_filename, ko_sketch, ksize, scaled, threshold_bp, prefetch_output_filename, run_metrics)
+        else:
+            prefetch_table = run_cli(mg_filename, ko_sketch, ksize, scaled, threshold_bp, prefetch_output_filename, cache, scratch_dir, run_metrics)
+
+        with run_metrics.stage('abundance') as record:
+            # extract ko info from the prefetch table, unless it is empty
+            if prefetch_table is not None:
+                record['read_bytes'] = prefetch_table[1]
+                df = read_prefetch_weights(prefetch_table[0])
+            else:
+                import pandas as pd
+                df = pd.DataFrame(columns=['match_name', 'f_match_query'])
+            write_ko_profiles(df, output_filename)
+    write_run_metrics(args, run_metrics)
 
 
 if __name__ == '__main__':
@@ -16,23 +16,76 @@ This script does the following:
     e. output file name
     f. threshold_bp
 
-All instances of funcprofiler.py are run in parallel.
+The samples are run in parallel by a bounded pool of workers: at most --jobs at a time, and
+with --mem_per_job, no more than fit in the available memory. The samples with the largest
+input files are started first, so that a long job does not start last and delay the end
+of the run. A sample that fails is reported and does not stop the others; the exit code is
+1 if any sample failed.
+
+With --in_process, the samples are profiled in this process against one loaded KO sketch or
+index, and the sketching of the next samples, the matching, and the writing of the outputs
+overlap (see pipeline.py).
+
+With --server, the samples are sent as jobs to a running funcprofiler-server instead,
+which has the KO sketch loaded in memory already.
+
+With --metrics, every funcprofiler records the time, memory and IO of its stages, and the records
+of all the samples are written to one file, with a summary of every stage over the samples.
+
+With --matrix, the samples are all profiled in this process against one loaded KO sketch or
+index, and written as a single sparse KO x sample abundance matrix (see cohort.py) instead of
+one CSV per sample. The second column of the file list then gives the sample ids, and may be
+left out to use the names of the metagenome files.
+
+Every sample that is profiled is recorded in a run manifest (see checkpoint.py), and with
+--resume, the samples whose output is intact and was computed from the same input and
+parameters are skipped, so that a run that was killed continues where it stopped.
+
+With --backend, the file list is split into --shards shards that run as the tasks of an array
+job, on a SLURM cluster or one after the other on this machine (see cluster.py), and the
+results of the shards are merged once they are all done.
 """
 
 import os
 import sys
+import time
 import subprocess
 import argparse
-from multiprocessing import Process
-import pandas as pd
+import csv
+import shlex
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from fmhfunprofiler import checkpoint, cluster, metrics, pipeline, reads
+from fmhfunprofiler.funcprofiler import sanity_check, write_ko_profiles
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Run funcprofiler.py on multiple metagenomes in parallel.')
     parser.add_argument('ko_sketch', type=str, help='KO sketch file name')
     parser.add_argument('ksize', type=int, help='ksize (protein)')
     parser.add_argument('scaled', type=int, help='scaled parameter')
-    parser.add_argument('filelist', type=str, help='Text file containing metagenome file names and output file names')
+    parser.add_argument('filelist', type=str, help='Text file containing metagenome file names and output file names. The read files of a sample of several files (e.g. paired-end reads) are given in the first column, separated by ;')
     parser.add_argument('threshold_bp', type=int, help='threshold_bp')
+    parser.add_argument('-s', '--server', type=str, help='Unix socket of a running funcprofiler-server to send the samples to, instead of starting one funcprofiler per sample')
+    parser.add_argument('--index', action='store_true', help='ko_sketch is an inverted KO index built with funcprofiler-index')
+    parser.add_argument('--in_process', action='store_true', help='Profile all the samples in this process against one loaded KO sketch or index, with the sketching of the next samples overlapping the matching and the writing of the outputs of the previous ones')
+    parser.add_argument('--cache_dir', type=str, help='Reuse and store the metagenome sketches in this sketch cache directory (see funcprofiler --cache_dir)')
+    parser.add_argument('--ko_subset', type=str, help='File of the KO ids of interest, one per line: every sample is only matched against these KOs, through a reduced index of ko_sketch built once (or reused from --subset_dir) before the samples are profiled. Implies --index for the samples')
+    parser.add_argument('--subset_dir', type=str, help='Directory of the cached reduced indexes of --ko_subset (see funcprofiler --subset_dir)')
+    parser.add_argument('--scratch_dir', type=str, help='Directory of the scratch directories of every funcprofiler, which hold the intermediate sketch and prefetch table of a sample until it is profiled (see funcprofiler --scratch_dir). Default: $TMPDIR')
+    parser.add_argument('--pipe', action='store_true', help='Pipe the sketch of every sample into sourmash prefetch, so that no intermediate file is written (see funcprofiler --pipe)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Maximum number of samples profiled at the same time (default: number of CPUs)')
+    parser.add_argument('--mem_per_job', type=float, help='Memory budget of one sample, in GB. No more samples than fit in the available memory are profiled at the same time')
+    parser.add_argument('--matrix', type=str, nargs='+', help='Profile all the samples in this process, and write a single KO x sample abundance matrix to these files instead of one CSV per sample: .npz (scipy.sparse) and/or .biom (BIOM/HDF5, needs biom-format)')
+    parser.add_argument('--metrics', type=str, help='Write the per-stage time, memory and IO metrics of every sample, and their summary over all the samples, to this file')
+    parser.add_argument('--metrics_format', type=str, choices=metrics.METRICS_FORMATS, default='jsonl', help='Format of the --metrics file: JSON lines with the records of every sample and the summaries (default), or Prometheus text with the summaries')
+    parser.add_argument('--resume', action='store_true', help='Skip the samples that the run manifest records as profiled, from the same input content and with the same parameters, into an output that is still intact')
+    parser.add_argument('--manifest', type=str, help='Run manifest recording the samples that have been profiled (default: <filelist>.manifest.jsonl)')
+    parser.add_argument('--backend', type=str, choices=cluster.BACKENDS, help='Split the file list into --shards shards, run as the tasks of an array job: submitted to SLURM with sbatch, or run one after the other on this machine (local). Run the same command again to merge the results, or to run the shards that are not done')
+    parser.add_argument('--shards', type=int, default=1, help='Number of shards with --backend (default 1). Every shard profiles its samples with --jobs parallel jobs')
+    parser.add_argument('--workdir', type=str, help='Work directory of the shards, their markers and logs with --backend (default: <filelist>.shards)')
+    parser.add_argument('--skip_checks', action='store_true', help='Do not check that sourmash, pandas and numpy are installed. They are otherwise checked once here, instead of by every funcprofiler')
+    parser.add_argument('--sbatch_options', type=str, help='Options added to the array-job script as #SBATCH lines, e.g. "--time=4:00:00 --mem=16G"')
     return parser.parse_args()
 
 def check_args(args):
@@ -56,39 +109,461 @@ def check_args(args):
         print(f'Error: threshold_bp {args.threshold_bp} is not valid. Exiting...')
         sys.exit(1)
 
+    # check if the number of jobs is valid
+    if args.jobs < 1:
+        print(f'Error: number of jobs {args.jobs} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the memory budget is valid
+    if args.mem_per_job is not None and args.mem_per_job <= 0:
+        print(f'Error: memory per job {args.mem_per_job} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check the matrix outputs
+    for matrix_filename in args.matrix or []:
+        from fmhfunprofiler import cohort
+        if cohort.matrix_format(matrix_filename) is None:
+            print(f'Error: matrix output {matrix_filename} must end in .npz or .biom. Exiting...')
+            sys.exit(1)
+        if cohort.matrix_format(matrix_filename) == '.biom':
+            try:
+                import biom
+            except ImportError:
+                print('Error: biom-format is not installed. Please install biom-format to write .biom matrices.')
+                sys.exit(1)
+    if args.in_process and args.server is not None:
+        print('Error: --in_process cannot be used with --server. Exiting...')
+        sys.exit(1)
+    if args.matrix and args.server is not None:
+        print('Error: --matrix profiles the samples in this process, and cannot be used with --server. Exiting...')
+        sys.exit(1)
+
+    # the samples are only run with the sourmash command line tool by funcprofiler
+    if args.pipe and (args.in_process or args.matrix or args.index or args.ko_subset is not None or args.server is not None):
+        print('Error: --pipe runs the sourmash command line tool, and cannot be used with --in_process, --matrix, --index, --ko_subset or --server. Exiting...')
+        sys.exit(1)
+    if args.scratch_dir is not None and (args.in_process or args.matrix or args.index or args.ko_subset is not None or args.server is not None):
+        print('Error: --scratch_dir holds the intermediate files of the sourmash command line tool, and cannot be used with --in_process, --matrix, --index, --ko_subset or --server. Exiting...')
+        sys.exit(1)
+    if args.pipe and args.cache_dir is not None:
+        print('Error: --pipe cannot be used with the sketch cache. Exiting...')
+        sys.exit(1)
+
+    # check the KO subset, that the server cannot apply to the KOs it has loaded
+    if args.ko_subset is not None:
+        if args.server is not None:
+            print('Error: --ko_subset cannot be used with --server. Exiting...')
+            sys.exit(1)
+        from fmhfunprofiler import ko_index
+        ko_index.check_ko_subset(args.ko_subset)
+
+    # the manifest records the per-sample outputs
+    if args.resume and args.matrix:
+        print('Error: --resume skips the samples whose output is current, and cannot be used with --matrix. Exiting...')
+        sys.exit(1)
+
+    # check the array-job options
+    if args.shards < 1:
+        print(f'Error: number of shards {args.shards} is not valid. Exiting...')
+        sys.exit(1)
+    if args.backend is not None and args.server is not None:
+        print('Error: --backend cannot be used with --server. Exiting...')
+        sys.exit(1)
+
+    # the server does not report metrics
+    if args.metrics is not None and args.server is not None:
+        print('Error: --metrics cannot be used with --server. Exiting...')
+        sys.exit(1)
+
     return True
 
 
-def run_funcprofiler(metagenome_filename, output_filename, ko_sketch_filename, ksize, scaled, threshold_bp):
+"""
+Profile one sample. Returns True if the sample was profiled, False if it failed.
+"""
+def run_funcprofiler(metagenome_filename, output_filename, ko_sketch_filename, ksize, scaled, threshold_bp, server_socket=None, use_index=False, extra_args=(), metrics_filename=None):
+    if server_socket is not None:
+        from fmhfunprofiler import server
+        # the server has the KO sketch loaded already, only send the sample. It may run in another directory.
+        job = {'mg_filename': reads.join_read_files([os.path.abspath(filename) for filename in reads.read_files(metagenome_filename)]), 'output': os.path.abspath(output_filename), 'threshold_bp': threshold_bp}
+        try:
+            reply = server.submit_job(server_socket, job)
+        except OSError as e:
+            reply = {'status': 'error', 'error': str(e)}
+        if reply['status'] != 'ok':
+            print(f'Error: funcprofiler-server failed on {metagenome_filename}: {reply["error"]}')
+            return False
+        return True
+
     # run funcprofiler.py. Command: python funcprofiler.py <metagenome_filename> <ko_sketch_filename> <ksize> <scaled> <output_filename> -t <threshold_bp>
+    cmd = [sys.executable, '-m', 'fmhfunprofiler.funcprofiler', metagenome_filename, ko_sketch_filename, str(ksize), str(scaled), output_filename, '-t', str(threshold_bp)]
+    if use_index:
+        cmd.append('--index')
+    # the environment has been checked once for all the samples, see main
+    cmd.append('--skip_checks')
+    cmd.extend(extra_args)
+    if metrics_filename is not None:
+        cmd += ['--metrics', metrics_filename]
 
-    # find the directory that this (currently running) script is in
-    script_dir = os.path.dirname(os.path.realpath(__file__))
+    # the output of a sample is only shown if it fails, so that it does not drown the progress report
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if res.returncode != 0:
+        print(f'Error: funcprofiler.py failed on {metagenome_filename} with error code {res.returncode}. Its last output lines:')
+        for line in res.stdout.splitlines()[-10:]:
+            print(f'    {line}')
+        return False
+    return True
+
+
+"""
+Read the file list. Returns a list of (metagenome_filename, output_filename) pairs. The output
+filename (or the sample id, with --matrix) is None when the second column is missing. The read
+files of a sample of several files are all given in the first column, separated by ; (or by
+commas, inside a quoted field), and joined into one metagenome_filename (see reads.py). A line
+with more than two columns is an error, since it cannot be told whether its last column is an
+output or a read file.
+"""
+def read_filelist(filelist_filename):
+    samples = []
+    with open(filelist_filename, newline='') as fp:
+        reader = csv.reader(fp)
+        for row in reader:
+            row = [value.strip() for value in row]
+            if not any(row):
+                continue
+            if len(row) > 2:
+                print(f'Error: line {reader.line_num} of {filelist_filename} has {len(row)} columns. Give the read files of a sample '
+                      f'in the first column, separated by {reads.FILELIST_READ_FILES_SEPARATOR}, e.g. sample_R1.fastq.gz;sample_R2.fastq.gz. Exiting...')
+                sys.exit(1)
+            samples.append((reads.filelist_read_files(row[0]), row[1] or None if len(row) > 1 else None))
+    return samples
 
+
+"""
+Order the samples by the size of their input file, largest first. Missing files go last.
+"""
+def order_by_input_size(samples):
+    def input_size(sample):
+        if reads.missing_read_files(sample[0]):
+            return -1
+        return reads.input_size(sample[0])
+    return sorted(samples, key=input_size, reverse=True)
+
+
+"""
+Memory available for new processes, in bytes.
+"""
+def available_memory():
     try:
-        subprocess.run([sys.executable, '-m', 'fmhfunprofiler.funcprofiler', metagenome_filename, ko_sketch_filename, str(ksize), str(scaled), output_filename, '-t', str(threshold_bp)], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f'Error: funcprofiler.py failed with error code {e.returncode}. Exiting...')
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+"""
+Number of samples to profile at the same time: at most jobs, and, when every job needs
+mem_per_job GB, no more than fit in the available memory. At least one sample is always run.
+"""
+def max_concurrent_jobs(jobs, mem_per_job=None, memory=None):
+    if mem_per_job is None:
+        return max(1, jobs)
+    if memory is None:
+        memory = available_memory()
+    return max(1, min(jobs, int(memory // (mem_per_job * 1024**3))))
+
+
+"""
+Profile all the samples with a pool of n_workers workers, reporting progress as samples finish.
+With metrics_dir, the metrics of sample i are written to metrics_dir/i.jsonl. With manifest, every
+sample profiled is recorded in it with params. Returns the list of samples that failed.
+"""
+def run_all(samples, n_workers, ko_sketch_filename, ksize, scaled, threshold_bp, server_socket=None, use_index=False, extra_args=(), metrics_dir=None,
+            manifest=None, params=None):
+    failed = []
+    start_time = time.time()
+
+    # the manifest entry hashes the input and the output, so it is made by the worker of the
+    # sample, in parallel with the other samples, and only appended below
+    def profile(mg_filename, output_filename, metrics_filename):
+        ok = run_funcprofiler(mg_filename, output_filename, ko_sketch_filename, ksize, scaled, threshold_bp,
+                              server_socket, use_index, extra_args, metrics_filename)
+        if ok and manifest is not None and os.path.exists(output_filename):
+            return ok, manifest.make_entry(mg_filename, output_filename, params)
+        return ok, None
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        # each worker only waits for its funcprofiler process or server, so threads are enough
+        futures = {pool.submit(profile, mg_filename, output_filename,
+                               os.path.join(metrics_dir, f'{i}.jsonl') if metrics_dir is not None else None): (mg_filename, output_filename)
+                   for i, (mg_filename, output_filename) in enumerate(samples)}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            mg_filename, output_filename = futures[future]
+            try:
+                ok, entry = future.result()
+            except Exception as e:
+                print(f'Error: profiling {mg_filename} failed: {e}')
+                ok, entry = False, None
+            if ok and not os.path.exists(output_filename):
+                print(f'Error: profiling {mg_filename} did not write {output_filename}')
+                ok = False
+            if not ok:
+                failed.append((mg_filename, output_filename))
+            elif entry is not None:
+                manifest.append(entry)
+            status = 'done' if ok else 'FAILED'
+            print(f'[{n_done}/{len(samples)}] {mg_filename} -> {output_filename}: {status} ({time.time() - start_time:.1f}s elapsed)')
+    return failed
+
+
+"""
+Profile all the samples against one loaded KO database, and write the KO x sample matrix, with
+the samples in the order of the file list. Returns the list of samples that failed.
+"""
+def run_matrix(samples, n_workers, args, run_metrics):
+    from fmhfunprofiler import cohort, server
+    # the sample ids are the second column of the file list, or the names of the metagenome files
+    samples = [(mg_filename, sample_id if sample_id is not None else os.path.basename(reads.read_files(mg_filename)[0]))
+               for mg_filename, sample_id in samples]
+    if len(set(sample_id for _, sample_id in samples)) < len(samples):
+        print(f'Error: the sample ids in {args.filelist} are not unique. Exiting...')
+        sys.exit(1)
+    with run_metrics.stage('load_database') as record:
+        print(f'Loading KO sketches from {args.ko_sketch}...')
+        ko_database = server.KODatabase(args.ko_sketch, args.ksize, args.scaled, args.threshold_bp, use_index=args.index)
+        record['read_bytes'] = os.path.getsize(args.ko_sketch)
+    with run_metrics.stage('profile') as record:
+        print(f'Profiling {len(samples)} samples against {ko_database.n_kos} KOs with {n_workers} sketching processes...')
+        ko_ids, sample_ids, matrix, failed = cohort.profile_cohort(samples, ko_database, args.threshold_bp, n_workers, args.cache_dir,
+                                                                   submit_order=order_by_input_size(samples))
+        record['read_bytes'] = sum(reads.input_size(mg_filename) for mg_filename, _ in samples)
+    with run_metrics.stage('write_matrix'):
+        for matrix_filename in args.matrix:
+            cohort.save_matrix(matrix_filename, ko_ids, sample_ids, matrix)
+            print(f'KO x sample matrix ({len(ko_ids)} KOs, {len(sample_ids)} samples) has been written to {matrix_filename}')
+    return failed
+
+
+"""
+Profile all the samples against one loaded KO database, with the sketching, matching and output
+writing of the samples pipelined (see pipeline.py), and write one KO profile per sample. With
+manifest, every sample profiled is recorded in it with params. Returns the list of samples that
+failed.
+"""
+def run_in_process(samples, n_workers, args, run_metrics, manifest=None, params=None):
+    from fmhfunprofiler import cohort, server
+    with run_metrics.stage('load_database') as record:
+        print(f'Loading KO sketches from {args.ko_sketch}...')
+        ko_database = server.KODatabase(args.ko_sketch, args.ksize, args.scaled, args.threshold_bp, use_index=args.index)
+        record['read_bytes'] = os.path.getsize(args.ko_sketch)
+
+    # with a manifest, the sketch workers also take the state of the inputs, which may hash them,
+    # so that the writer thread only hashes the outputs
+    def match(sample, result):
+        query_minhash, state = result if manifest is not None else (result, None)
+        return ko_database.prefetch(query_minhash, args.threshold_bp, query_name=sample[0]), state
+
+    def write(sample, result):
+        mg_filename, output_filename = sample
+        df, state = result
+        write_ko_profiles(df, output_filename)
+        if manifest is not None:
+            manifest.append(manifest.make_entry(mg_filename, output_filename, params, state))
+        return f'{len(df)} KOs'
+
+    with run_metrics.stage('profile') as record:
+        print(f'Profiling {len(samples)} samples against {ko_database.n_kos} KOs with {n_workers} sketching processes...')
+        if manifest is None:
+            sketch_function = partial(cohort.sketch_sample, ksize=args.ksize, scaled=args.scaled, cache_dir=args.cache_dir)
+            failed = pipeline.run_pipeline(samples, sketch_function, match, write, n_workers)
+        else:
+            sketch_function = partial(cohort.sketch_sample_with_state, ksize=args.ksize, scaled=args.scaled, cache_dir=args.cache_dir)
+            previous_entries = {mg_filename: manifest.entries[(mg_filename, output_filename)] for mg_filename, output_filename in samples
+                                if (mg_filename, output_filename) in manifest.entries}
+            failed = pipeline.run_pipeline(samples, sketch_function, match, write, n_workers,
+                                           initializer=cohort.init_manifest_worker, initargs=(previous_entries,))
+        record['read_bytes'] = sum(reads.input_size(mg_filename) for mg_filename, _ in samples)
+    return failed
+
+
+"""
+Write the stage records of all the samples and their summary per stage. The Prometheus format
+only holds the summaries, to keep one series per stage.
+"""
+def write_metrics_summary(filename, records, metrics_format='jsonl'):
+    summaries = metrics.aggregate(records)
+    if metrics_format == 'prometheus':
+        metrics.write_metrics(filename, summaries, metrics_format)
+    else:
+        metrics.write_metrics(filename, records + summaries, metrics_format)
+    for summary in summaries:
+        print(f'{summary["stage"]}: {summary["samples"]} samples, {summary["wall_seconds_sum"]:.1f}s wall, '
+              f'{summary["cpu_seconds_sum"]:.1f}s CPU, max RSS {summary["peak_rss_bytes_max"] / 1024**2:.0f} MB')
+    print(f'Stage metrics have been written to {filename}')
+
+
+"""
+Profile every sample with its own funcprofiler process (or server job), and collect their
+metrics. Returns the list of samples that failed.
+"""
+def run_subprocesses(samples, n_workers, args, extra_args, manifest=None, params=None):
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        failed = run_all(samples, n_workers, args.ko_sketch, args.ksize, args.scaled, args.threshold_bp, args.server, args.index, extra_args,
+                         metrics_dir=metrics_dir if args.metrics is not None else None, manifest=manifest, params=params)
+        if args.metrics is not None:
+            records = []
+            for i in range(len(samples)):
+                if os.path.exists(os.path.join(metrics_dir, f'{i}.jsonl')):
+                    records += metrics.read_metrics(os.path.join(metrics_dir, f'{i}.jsonl'))
+            write_metrics_summary(args.metrics, records, args.metrics_format)
+    return failed
+
+
+"""
+The parameters of a run that the outputs depend on, as recorded in the run manifest.
+"""
+def run_params(args, extra_args=()):
+    st = os.stat(args.ko_sketch)
+    return {'ko_sketch': os.path.abspath(args.ko_sketch), 'ko_sketch_size': st.st_size, 'ko_sketch_mtime_ns': st.st_mtime_ns,
+            'ksize': args.ksize, 'scaled': args.scaled, 'threshold_bp': args.threshold_bp, 'index': bool(args.index),
+            'server': args.server is not None, 'in_process': bool(args.in_process), 'extra_args': list(extra_args)}
+
+
+"""
+Profile the samples as an array job over shards of the file list (see cluster.py), and merge
+the matrices and metrics of the shards once they are all done. Exits with code 1 if a shard
+failed.
+"""
+def run_array(args):
+    from fmhfunprofiler import cohort
+    samples = read_filelist(args.filelist)
+    if not args.matrix and any(output_filename is None for _, output_filename in samples):
+        print(f'Error: every line of {args.filelist} needs an output file name. Exiting...')
         sys.exit(1)
-    return None
+    sample_order = [sample_id if sample_id is not None else os.path.basename(reads.read_files(mg_filename)[0]) for mg_filename, sample_id in samples]
+    if args.matrix and len(set(sample_order)) < len(sample_order):
+        print(f'Error: the sample ids in {args.filelist} are not unique. Exiting...')
+        sys.exit(1)
+
+    workdir = args.workdir if args.workdir is not None else f'{args.filelist}.shards'
+    shards = cluster.prepare_shards(workdir, samples, args.shards)
+    pending = cluster.pending_shards(workdir, len(shards))
+    if pending:
+        # options passed on to the funcprofiler-many of every shard
+        shard_args = [os.path.abspath(args.ko_sketch), str(args.ksize), str(args.scaled), str(args.threshold_bp), '-j', str(args.jobs)]
+        if args.index:
+            shard_args += ['--index']
+        if args.cache_dir is not None:
+            shard_args += ['--cache_dir', os.path.abspath(args.cache_dir)]
+        if args.mem_per_job is not None:
+            shard_args += ['--mem_per_job', str(args.mem_per_job)]
+        if args.resume:
+            shard_args += ['--resume']
+        if args.in_process:
+            shard_args += ['--in_process']
+        if args.scratch_dir is not None:
+            shard_args += ['--scratch_dir', args.scratch_dir]
+        if args.pipe:
+            shard_args += ['--pipe']
+        script = cluster.array_script(workdir, shard_args, matrix=bool(args.matrix), with_metrics=args.metrics is not None,
+                                      sbatch_options=shlex.split(args.sbatch_options or ''))
+        script_filename = cluster.write_script(workdir, script)
+        print(f'{len(pending)} of {len(shards)} shards to run, with the array-job script {script_filename}')
+        if args.backend == 'slurm':
+            print(cluster.submit_slurm(script_filename, pending))
+            print('Run the same command again once the array job has finished, to merge the results of the shards')
+            return
+        failed = cluster.run_local(workdir, script_filename, pending)
+        if failed:
+            print(f'{len(failed)} of {len(shards)} shards failed, see their logs in {os.path.join(workdir, "logs")}. '
+                  'Run the same command again to run them again')
+            sys.exit(1)
+
+    print(f'All the {len(shards)} shards are done')
+    if args.matrix:
+        ko_ids, sample_ids, matrix = cluster.merge_shard_matrices(workdir, len(shards), sample_order)
+        for matrix_filename in args.matrix:
+            cohort.save_matrix(matrix_filename, ko_ids, sample_ids, matrix)
+            print(f'KO x sample matrix ({len(ko_ids)} KOs, {len(sample_ids)} samples) has been written to {matrix_filename}')
+    if args.metrics is not None:
+        write_metrics_summary(args.metrics, cluster.merge_shard_metrics(workdir, len(shards)), args.metrics_format)
+
 
 def main():
     args = parse_arguments()
     if check_args(args):
-        # read the filelist
-        filelist = pd.read_csv(args.filelist, sep=',', header=None, names=['metagenome_filename', 'output_filename'])
+        # the samples are matched against the reduced index of the KO subset instead of ko_sketch
+        if args.ko_subset is not None:
+            from fmhfunprofiler import ko_index
+            args.ko_sketch = ko_index.cached_subset_index(args.ko_sketch, args.ksize, args.scaled, ko_index.read_ko_list(args.ko_subset),
+                                                          args.index, args.subset_dir)
+            args.index = True
+
+        # the samples are profiled in this process, or by funcprofiler with the in-process engine (--index),
+        # or with the sourmash command line tool
+        if not args.skip_checks:
+            sanity_check(require_cli=not (args.in_process or args.matrix or args.index or args.server is not None))
+        n_workers = max_concurrent_jobs(args.jobs, args.mem_per_job)
+
+        if args.backend is not None:
+            run_array(args)
+            return
+
+        if args.matrix:
+            samples = read_filelist(args.filelist)
+            run_metrics = metrics.Metrics()
+            failed = run_matrix(samples, n_workers, args, run_metrics)
+            if args.metrics is not None:
+                write_metrics_summary(args.metrics, run_metrics.records, args.metrics_format)
+            print(f'{len(samples) - len(failed)} of {len(samples)} samples have been profiled')
+            if failed:
+                print(f'{len(failed)} samples failed:')
+                for mg_filename, _ in failed:
+                    print(f'    {mg_filename}')
+                sys.exit(1)
+            return
 
-        # run funcprofiler.py on each pair of metagenome_filename and output_filename
-        process_lit = []
-        for index, row in filelist.iterrows():
-            p = Process(target=run_funcprofiler, args=(str(row['metagenome_filename']), str(row['output_filename']), args.ko_sketch, args.ksize, args.scaled, args.threshold_bp))
-            process_lit.append(p)
+        # read the filelist, largest inputs first
+        samples = order_by_input_size(read_filelist(args.filelist))
+        if any(output_filename is None for _, output_filename in samples):
+            print(f'Error: every line of {args.filelist} needs an output file name. Exiting...')
+            sys.exit(1)
+        # options passed on to every funcprofiler
+        extra_args = []
 
-        for p in process_lit:
-            p.start()
+        manifest = checkpoint.Manifest(args.manifest if args.manifest is not None else f'{args.filelist}.manifest.jsonl')
+        params = run_params(args, extra_args)
+        # where the sketches are cached and the intermediates go does not change the outputs, so it
+        # is not part of the parameters
+        if args.cache_dir is not None:
+            extra_args += ['--cache_dir', args.cache_dir]
+        if args.scratch_dir is not None:
+            extra_args += ['--scratch_dir', args.scratch_dir]
+        if args.pipe:
+            extra_args += ['--pipe']
+        n_samples = len(samples)
+        if args.resume:
+            samples = [(mg_filename, output_filename) for mg_filename, output_filename in samples
+                       if not manifest.is_current(mg_filename, output_filename, params)]
+            print(f'Resuming: {n_samples - len(samples)} of {n_samples} samples are up to date in {manifest.filename}')
+        if args.in_process:
+            run_metrics = metrics.Metrics()
+            failed = run_in_process(samples, n_workers, args, run_metrics, manifest, params)
+            if args.metrics is not None:
+                write_metrics_summary(args.metrics, run_metrics.records, args.metrics_format)
+        else:
+            print(f'Profiling {len(samples)} samples with {n_workers} parallel jobs...')
+            failed = run_subprocesses(samples, n_workers, args, extra_args, manifest, params)
 
-        for p in process_lit:
-            p.join()
+        print(f'{len(samples) - len(failed)} of {len(samples)} samples have been profiled')
+        if failed:
+            print(f'{len(failed)} samples failed:')
+            for mg_filename, output_filename in failed:
+                print(f'    {mg_filename} -> {output_filename}')
+            sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,257 @@
+"""
+Incremental re-profiling after an update of the KO reference. Instead of sketching every
+historical sample again and running prefetch against the whole new reference, the old and new
+references are compared KO by KO, and only the KOs that were added or whose hashes changed are
+matched against the samples. The containment of a sample in a KO only depends on the two
+sketches, so the rows of the unchanged KOs of the stored prefetch tables stay valid:
+
+    the rows of the removed and changed KOs are dropped from the stored prefetch table,
+    the sample sketch (from the sketch cache, or computed and cached on a miss) is matched
+    against an index of the added and changed KOs only,
+    the new rows are appended, and the KO profile is written again from the patched table.
+
+The prefetch tables must have been computed with the same ksize, scaled and threshold_bp. A
+sample whose prefetch table is missing is profiled against the whole new reference. Tables with
+reassigned columns (funcprofiler --reassign) cannot be patched, since the share of every KO
+depends on all the others, and are reported as failed.
+
+The funcprofiler-update command updates all the samples of a file list.
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from fmhfunprofiler import checkpoint, engine, ko_index, reads, reassign, sketch_cache
+from fmhfunprofiler.funcprofiler import write_ko_profiles
+
+
+KO_STATUSES = ['added', 'removed', 'changed']
+
+
+"""
+Load the KO names of a reference and the hashes of every KO, from a KO sketch or, with
+use_index, from a KO index.
+"""
+def reference_hashes(ko_reference, ksize, scaled, use_index=False):
+    if use_index:
+        index = ko_index.load_checked_index(ko_reference, ksize, scaled)
+        return [str(name) for name in index.ko_names], index.ko_hashes()
+    ko_sigs = engine.load_ko_sketches(ko_reference, ksize, scaled)
+    return [sig.name for sig in ko_sigs], [engine.minhash_to_arrays(sig.minhash)[0] for sig in ko_sigs]
+
+
+def _hashes_digest(hashes):
+    return hashlib.blake2b(hashes.astype('<u8').tobytes(), digest_size=20).hexdigest()
+
+
+"""
+Compare two references, given as the KO names and the hashes of every KO. Returns a dictionary
+status -> sorted list of KO names, for the KOs added, removed, and changed (present in both
+with different hashes).
+"""
+def diff_references(old_names, old_hashes, new_names, new_hashes):
+    old_digests = {name: _hashes_digest(hashes) for name, hashes in zip(old_names, old_hashes)}
+    new_digests = {name: _hashes_digest(hashes) for name, hashes in zip(new_names, new_hashes)}
+    return {
+        'added': sorted(set(new_digests) - set(old_digests)),
+        'removed': sorted(set(old_digests) - set(new_digests)),
+        'changed': sorted(name for name in set(old_digests) & set(new_digests) if old_digests[name] != new_digests[name]),
+    }
+
+
+"""
+Patch a stored prefetch table: drop the rows of the KOs in drop_names, and append the rows of
+the KOs of update_index that the sample matches. The table keeps its abundance-weighted columns,
+if it has them. Columns that only the sourmash command line tool writes are left empty in the
+new rows.
+"""
+def patch_prefetch_table(df, query_minhash, update_index, drop_names, threshold_bp, query_name=''):
+    weighted = all(column in df.columns for column in engine.WEIGHTED_COLUMNS)
+    kept = df[~df['match_name'].isin(set(drop_names))]
+    new_rows = update_index.prefetch(query_minhash, threshold_bp, query_name=query_name, weighted=weighted)
+    if len(kept) == 0:
+        return new_rows
+    if len(new_rows) == 0:
+        return kept.reset_index(drop=True)
+    return pd.concat([kept, new_rows], ignore_index=True)
+
+
+"""
+Update the prefetch table and the KO profile of one sample. When the prefetch table does not
+exist, the sample is matched against full_index instead. Returns a short description of what
+was done.
+"""
+def update_sample(mg_filename, output_filename, prefetch_filename, update_index, drop_names, threshold_bp,
+                  ksize, scaled, cache_dir=None, full_index=None):
+    if os.path.exists(prefetch_filename):
+        # sourmash prefetch writes an empty file when the sample matches no KO
+        if os.path.getsize(prefetch_filename) > 0:
+            df = pd.read_csv(prefetch_filename)
+        else:
+            df = pd.DataFrame(columns=engine.PREFETCH_COLUMNS)
+        if any(column in df.columns for column in reassign.REASSIGNED_COLUMNS):
+            raise ValueError(f'{prefetch_filename} has reassigned columns, and cannot be patched')
+        index, action = update_index, 'patched'
+    else:
+        df = pd.DataFrame(columns=engine.PREFETCH_COLUMNS)
+        index, action = full_index, 'profiled against the whole new reference'
+
+    cache = sketch_cache.SketchCache(cache_dir)
+    query_minhash = sketch_cache.cached_sketch(cache, mg_filename, ksize, scaled, engine.sketch_metagenome)
+    df = patch_prefetch_table(df, query_minhash, index, drop_names, threshold_bp, query_name=mg_filename)
+    checkpoint.atomic_write(prefetch_filename, lambda tmp_filename: df.to_csv(tmp_filename, index=False))
+    weighted = 'sum_abund' in df.columns
+    write_ko_profiles(df, output_filename, weight_column='sum_abund' if weighted else 'f_match_query')
+    return action
+
+
+# update_index, drop_names and full_index of the worker processes, set once per worker instead of
+# being sent with every sample
+_worker_update = None
+
+
+def _init_worker(update_index, drop_names, full_index):
+    global _worker_update
+    _worker_update = (update_index, drop_names, full_index)
+
+
+def _update_sample_in_worker(mg_filename, output_filename, prefetch_filename, threshold_bp, ksize, scaled, cache_dir=None):
+    update_index, drop_names, full_index = _worker_update
+    return update_sample(mg_filename, output_filename, prefetch_filename, update_index, drop_names, threshold_bp,
+                         ksize, scaled, cache_dir, full_index)
+
+
+"""
+Read the file list: (metagenome_filename, output_filename, prefetch_filename) rows, with None
+for the missing columns. The read files of a sample of several files are given in the first
+column as in the file list of funcprofiler-many, separated by ; (or by commas, inside a quoted
+field). A line with more than three columns is an error.
+"""
+def read_filelist(filelist_filename):
+    samples = []
+    with open(filelist_filename, newline='') as fp:
+        reader = csv.reader(fp)
+        for row in reader:
+            row = [value.strip() for value in row]
+            if not any(row):
+                continue
+            if len(row) > 3:
+                print(f'Error: line {reader.line_num} of {filelist_filename} has {len(row)} columns. Give the read files of a sample '
+                      f'in the first column, separated by {reads.FILELIST_READ_FILES_SEPARATOR}, e.g. sample_R1.fastq.gz;sample_R2.fastq.gz. Exiting...')
+                sys.exit(1)
+            row += [''] * (3 - len(row))
+            samples.append((reads.filelist_read_files(row[0]), row[1] or None, row[2] or None))
+    return samples
+
+
+def write_diff(filename, diff):
+    rows = [(name, status) for status in KO_STATUSES for name in diff[status]]
+    pd.DataFrame(rows, columns=['ko_id', 'status']).to_csv(filename, index=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Update the KO profiles of already profiled samples after an update of the KO reference, by matching the samples only against the KOs that were added or changed.")
+    parser.add_argument("old_ko_sketch", type=str, help="KO sketch (or index) the samples were profiled with")
+    parser.add_argument("new_ko_sketch", type=str, help="Updated KO sketch (or index)")
+    parser.add_argument("ksize", type=int, help="Protein kmer size (7, 11, or 15) used to obtain the KO sketches")
+    parser.add_argument("scaled", type=int, help="The scaled parameter the samples were profiled with")
+    parser.add_argument("filelist", type=str, help="CSV file with no header and three columns: metagenome file, KO profile output, and prefetch table of every sample")
+    parser.add_argument("threshold_bp", type=int, help="The threshold_bp the samples were profiled with")
+    parser.add_argument("--index", action="store_true", help="Both KO references are inverted KO indexes built with funcprofiler-index")
+    parser.add_argument("--cache_dir", type=str, help="Sketch cache holding the sketches of the samples (see funcprofiler --cache_dir). Samples missing from it are sketched and cached")
+    parser.add_argument("--diff", type=str, help="Write the added, removed and changed KOs to this CSV file")
+    parser.add_argument('-j', "--jobs", type=int, default=1, help="Number of samples updated at the same time (default 1)")
+    return parser.parse_args()
+
+
+def check_args(args):
+    # check if the KO sketch files exist
+    for ko_sketch in [args.old_ko_sketch, args.new_ko_sketch]:
+        if not os.path.exists(ko_sketch):
+            print(f'Error: KO sketch file {ko_sketch} does not exist. Exiting...')
+            sys.exit(1)
+
+    # check if the file list exists
+    if not os.path.exists(args.filelist):
+        print(f'Error: file list {args.filelist} does not exist. Exiting...')
+        sys.exit(1)
+
+    # check if the protein kmer size is valid
+    if args.ksize not in [7, 11, 15]:
+        print(f'Error: Protein kmer size {args.ksize} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the scaled parameter is valid
+    if args.scaled < 1:
+        print(f'Error: Scaled parameter {args.scaled} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the threshold_bp is valid
+    if args.threshold_bp < 1:
+        print(f'Error: threshold_bp {args.threshold_bp} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the number of jobs is valid
+    if args.jobs < 1:
+        print(f'Error: number of jobs {args.jobs} is not valid. Exiting...')
+        sys.exit(1)
+
+    return True
+
+
+def main():
+    args = parse_args()
+    check_args(args)
+    samples = read_filelist(args.filelist)
+    if any(output_filename is None or prefetch_filename is None for _, output_filename, prefetch_filename in samples):
+        print(f'Error: every sample in {args.filelist} needs a metagenome file, an output and a prefetch table. Exiting...')
+        sys.exit(1)
+
+    print(f'Comparing {args.old_ko_sketch} and {args.new_ko_sketch}...')
+    old_names, old_hashes = reference_hashes(args.old_ko_sketch, args.ksize, args.scaled, args.index)
+    new_names, new_hashes = reference_hashes(args.new_ko_sketch, args.ksize, args.scaled, args.index)
+    diff = diff_references(old_names, old_hashes, new_names, new_hashes)
+    print(', '.join(f'{len(diff[status])} {status}' for status in KO_STATUSES) + f' out of {len(new_names)} KOs')
+    if args.diff is not None:
+        write_diff(args.diff, diff)
+
+    missing_tables = [sample for sample in samples if not os.path.exists(sample[2])]
+    if not any(diff.values()) and not missing_tables:
+        print('The KO references hold the same KOs. The profiles are up to date. Exiting...')
+        return
+
+    update_index = ko_index.subset_index(new_names, new_hashes, diff['added'] + diff['changed'], args.ksize, args.scaled)
+    drop_names = diff['removed'] + diff['changed']
+    full_index = ko_index.KOIndex.from_hashes(new_names, new_hashes, args.ksize, args.scaled) if missing_tables else None
+
+    failed = []
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker, initargs=(update_index, drop_names, full_index)) as pool:
+        futures = {pool.submit(_update_sample_in_worker, mg_filename, output_filename, prefetch_filename,
+                               args.threshold_bp, args.ksize, args.scaled, args.cache_dir): mg_filename
+                   for mg_filename, output_filename, prefetch_filename in samples}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            mg_filename = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print(f'Error: updating {mg_filename} failed: {e}')
+                failed.append(mg_filename)
+                status = 'FAILED'
+            print(f'[{n_done}/{len(samples)}] {mg_filename}: {status} ({time.time() - start_time:.1f}s elapsed)')
+
+    if failed:
+        print(f'{len(failed)} of {len(samples)} samples failed:')
+        for mg_filename in failed:
+            print(f'    {mg_filename}')
+        sys.exit(1)
+    print('Exiting...')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+"""
+Inverted hash -> KO index of a KO sketch. The hashes of all the KO sketches are stored as one
+sorted array of unique uint64 hashes, and the KOs that contain every hash are stored in CSR
+layout: the KOs of hashes[i] are ko_ids[indptr[i]:indptr[i+1]].
+
+Matching a metagenome sketch against the index is then a single np.searchsorted pass over the
+sample hashes, followed by np.bincount over the KO ids of the hashes found. The cost of a
+query grows with the size of the sample sketch, not with the number of KOs.
+
+The index is built with the funcprofiler-index command, and used by funcprofiler --index.
+
+Indexes are saved in a native format that can be memory-mapped, so that loading one does not
+decompress or deserialize anything, and the concurrent workers on a node share one page-cache
+copy of the arrays. A native index file is laid out as:
+
+    the magic bytes b'FMHIDX01'
+    the length of the header, as a little-endian uint64
+    the header, in JSON: ksize, scaled, the KO names, and the dtype, offset and length of every array
+    the flat arrays (hashes, indptr, ko_ids, ko_n_hashes), each aligned to ARRAY_ALIGNMENT bytes,
+    at offsets relative to the first aligned position after the header
+
+Indexes saved to a filename ending in .npz use the NumPy .npz format instead.
+
+A query that only needs a panel of KOs (e.g. a pathway, or resistance genes) can be matched
+against the reduced index of these KOs, whose load time and matching cost grow with the size of
+the panel. funcprofiler --ko_subset builds the reduced index of a KO list once, and caches it
+in a subset directory, under a name made of a hash of the sorted KO list, the ksize, the scaled
+and a hash of the path, size and modification time of the full reference, so that the same
+panel is never extracted twice from the same reference. funcprofiler-index --ko_subset writes
+the reduced index to a given file instead, or into the subset directory if no output is given.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import numpy as np
+from fmhfunprofiler import checkpoint, engine
+
+
+"""
+An inverted hash -> KO index, together with the parameters of the KO sketch it was built from.
+"""
+class KOIndex:
+    def __init__(self, hashes, indptr, ko_ids, ko_names, ko_n_hashes, ksize, scaled):
+        self.hashes = hashes
+        self.indptr = indptr
+        self.ko_ids = ko_ids
+        self.ko_names = ko_names
+        self.ko_n_hashes = ko_n_hashes
+        self.ksize = ksize
+        self.scaled = scaled
+
+    @property
+    def n_kos(self):
+        return len(self.ko_names)
+
+    """
+    Build the index from a list of KO names and, for every KO, the array of its hashes.
+    """
+    @classmethod
+    def from_hashes(cls, ko_names, ko_hashes, ksize, scaled):
+        ko_n_hashes = np.array([len(h) for h in ko_hashes], dtype=np.int64)
+        all_hashes = np.concatenate(ko_hashes) if ko_hashes else np.zeros(0, dtype=np.uint64)
+        all_ko_ids = np.repeat(np.arange(len(ko_hashes), dtype=np.int32), ko_n_hashes)
+
+        # sort by hash, then group equal hashes into CSR rows
+        order = np.argsort(all_hashes, kind='stable')
+        all_hashes = all_hashes[order].astype(np.uint64)
+        ko_ids = all_ko_ids[order]
+        hashes, row_starts = np.unique(all_hashes, return_index=True)
+        indptr = np.append(row_starts, len(all_hashes)).astype(np.int64)
+
+        return cls(hashes, indptr, ko_ids, np.array(ko_names, dtype=str), ko_n_hashes, ksize, scaled)
+
+    """
+    The hashes of every KO, as a list of sorted uint64 arrays in the order of ko_names: the
+    inverse of from_hashes.
+    """
+    def ko_hashes(self):
+        entry_hashes = np.repeat(self.hashes, np.diff(self.indptr))
+        order = np.argsort(self.ko_ids, kind='stable')
+        return np.split(entry_hashes[order], np.cumsum(self.ko_n_hashes)[:-1])
+
+    """
+    Find the sample hashes in the index. Returns the positions of the index rows of the sample
+    hashes that are present, and a boolean mask over sample_hashes telling which are present.
+    """
+    def lookup(self, sample_hashes):
+        sample_hashes = np.asarray(sample_hashes, dtype=np.uint64)
+        rows = np.searchsorted(self.hashes, sample_hashes)
+        found = rows < len(self.hashes)
+        found[found] = self.hashes[rows[found]] == sample_hashes[found]
+        return rows[found], found
+
+    """
+    KO ids of the given index rows, concatenated, with the position of the row each KO id
+    came from.
+    """
+    def expand_rows(self, rows):
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        row_of_entry = np.repeat(np.arange(len(rows)), lengths)
+        # offset of every entry inside its own row
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.ko_ids[starts[row_of_entry] + offsets], row_of_entry
+
+    """
+    Number of sample hashes found in every KO. Sample hashes above the max hash of the index
+    scaled are ignored, so a sample sketched with a smaller scaled is downsampled on the fly.
+    """
+    def count_shared_hashes(self, sample_hashes):
+        return self.count_shared_abundances(sample_hashes)[0]
+
+    """
+    Number of sample hashes found in every KO, and the sum of the abundances of these hashes in
+    the sample (sample_abunds, aligned with sample_hashes; all ones if not given).
+    """
+    def count_shared_abundances(self, sample_hashes, sample_abunds=None):
+        if sample_abunds is None:
+            sample_abunds = np.ones(len(sample_hashes), dtype=np.int64)
+        positions, ko_ids = self.shared_hash_pairs(sample_hashes)
+        n_common = np.bincount(ko_ids, minlength=self.n_kos)
+        sum_abund = np.bincount(ko_ids, weights=np.asarray(sample_abunds)[positions], minlength=self.n_kos)
+        return n_common, sum_abund.astype(np.int64)
+
+    """
+    The (sample hash, KO) pairs of the sample hashes found in the index: the positions in
+    sample_hashes, and the KO ids. Sample hashes above the max hash of the index scaled are
+    ignored.
+    """
+    def shared_hash_pairs(self, sample_hashes):
+        sample_hashes = np.asarray(sample_hashes, dtype=np.uint64)
+        kept = np.flatnonzero(sample_hashes <= np.uint64(engine.max_hash_for_scaled(self.scaled)))
+        rows, found = self.lookup(sample_hashes[kept])
+        ko_ids, row_of_entry = self.expand_rows(rows)
+        return kept[found][row_of_entry], ko_ids
+
+    """
+    Run the equivalent of `sourmash prefetch` of a metagenome sketch against the index.
+    Returns the prefetch table as a DataFrame.
+    """
+    def prefetch(self, query_minhash, threshold_bp, query_name='', weighted=False):
+        return self.prefetch_thresholds(query_minhash, [threshold_bp], query_name, weighted)[threshold_bp]
+
+    """
+    Like prefetch, for several values of threshold_bp from one set of shared hash counts.
+    Returns a dictionary threshold_bp -> prefetch table. With weighted, the tables have the
+    abundance-weighted columns (engine.WEIGHTED_COLUMNS).
+    """
+    def prefetch_thresholds(self, query_minhash, thresholds, query_name='', weighted=False):
+        sample_hashes, sample_abunds = engine.minhash_to_arrays(query_minhash, scaled=self.scaled)
+        n_common, sum_abund = self.count_shared_abundances(sample_hashes, sample_abunds)
+        return {threshold_bp: engine.build_prefetch_table(n_common, self.ko_names, self.ko_n_hashes, len(sample_hashes),
+                                                          self.ksize, self.scaled, threshold_bp, query_name=query_name,
+                                                          sum_abund=sum_abund if weighted else None)
+                for threshold_bp in thresholds}
+
+
+"""
+Build the inverted index of the KO signatures with the given ksize, downsampled to scaled.
+"""
+def build_index(ko_sketch, ksize, scaled):
+    ko_sigs = engine.load_ko_sketches(ko_sketch, ksize, scaled)
+    ko_names = [sig.name for sig in ko_sigs]
+    ko_hashes = [engine.minhash_to_arrays(sig.minhash)[0] for sig in ko_sigs]
+    return KOIndex.from_hashes(ko_names, ko_hashes, ksize, scaled)
+
+
+"""
+Load the KOs with the given ksize, downsampled to scaled: the list of KO signatures of a KO
+sketch or, with use_index, a KO index.
+"""
+def load_reference(ko_sketch, ksize, scaled, use_index=False):
+    if use_index:
+        return load_checked_index(ko_sketch, ksize, scaled)
+    return engine.load_ko_sketches(ko_sketch, ksize, scaled)
+
+
+"""
+The sorted array of all the distinct hashes of a reference loaded with load_reference.
+"""
+def reference_hash_set(reference):
+    if isinstance(reference, KOIndex):
+        return np.asarray(reference.hashes)
+    ko_hashes = [engine.minhash_to_arrays(sig.minhash)[0] for sig in reference]
+    return np.unique(np.concatenate(ko_hashes)) if ko_hashes else np.zeros(0, dtype=np.uint64)
+
+
+"""
+The sorted array of all the distinct hashes of the KOs with the given ksize, downsampled to
+scaled, from a KO sketch or, with use_index, from a KO index.
+"""
+def load_hash_set(ko_sketch, ksize, scaled, use_index=False):
+    return reference_hash_set(load_reference(ko_sketch, ksize, scaled, use_index))
+
+
+"""
+An index of the KOs of a reference with the given names.
+"""
+def subset_index(names, hashes, subset, ksize, scaled):
+    subset = set(subset)
+    kept = [i for i, name in enumerate(names) if name in subset]
+    return KOIndex.from_hashes([names[i] for i in kept], [hashes[i] for i in kept], ksize, scaled)
+
+
+SUBSET_DIR_ENV = 'FMHFUNPROFILER_SUBSET_DIR'
+
+
+"""
+The directory of the reduced indexes when none is given: $FMHFUNPROFILER_SUBSET_DIR if it is
+set, otherwise fmhfunprofiler/ko_subsets under $XDG_CACHE_HOME (default ~/.cache).
+"""
+def default_subset_dir():
+    if os.environ.get(SUBSET_DIR_ENV):
+        return os.environ[SUBSET_DIR_ENV]
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'fmhfunprofiler', 'ko_subsets')
+
+
+"""
+Read a list of KO ids: one per line, or the first column of a CSV file such as a KO profile
+(whose ko_id header is skipped). Blank lines and lines starting with # are ignored. Returns the
+sorted distinct KO ids.
+"""
+def read_ko_list(filename):
+    ko_ids = set()
+    with open(filename) as fp:
+        for line in fp:
+            ko_id = line.split(',')[0].strip()
+            if ko_id and not ko_id.startswith('#') and ko_id != 'ko_id':
+                ko_ids.add(ko_id)
+    return sorted(ko_ids)
+
+
+"""
+Hash of a list of KO ids, independent of their order and of duplicates.
+"""
+def ko_list_digest(ko_ids):
+    return hashlib.blake2b('\n'.join(sorted(set(ko_ids))).encode(), digest_size=20).hexdigest()
+
+
+"""
+Filename of the reduced index of the KO list in the subset directory. The name changes when the
+KO list, the ksize, the scaled, or the path, size or modification time of the reference change.
+"""
+def subset_index_filename(subset_dir, ko_sketch, ksize, scaled, ko_ids):
+    st = os.stat(ko_sketch)
+    reference = f'{os.path.abspath(ko_sketch)}\0{st.st_size}\0{st.st_mtime_ns}'
+    reference_digest = hashlib.blake2b(reference.encode(), digest_size=8).hexdigest()
+    return os.path.join(subset_dir, f'{ko_list_digest(ko_ids)}_k{ksize}_s{scaled}_{reference_digest}.idx')
+
+
+"""
+Build the index of the KOs of the list, from a KO sketch or, with use_index, from a KO index.
+"""
+def build_subset_index(ko_sketch, ksize, scaled, ko_ids, use_index=False):
+    if use_index:
+        index = load_checked_index(ko_sketch, ksize, scaled)
+        return subset_index([str(name) for name in index.ko_names], index.ko_hashes(), ko_ids, ksize, scaled)
+    ko_sigs = engine.load_ko_sketches(ko_sketch, ksize, scaled)
+    return subset_index([sig.name for sig in ko_sigs], [engine.minhash_to_arrays(sig.minhash)[0] for sig in ko_sigs],
+                        ko_ids, ksize, scaled)
+
+
+"""
+Build the reduced index of the KO list into filename, atomically. Returns the index.
+"""
+def write_subset_index(filename, ko_sketch, ksize, scaled, ko_ids, use_index=False):
+    print(f'Extracting {len(ko_ids)} KOs from {ko_sketch}...')
+    index = build_subset_index(ko_sketch, ksize, scaled, ko_ids, use_index)
+    n_missing = len(set(ko_ids) - set(str(name) for name in index.ko_names))
+    if n_missing > 0:
+        print(f'Warning: {n_missing} of the {len(ko_ids)} KOs of the list are not in {ko_sketch} (ksize={ksize})')
+    checkpoint.atomic_write(filename, lambda tmp_filename: save_index(index, tmp_filename))
+    return index
+
+
+"""
+The filename of the reduced index of the KO list, in the subset directory (default:
+default_subset_dir()). It is built from the reference (a KO sketch or, with use_index, a KO
+index) the first time, and reused afterwards.
+"""
+def cached_subset_index(ko_sketch, ksize, scaled, ko_ids, use_index=False, subset_dir=None):
+    subset_dir = subset_dir if subset_dir is not None else default_subset_dir()
+    filename = subset_index_filename(subset_dir, ko_sketch, ksize, scaled, ko_ids)
+    if os.path.exists(filename):
+        print(f'Using the cached index of the KO subset {filename}')
+        return filename
+    os.makedirs(subset_dir, exist_ok=True)
+    index = write_subset_index(filename, ko_sketch, ksize, scaled, ko_ids, use_index)
+    print(f'Index of the KO subset ({index.n_kos} KOs, {len(index.hashes)} hashes) has been cached to {filename}')
+    return filename
+
+
+INDEX_MAGIC = b'FMHIDX01'
+INDEX_VERSION = 1
+ARRAY_ALIGNMENT = 64
+INDEX_ARRAYS = [('hashes', '<u8'), ('indptr', '<i8'), ('ko_ids', '<i4'), ('ko_n_hashes', '<i8')]
+
+
+"""
+Save the index. The native memory-mappable format is used, unless the filename ends in .npz.
+"""
+def save_index(index, filename):
+    if filename.endswith('.npz'):
+        save_index_npz(index, filename)
+        return
+
+    # lay out the arrays one after the other, each one aligned. Offsets are relative to the
+    # start of the array section, which is the first aligned offset after the header.
+    header = {'version': INDEX_VERSION, 'ksize': int(index.ksize), 'scaled': int(index.scaled),
+              'ko_names': [str(name) for name in index.ko_names], 'arrays': {}}
+    arrays = {name: np.ascontiguousarray(getattr(index, name), dtype=dtype) for name, dtype in INDEX_ARRAYS}
+    offset = 0
+    for name, dtype in INDEX_ARRAYS:
+        header['arrays'][name] = {'dtype': dtype, 'offset': offset, 'length': len(arrays[name])}
+        offset = _align(offset + arrays[name].nbytes)
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(INDEX_MAGIC) + 8 + len(header_bytes))
+
+    with open(filename, 'wb') as fp:
+        fp.write(INDEX_MAGIC)
+        fp.write(struct.pack('<Q', len(header_bytes)))
+        fp.write(header_bytes)
+        for name, _ in INDEX_ARRAYS:
+            fp.write(b'\0' * (data_start + header['arrays'][name]['offset'] - fp.tell()))
+            fp.write(arrays[name].tobytes())
+
+
+def _align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+def save_index_npz(index, filename):
+    # write to a file object, so that numpy does not append .npz to the filename
+    with open(filename, 'wb') as fp:
+        np.savez(fp, hashes=index.hashes, indptr=index.indptr, ko_ids=index.ko_ids,
+                 ko_names=index.ko_names, ko_n_hashes=index.ko_n_hashes,
+                 ksize=index.ksize, scaled=index.scaled)
+
+
+"""
+Load an index. Native index files are memory-mapped read-only, .npz files are read into memory.
+"""
+def load_index(filename):
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(INDEX_MAGIC))
+        if magic != INDEX_MAGIC:
+            return load_index_npz(filename)
+        header_size, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_size))
+    data_start = _align(len(INDEX_MAGIC) + 8 + header_size)
+
+    if header['version'] != INDEX_VERSION:
+        raise ValueError(f'{filename} is a KO index of version {header["version"]}, this version reads version {INDEX_VERSION}')
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        if info['length'] == 0:
+            # empty arrays cannot be memory-mapped
+            arrays[name] = np.zeros(0, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(filename, dtype=info['dtype'], mode='r', offset=data_start + info['offset'], shape=(info['length'],))
+    return KOIndex(arrays['hashes'], arrays['indptr'], arrays['ko_ids'], np.array(header['ko_names'], dtype=str),
+                   arrays['ko_n_hashes'], header['ksize'], header['scaled'])
+
+
+def load_index_npz(filename):
+    with np.load(filename, allow_pickle=False) as data:
+        return KOIndex(data['hashes'], data['indptr'], data['ko_ids'], data['ko_names'],
+                       data['ko_n_hashes'], int(data['ksize']), int(data['scaled']))
+
+
+"""
+Load an index, and check that it was built with the given ksize and scaled.
+"""
+def load_checked_index(filename, ksize, scaled):
+    index = load_index(filename)
+    if index.ksize != ksize or index.scaled != scaled:
+        print(f'Error: KO index {filename} was built with ksize={index.ksize} and scaled={index.scaled}, not ksize={ksize} and scaled={scaled}. Exiting...')
+        sys.exit(1)
+    return index
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the inverted hash -> KO index of a KO sketch, to be used with funcprofiler --index.")
+    parser.add_argument("ko_sketch", type=str, help="Filename of KO sketch")
+    parser.add_argument("ksize", type=int, help="Protein kmer size (7, 11, or 15) of the KO sketches to index")
+    parser.add_argument("scaled", type=int, help="The scaled to build the index at (the KO sketch is downsampled if needed)")
+    parser.add_argument("output", type=str, nargs='?', help="Output filename of the index. The memory-mappable native format is used, unless the name ends in .npz. May be omitted with --ko_subset, to build the reduced index into the subset directory")
+    parser.add_argument("--ko_subset", type=str, help="File of the KO ids to keep, one per line (or the first column of a CSV file, such as a KO profile): only these KOs are indexed")
+    parser.add_argument("--subset_dir", type=str, help="Directory of the cached reduced indexes, used with --ko_subset when no output is given (see funcprofiler --subset_dir). Default: $FMHFUNPROFILER_SUBSET_DIR, or ~/.cache/fmhfunprofiler/ko_subsets")
+    parser.add_argument("--index", action="store_true", help="ko_sketch is a KO index built with funcprofiler-index, to extract the --ko_subset from")
+    return parser.parse_args()
+
+
+def check_args(args):
+    # check if the KO sketch file exists
+    if not os.path.exists(args.ko_sketch):
+        print(f'Error: KO sketch file {args.ko_sketch} does not exist. Exiting...')
+        sys.exit(1)
+
+    # check if the protein kmer size is valid
+    if args.ksize not in [7, 11, 15]:
+        print(f'Error: Protein kmer size {args.ksize} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the scaled parameter is valid
+    if args.scaled < 1:
+        print(f'Error: Scaled parameter {args.scaled} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check the KO subset
+    if args.ko_subset is None:
+        if args.output is None:
+            print('Error: an output filename is needed without --ko_subset. Exiting...')
+            sys.exit(1)
+        if args.index:
+            print('Error: --index is only used to extract a --ko_subset from a KO index. Exiting...')
+            sys.exit(1)
+    else:
+        check_ko_subset(args.ko_subset)
+
+    return True
+
+
+"""
+Check that the file of a KO subset exists and lists KOs.
+"""
+def check_ko_subset(ko_subset):
+    if not os.path.exists(ko_subset):
+        print(f'Error: KO subset file {ko_subset} does not exist. Exiting...')
+        sys.exit(1)
+    if not read_ko_list(ko_subset):
+        print(f'Error: KO subset file {ko_subset} lists no KO. Exiting...')
+        sys.exit(1)
+
+
+def main():
+    args = parse_args()
+    check_args(args)
+
+    if args.ko_subset is not None:
+        ko_ids = read_ko_list(args.ko_subset)
+        if args.output is None:
+            cached_subset_index(args.ko_sketch, args.ksize, args.scaled, ko_ids, args.index, args.subset_dir)
+            return
+        index = write_subset_index(args.output, args.ko_sketch, args.ksize, args.scaled, ko_ids, args.index)
+        print(f'Index of the KO subset ({index.n_kos} KOs, {len(index.hashes)} hashes) has been written to {args.output}')
+        return
+
+    print(f'Loading KO sketches from {args.ko_sketch}...')
+    index = build_index(args.ko_sketch, args.ksize, args.scaled)
+    if index.n_kos == 0:
+        print(f'Error: no protein sketches with ksize {args.ksize} found in {args.ko_sketch}. Exiting...')
+        sys.exit(1)
+
+    save_index(index, args.output)
+    print(f'Index of {index.n_kos} KOs and {len(index.hashes)} hashes has been written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Per-stage instrumentation of a profiling run. Every stage (sanity check, sketch, prefetch,
+abundance extraction, ...) is recorded with its wall time, its CPU time (of this process and of
+the processes it waited for, such as the sourmash command line tool or the sketching workers),
+the peak RSS reached by the end of the stage, the number of bytes read, and the number of hashes
+processed.
+
+The records are written as JSON lines, one per stage, or as a Prometheus text exposition file.
+funcprofiler-many aggregates the records of all its samples per stage.
+"""
+
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+# numeric fields of a stage record; all the other fields are labels (stage, sample, ...)
+METRIC_FIELDS = ['wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'read_bytes', 'hashes']
+METRICS_FORMATS = ['jsonl', 'prometheus']
+PROMETHEUS_PREFIX = 'fmhfunprofiler_stage_'
+
+
+def _cpu_seconds():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def _peak_rss_bytes():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Metrics:
+    def __init__(self, **labels):
+        self.labels = labels
+        self.records = []
+
+    """
+    Record one stage. Used as a context manager, which yields the record so that the stage can
+    set read_bytes and hashes. Extra keyword arguments are added to the record as labels.
+    """
+    @contextmanager
+    def stage(self, name, **labels):
+        record = {'stage': name, **self.labels, **labels, 'read_bytes': 0, 'hashes': 0}
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_seconds()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = _cpu_seconds() - start_cpu
+            record['peak_rss_bytes'] = _peak_rss_bytes()
+            self.records.append(record)
+
+    def write(self, filename, metrics_format='jsonl'):
+        write_metrics(filename, self.records, metrics_format)
+
+
+"""
+Aggregate stage records over samples: one summary per stage (and per value of the other labels,
+except sample), with the number of samples, and the sum, mean and max of every metric.
+"""
+def aggregate(records):
+    groups = {}
+    for record in records:
+        labels = tuple((key, value) for key, value in record.items() if not _is_metric(key) and key != 'sample')
+        groups.setdefault(labels, []).append(record)
+
+    summaries = []
+    for labels, group in groups.items():
+        summary = dict(labels)
+        summary['samples'] = len(group)
+        for field in METRIC_FIELDS:
+            values = [record.get(field, 0) for record in group]
+            summary[f'{field}_sum'] = sum(values)
+            summary[f'{field}_mean'] = sum(values) / len(values)
+            summary[f'{field}_max'] = max(values)
+        summaries.append(summary)
+    return summaries
+
+
+def read_metrics(filename):
+    with open(filename) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def write_metrics(filename, records, metrics_format='jsonl'):
+    with open(filename, 'w') as fp:
+        if metrics_format == 'prometheus':
+            fp.write(to_prometheus(records))
+        else:
+            for record in records:
+                fp.write(json.dumps(record) + '\n')
+
+
+"""
+Format stage records or their aggregates in the Prometheus text exposition format: every metric
+becomes a gauge named fmhfunprofiler_stage_<field>, and every other field a label.
+"""
+def to_prometheus(records):
+    samples = {}
+    for record in records:
+        labels = ','.join(f'{key}="{_escape(value)}"' for key, value in record.items() if not _is_metric(key))
+        for key, value in record.items():
+            if _is_metric(key):
+                samples.setdefault(key, []).append(f'{PROMETHEUS_PREFIX}{key}{{{labels}}} {value}')
+
+    lines = []
+    for key, metric_lines in samples.items():
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}{key} gauge')
+        lines.extend(metric_lines)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _is_metric(key):
+    # the fields of stage records, and of their aggregates (wall_seconds_sum, ..., samples)
+    return key == 'samples' or any(key == field or key.startswith(field + '_') for field in METRIC_FIELDS)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
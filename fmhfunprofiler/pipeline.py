@@ -0,0 +1,96 @@
+"""
+Pipelined execution of the samples of a cohort against one loaded KO database. Every sample
+goes through three stages, and the stages of different samples overlap:
+
+    sketch: a pool of worker processes reads, decompresses, translates and sketches the reads,
+        at most max_pending samples ahead of the matching
+    match: the main thread matches the sketches against the KO database as they complete
+    write: a writer thread writes the outputs, fed through a queue of at most write_queue_size
+        results
+
+So while a sample is matched and written, the next ones are read and sketched, and the CPUs
+keep working while a slow (e.g. network) file system serves the reads or the outputs. The
+bounded number of pending sketches and the bounded queue keep the memory use independent of
+the number of samples: when a stage falls behind, the stages before it wait.
+"""
+
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+DEFAULT_WRITE_QUEUE_SIZE = 4
+# marks the end of the samples in the write queue
+_END = object()
+
+
+"""
+Run every sample through the pipeline. samples are tuples whose first element is the metagenome
+filename; sketch_function(mg_filename) runs in a worker process (and must be picklable),
+match_function(sample, sketch) in the main thread, and write_function(sample, result) in the
+writer thread, which may return a status to report. initializer(*initargs), if given, runs
+once in every worker process, e.g. to hand it data that would otherwise be sent with every
+sample. Progress is reported as samples leave the pipeline. Returns the list of samples that
+failed, in the order of samples.
+"""
+def run_pipeline(samples, sketch_function, match_function, write_function, n_workers=1, max_pending=None,
+                 write_queue_size=DEFAULT_WRITE_QUEUE_SIZE, initializer=None, initargs=()):
+    if max_pending is None:
+        max_pending = 2 * n_workers
+    failed = set()
+    n_done = [0]
+    lock = threading.Lock()
+
+    def report(sample, status=None, error=None):
+        with lock:
+            n_done[0] += 1
+            if error is not None:
+                print(f'Error: profiling {sample[0]} failed: {error}')
+                failed.add(sample)
+                status = 'FAILED'
+            print(f'[{n_done[0]}/{len(samples)}] {sample[0]}: {status or "done"}')
+
+    write_queue = queue.Queue(maxsize=write_queue_size)
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is _END:
+                return
+            sample, result = item
+            try:
+                report(sample, write_function(sample, result))
+            except Exception as e:
+                report(sample, error=e)
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=initializer, initargs=initargs) as pool:
+            remaining = iter(samples)
+            pending = {}
+
+            def submit_next():
+                sample = next(remaining, None)
+                if sample is not None:
+                    pending[pool.submit(sketch_function, sample[0])] = sample
+
+            for _ in range(max(1, max_pending)):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sample = pending.pop(future)
+                    # keep the workers busy while this sample is matched
+                    submit_next()
+                    try:
+                        result = match_function(sample, future.result())
+                    except Exception as e:
+                        report(sample, error=e)
+                        continue
+                    # waits when the writer falls behind
+                    write_queue.put((sample, result))
+    finally:
+        write_queue.put(_END)
+        writer_thread.join()
+    return [sample for sample in samples if sample in failed]
@@ -0,0 +1,70 @@
+"""
+Samples whose reads are in several files, e.g. the two files of paired-end reads, or the files
+of several sequencing lanes. Wherever a metagenome file is expected, such a sample is given by
+its read files joined with commas, e.g. sample_R1.fastq.gz,sample_R2.fastq.gz. The reads of all
+the files are streamed into a single sketch, so the files never have to be concatenated on disk.
+
+The content of a sample is hashed over its files in order, so a sample of one file has the same
+digest as before, and a sample split into several files the digest of their concatenation.
+"""
+
+import os
+from fmhfunprofiler.sketch_cache import files_digest
+
+
+READ_FILES_SEPARATOR = ','
+# the separator of the read files of a sample in a column of a file list, where commas separate
+# the columns
+FILELIST_READ_FILES_SEPARATOR = ';'
+
+
+"""
+The read files of a sample.
+"""
+def read_files(mg_filename):
+    return [filename for filename in mg_filename.split(READ_FILES_SEPARATOR) if filename]
+
+
+"""
+The name of a sample made of these read files.
+"""
+def join_read_files(filenames):
+    return READ_FILES_SEPARATOR.join(filenames)
+
+
+"""
+The name of a sample (see join_read_files) from a column of a file list, which gives its read
+files separated by ; (or by commas, inside a quoted field).
+"""
+def filelist_read_files(field):
+    return join_read_files([filename for part in field.split(FILELIST_READ_FILES_SEPARATOR) for filename in read_files(part.strip())])
+
+
+"""
+The read files of a sample that do not exist.
+"""
+def missing_read_files(mg_filename):
+    return [filename for filename in read_files(mg_filename) if not os.path.exists(filename)]
+
+
+"""
+Total size of the read files of a sample, in bytes. The missing files count for nothing.
+"""
+def input_size(mg_filename):
+    return sum(os.path.getsize(filename) for filename in read_files(mg_filename) if os.path.exists(filename))
+
+
+"""
+The size and the latest modification time (in ns) of the read files of a sample, as recorded
+in the run manifest. Raises OSError if a file is missing.
+"""
+def input_stat(mg_filename):
+    stats = [os.stat(filename) for filename in read_files(mg_filename)]
+    return sum(st.st_size for st in stats), max(st.st_mtime_ns for st in stats)
+
+
+"""
+Hash of the content of the read files of a sample.
+"""
+def content_digest(mg_filename):
+    return files_digest(read_files(mg_filename))
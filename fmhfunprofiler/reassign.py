@@ -0,0 +1,146 @@
+"""
+Reassignment of the hashes shared by several KOs. In the prefetch table, a sample hash counts
+for every KO that contains it, so the members of a paralogous KO family are all credited with
+the same hashes. `sourmash gather` resolves this by greedily assigning every hash to a single
+KO, but is too slow on large samples and databases.
+
+Here, the sample hashes found in the KOs of the prefetch table are gathered into a sparse
+hash x KO matrix, and every hash is split between the KOs that contain it, either:
+
+    em: by expectation-maximization, with a mixture model where every KO emits its hashes
+        uniformly, with a weight estimated from all the hashes. Iterated until the weights
+        change by less than the tolerance, or for at most max_iterations iterations.
+    greedy: as `sourmash gather` does, by repeatedly giving all the remaining hashes of the
+        KO with the most remaining hashes to it.
+
+Every step is a sparse matrix-vector product, so the cost stays close to the cost of prefetch.
+KOs whose share of the hashes falls below threshold_bp are dropped, as in `sourmash gather`.
+The table gets three columns: unique_intersect_bp (the hashes assigned to the KO, times scaled),
+f_unique_to_query (the fraction of the sample hashes assigned to the KO), and f_unique_weighted
+(the same fraction, weighted by the abundances of the hashes).
+
+numpy and scipy are imported by the functions that use them, so that the command line tools
+can offer REASSIGN_METHODS without loading them.
+"""
+
+
+REASSIGN_METHODS = ['em', 'greedy']
+REASSIGNED_COLUMNS = ['unique_intersect_bp', 'f_unique_to_query', 'f_unique_weighted']
+
+
+"""
+The sparse hash x KO matrix of the (hash, KO) pairs, with a 1 for every hash contained in a KO.
+"""
+def hash_ko_matrix(hash_positions, ko_ids, n_hashes, n_kos):
+    import numpy as np
+    import scipy.sparse
+    data = np.ones(len(hash_positions), dtype=np.float64)
+    return scipy.sparse.csr_matrix((data, (hash_positions, ko_ids)), shape=(n_hashes, n_kos))
+
+
+"""
+Split every hash (row of matrix) between the KOs (columns) that contain it, by EM. weights are
+the weights of the hashes (ones, or their abundances), and ko_n_hashes the number of hashes of
+every KO. Returns the matrix of the responsibilities: row h holds the share of hash h given to
+every KO, and the number of iterations run.
+"""
+def em_assignment(matrix, ko_n_hashes, weights, tolerance=1e-6, max_iterations=1000):
+    import numpy as np
+    import scipy.sparse
+    n_kos = matrix.shape[1]
+    ko_n_hashes = np.maximum(np.asarray(ko_n_hashes, dtype=np.float64), 1.0)
+    weights = np.asarray(weights, dtype=np.float64)
+    total_weight = weights.sum()
+    # mixture weights of the KOs
+    pi = np.full(n_kos, 1.0 / n_kos)
+    matrix_t = matrix.T.tocsr()
+    n_iterations = 0
+    for n_iterations in range(1, max_iterations + 1):
+        # a KO emits each of its hashes with probability pi / n_hashes
+        emission = pi / ko_n_hashes
+        # E step: the responsibility of KO k for hash h is emission[k] / (matrix @ emission)[h]
+        denominator = matrix @ emission
+        scale = np.divide(weights, denominator, out=np.zeros_like(weights), where=denominator > 0)
+        # M step: the weight of a KO is the sum of its (weighted) responsibilities
+        new_pi = emission * (matrix_t @ scale) / total_weight
+        converged = np.abs(new_pi - pi).max() < tolerance
+        pi = new_pi
+        if converged:
+            break
+
+    emission = pi / ko_n_hashes
+    denominator = matrix @ emission
+    inverse = np.divide(1.0, denominator, out=np.zeros_like(denominator), where=denominator > 0)
+    responsibilities = scipy.sparse.diags(inverse) @ matrix @ scipy.sparse.diags(emission)
+    return responsibilities.tocsr(), n_iterations
+
+
+"""
+Assign every hash to a single KO, as `sourmash gather` does: the KO with the most remaining
+hashes gets all of them, until no KO has at least min_hashes remaining hashes. Returns the
+0/1 matrix of the assignments, in the layout of em_assignment.
+"""
+def greedy_assignment(matrix, min_hashes=1):
+    import numpy as np
+    import scipy.sparse
+    n_hashes, n_kos = matrix.shape
+    matrix_csc = matrix.tocsc()
+    remaining = np.ones(n_hashes, dtype=np.float64)
+    assigned_ko = np.full(n_hashes, -1, dtype=np.int64)
+    for _ in range(n_kos):
+        counts = matrix_csc.T @ remaining
+        best = int(np.argmax(counts))
+        if counts[best] < max(min_hashes, 1):
+            break
+        hashes = matrix_csc.indices[matrix_csc.indptr[best]:matrix_csc.indptr[best + 1]]
+        hashes = hashes[remaining[hashes] > 0]
+        assigned_ko[hashes] = best
+        remaining[hashes] = 0.0
+
+    rows = np.flatnonzero(assigned_ko >= 0)
+    return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, assigned_ko[rows])), shape=(n_hashes, n_kos))
+
+
+"""
+Reassign the shared hashes between the KOs of a prefetch table. hash_positions and ko_ids are
+the (sample hash, KO) pairs of the sample hashes found in the KO database (in the positions of
+the sample hashes, and the ids of ko_names), and sample_abunds the abundances of the sample
+hashes. With weighted, EM weighs the hashes by their abundances. Returns the table restricted
+to the KOs that keep at least threshold_bp of unique overlap, with the REASSIGNED_COLUMNS, and
+the number of EM iterations (0 for greedy).
+"""
+def reassign_shared_hashes(df, hash_positions, ko_ids, ko_names, sample_abunds, scaled, threshold_bp,
+                           method='em', tolerance=1e-6, max_iterations=1000, weighted=False):
+    import numpy as np
+    sample_abunds = np.asarray(sample_abunds, dtype=np.float64)
+    n_sample_hashes = len(sample_abunds)
+
+    # only the KOs of the table take part, as columns in the order of the table
+    column_of_ko = np.full(len(ko_names), -1, dtype=np.int64)
+    ko_id_of_name = {name: ko_id for ko_id, name in enumerate(ko_names)}
+    column_of_ko[[ko_id_of_name[name] for name in df['match_name']]] = np.arange(len(df))
+    columns = column_of_ko[ko_ids]
+    keep = columns >= 0
+    hash_positions, columns = hash_positions[keep], columns[keep]
+
+    # the rows are the sample hashes found in these KOs
+    hashes, rows = np.unique(hash_positions, return_inverse=True)
+    matrix = hash_ko_matrix(rows, columns, len(hashes), len(df))
+    n_iterations = 0
+    if len(df) == 0:
+        responsibilities = matrix
+    elif method == 'greedy':
+        responsibilities = greedy_assignment(matrix, min_hashes=threshold_bp / scaled)
+    else:
+        ko_n_hashes = df['match_bp'].to_numpy() // scaled
+        weights = sample_abunds[hashes] if weighted else np.ones(len(hashes))
+        responsibilities, n_iterations = em_assignment(matrix, ko_n_hashes, weights, tolerance, max_iterations)
+
+    n_unique = np.asarray(responsibilities.sum(axis=0)).ravel()
+    weighted_unique = responsibilities.T @ sample_abunds[hashes]
+    df = df.copy()
+    df['unique_intersect_bp'] = n_unique * scaled
+    df['f_unique_to_query'] = n_unique / n_sample_hashes if n_sample_hashes else 0.0
+    df['f_unique_weighted'] = weighted_unique / sample_abunds.sum() if n_sample_hashes else 0.0
+    df = df[(df['unique_intersect_bp'] > 0) & (df['unique_intersect_bp'] >= threshold_bp)]
+    return df.reset_index(drop=True), n_iterations
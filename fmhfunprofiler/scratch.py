@@ -0,0 +1,53 @@
+"""
+Scratch directories for the intermediate files of a run, such as the metagenome sketch and the
+prefetch table written by the sourmash command line tool. Every run gets its own directory,
+with a unique name, under the scratch location: $TMPDIR by default, which is node-local on most
+clusters, so that the intermediates are neither written to the shared storage of the inputs nor
+left behind there. The directory is removed when the run ends, whether it succeeds, fails or is
+stopped with SIGTERM (as schedulers do when a job is cancelled or runs out of time).
+"""
+
+import contextlib
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+
+
+SCRATCH_PREFIX = 'funcprofiler_'
+
+
+"""
+The scratch location used when none is given: $TMPDIR if it is set, otherwise the temporary
+directory of the system.
+"""
+def default_scratch_dir():
+    return tempfile.gettempdir()
+
+
+def _exit_on_sigterm(signum, frame):
+    sys.exit(128 + signum)
+
+
+"""
+Create a directory with a unique name under scratch_dir (default: default_scratch_dir()), and
+remove it with all its content on exit. While it exists, SIGTERM exits through SystemExit, so
+that the directory is removed as well. Yields the name of the directory.
+"""
+@contextlib.contextmanager
+def scratch_directory(scratch_dir=None, prefix=SCRATCH_PREFIX):
+    scratch_dir = scratch_dir if scratch_dir is not None else default_scratch_dir()
+    os.makedirs(scratch_dir, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=prefix, dir=scratch_dir)
+    # signal handlers can only be set from the main thread
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
@@ -0,0 +1,222 @@
+"""
+Persistent KO database server. The KO sketch is loaded once, and kept in memory while
+metagenome samples are profiled against it, so that the cost of loading the reference
+(which dominates short jobs with the scaled=10/50 KEGG sketches) is paid once per node
+instead of once per sample.
+
+The server listens on a local Unix socket. Every connection sends one job, as a single
+line of JSON, and receives one line of JSON back. A job is either a metagenome file:
+
+    {"mg_filename": "sample.fastq", "output": "ko_profiles.csv", "threshold_bp": 1000}
+
+where mg_filename may list the read files of a sample separated by commas (see reads.py), or
+a metagenome sketch that has already been computed (with the same ksize and scaled):
+
+    {"sketch": "sample.sig.zip", "output": "ko_profiles.csv"}
+
+"threshold_bp", "prefetch_file" and "abundance_weighted" (true for KO abundances weighted by
+the multiplicities of the sample hashes) are optional. When "output" is missing, the KO profile
+is returned in the reply instead of being written to a file. {"command": "shutdown"} stops
+the server.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from fmhfunprofiler import checkpoint, engine, ko_index, reads
+from fmhfunprofiler.funcprofiler import write_ko_profiles
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Persistent KO database server. Loads the KO sketch once, and profiles metagenome samples sent to it over a Unix socket.")
+    parser.add_argument("ko_sketch", type=str, help="Filename of KO sketch")
+    parser.add_argument("ksize", type=int, help="Protein kmer size (7, 11, or 15) used to obtain the KO sketch")
+    parser.add_argument("scaled", type=int, help="The scaled parameter used to obtain the KO sketch")
+    parser.add_argument("socket", type=str, help="Path of the Unix socket to listen on")
+    parser.add_argument('-t', "--threshold_bp", type=int, help="Default threshold_bp for jobs that do not set one", default=1000)
+    parser.add_argument("--index", action="store_true", help="ko_sketch is an inverted KO index built with funcprofiler-index")
+    return parser.parse_args()
+
+
+def check_args(args):
+    # check if the KO sketch file exists
+    if not os.path.exists(args.ko_sketch):
+        print(f'Error: KO sketch file {args.ko_sketch} does not exist. Exiting...')
+        sys.exit(1)
+
+    # check if the protein kmer size is valid
+    if args.ksize not in [7, 11, 15]:
+        print(f'Error: Protein kmer size {args.ksize} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the scaled parameter is valid
+    if args.scaled < 1:
+        print(f'Error: Scaled parameter {args.scaled} is not valid. Exiting...')
+        sys.exit(1)
+
+    # check if the threshold_bp is valid
+    if args.threshold_bp < 1:
+        print(f'Error: threshold_bp {args.threshold_bp} is not valid. Exiting...')
+        sys.exit(1)
+
+    return True
+
+
+"""
+The in-memory KO database, together with the parameters it was loaded with.
+"""
+class KODatabase:
+    def __init__(self, ko_sketch, ksize, scaled, threshold_bp=1000, use_index=False):
+        self.ko_sketch = ko_sketch
+        self.ksize = ksize
+        self.scaled = scaled
+        self.threshold_bp = threshold_bp
+        self.index = None
+        self.ko_sigs = None
+        if use_index:
+            self.index = ko_index.load_checked_index(ko_sketch, ksize, scaled)
+        else:
+            self.ko_sigs = engine.load_ko_sketches(ko_sketch, ksize, scaled)
+
+    @property
+    def n_kos(self):
+        return self.index.n_kos if self.index is not None else len(self.ko_sigs)
+
+    """
+    Match a query minhash against the KO database. Returns the prefetch table.
+    """
+    def prefetch(self, query_minhash, threshold_bp, query_name='', weighted=False):
+        if self.index is not None:
+            return self.index.prefetch(query_minhash, threshold_bp, query_name=query_name, weighted=weighted)
+        return engine.prefetch(query_minhash, self.ko_sigs, self.ksize, self.scaled, threshold_bp, query_name=query_name, weighted=weighted)
+
+    """
+    Load the query minhash of a job, either by sketching the metagenome file, or from a
+    precomputed sketch.
+    """
+    def load_query(self, job):
+        if 'sketch' in job:
+            return engine.load_sketch(job['sketch'], self.ksize), job['sketch']
+        return engine.sketch_metagenome(job['mg_filename'], self.ksize, self.scaled), job['mg_filename']
+
+    """
+    Profile one job. Returns the reply as a dictionary.
+    """
+    def run_job(self, job):
+        threshold_bp = int(job.get('threshold_bp', self.threshold_bp))
+        if threshold_bp < 1:
+            raise ValueError(f'threshold_bp {threshold_bp} is not valid')
+        if 'sketch' in job and not os.path.exists(job['sketch']):
+            raise FileNotFoundError(f'{job["sketch"]} does not exist')
+        missing_read_files = reads.missing_read_files(job.get('mg_filename', ''))
+        if missing_read_files:
+            raise FileNotFoundError(f'{missing_read_files[0]} does not exist')
+        if 'mg_filename' not in job and 'sketch' not in job:
+            raise ValueError('a job needs either mg_filename or sketch')
+
+        weighted = bool(job.get('abundance_weighted', False))
+        weight_column = 'sum_abund' if weighted else 'f_match_query'
+        query_minhash, query_name = self.load_query(job)
+        df = self.prefetch(query_minhash, threshold_bp, query_name=query_name, weighted=weighted)
+        if job.get('prefetch_file'):
+            checkpoint.atomic_write(job['prefetch_file'], lambda tmp_filename: df.to_csv(tmp_filename, index=False))
+
+        if job.get('output'):
+            write_ko_profiles(df, job['output'], weight_column=weight_column)
+            return {'status': 'ok', 'output': job['output'], 'n_kos': len(df)}
+
+        sum_weights = df[weight_column].sum()
+        profile = [[name, weight / sum_weights] for name, weight in zip(df['match_name'], df[weight_column])]
+        return {'status': 'ok', 'profile': profile, 'n_kos': len(df)}
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        # a connection closed without a job, e.g. by make_server checking that the socket is in use
+        if not line:
+            return
+        try:
+            job = json.loads(line)
+            if job.get('command') == 'shutdown':
+                reply = {'status': 'ok'}
+                # shutdown() blocks until serve_forever() returns, so do not wait for it here
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                reply = self.server.ko_database.run_job(job)
+        except Exception as e:
+            reply = {'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+class KOServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, ko_database):
+        self.ko_database = ko_database
+        super().__init__(socket_path, JobHandler)
+
+
+"""
+Create a server that listens on socket_path. A stale socket file left by a server that is
+no longer running (which refuses connections) is removed. Exits with an error if socket_path
+is not a socket, or if a server is already listening on it.
+"""
+def make_server(socket_path, ko_database):
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            print(f'Error: {socket_path} exists and is not a socket. Exiting...')
+            sys.exit(1)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            except FileNotFoundError:
+                # removed in the meantime
+                pass
+            else:
+                print(f'Error: a server is already listening on {socket_path}. Exiting...')
+                sys.exit(1)
+    return KOServer(socket_path, ko_database)
+
+
+"""
+Send one job to a running server, and return its reply as a dictionary.
+"""
+def submit_job(socket_path, job):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(job) + '\n').encode())
+        with sock.makefile('rb') as fp:
+            return json.loads(fp.readline())
+
+
+def main():
+    args = parse_args()
+    check_args(args)
+
+    print(f'Loading KO sketches from {args.ko_sketch}...')
+    ko_database = KODatabase(args.ko_sketch, args.ksize, args.scaled, args.threshold_bp, use_index=args.index)
+    print(f'Loaded {ko_database.n_kos} KO sketches')
+
+    server = make_server(args.socket, ko_database)
+    print(f'Listening on {args.socket}')
+    try:
+        server.serve_forever(poll_interval=0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+    print('Exiting...')
+
+
+if __name__ == '__main__':
+    main()
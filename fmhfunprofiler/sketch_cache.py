@@ -0,0 +1,234 @@
+"""
+Content-addressed cache of metagenome sketches. A sketch is stored under a key made of a hash
+of the content of the metagenome file, the protein ksize and the scaled, so re-profiling the
+same sample with another threshold_bp or another KO database reuses its sketch, whatever the
+name or location of the file.
+
+The cache is a directory of .sig.zip files. Every use of a sketch refreshes its modification
+time, and when the cache grows above its maximum size, the least recently used sketches are
+removed first. The funcprofiler-cache command lists, prunes or clears a cache.
+
+sourmash is only imported to read or write a sketch, so that the cache keys can be computed by
+funcprofiler (and checkpoint.py) without loading it.
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import time
+import uuid
+
+
+CACHE_DIR_ENV = 'FMHFUNPROFILER_CACHE_DIR'
+SKETCH_SUFFIX = '.sig.zip'
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+"""
+The cache directory used when none is given: $FMHFUNPROFILER_CACHE_DIR if it is set, otherwise
+fmhfunprofiler/sketches under $XDG_CACHE_HOME (default ~/.cache).
+"""
+def default_cache_dir():
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.environ[CACHE_DIR_ENV]
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'fmhfunprofiler', 'sketches')
+
+
+"""
+Parse a size such as 500M, 20G or 1.5T (powers of 1024) into a number of bytes.
+"""
+def parse_size(size):
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)B?\s*', str(size).upper())
+    if match is None:
+        raise ValueError(f'invalid size: {size}')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+"""
+Hash of the content of a file, read in blocks so that large files do not fill the memory.
+"""
+def file_digest(filename, block_size=1 << 20):
+    return files_digest([filename], block_size)
+
+
+"""
+Hash of the content of several files, in order: the hash of their concatenation.
+"""
+def files_digest(filenames, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=20)
+    for filename in filenames:
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(content_digest, ksize, scaled):
+    return f'{content_digest}_k{ksize}_s{scaled}'
+
+
+class SketchCache:
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + SKETCH_SUFFIX)
+
+    """
+    Return the filename of the cached sketch with this key, or None if it is not cached.
+    """
+    def get(self, key):
+        filename = self.path(key)
+        try:
+            # mark the sketch as recently used
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        return filename
+
+    """
+    Store a copy of a sketch file under this key, and evict old sketches if the cache is
+    now too large. Returns the filename of the cached sketch.
+    """
+    def put_file(self, key, sketch_filename):
+        return self._put(key, lambda tmp_filename: shutil.copyfile(sketch_filename, tmp_filename))
+
+    """
+    Store a minhash under this key, see put_file.
+    """
+    def put_minhash(self, key, minhash, name=''):
+        from fmhfunprofiler import engine
+        return self._put(key, lambda tmp_filename: engine.save_sketch(minhash, name, tmp_filename))
+
+    def _put(self, key, write_function):
+        # write next to the final location, then rename, so that a concurrent reader never sees a partial file
+        tmp_filename = os.path.join(self.cache_dir, f'.tmp_{uuid.uuid4().hex}{SKETCH_SUFFIX}')
+        try:
+            write_function(tmp_filename)
+            os.replace(tmp_filename, self.path(key))
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        if self.max_size is not None:
+            self.evict(self.max_size)
+        return self.path(key)
+
+    """
+    The cached sketches, as (key, size in bytes, last use time) tuples, least recently used first.
+    """
+    def entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(SKETCH_SUFFIX) or filename.startswith('.tmp_'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                continue
+            entries.append((filename[:-len(SKETCH_SUFFIX)], st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def total_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    """
+    Remove the least recently used sketches until the cache holds at most max_size bytes.
+    Returns the keys of the removed sketches.
+    """
+    def evict(self, max_size):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for key, size, _ in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(key)
+        return removed
+
+    def clear(self):
+        return self.evict(0)
+
+
+"""
+Return the cached sketch of a metagenome file as a minhash, computing and caching it with
+sketch_function(mg_filename, ksize, scaled) on a miss.
+"""
+def cached_sketch(cache, mg_filename, ksize, scaled, sketch_function, content_digest=None):
+    def sketch_multi_function(mg_filename, ksizes, scaled):
+        return {ksize: sketch_function(mg_filename, ksize, scaled) for ksize in ksizes}
+    return cached_sketches(cache, mg_filename, [ksize], scaled, sketch_multi_function, content_digest)[ksize]
+
+
+"""
+Return the cached sketches of a metagenome file at several ksizes, as a dictionary ksize ->
+minhash. The ksizes missing from the cache are computed together, with
+sketch_multi_function(mg_filename, ksizes, scaled), and cached. The file is hashed to find its
+sketches, unless its content_digest is given.
+"""
+def cached_sketches(cache, mg_filename, ksizes, scaled, sketch_multi_function, content_digest=None):
+    from fmhfunprofiler import engine, reads
+    if content_digest is None:
+        content_digest = reads.content_digest(mg_filename)
+    minhashes = {}
+    missing = []
+    for ksize in ksizes:
+        filename = cache.get(cache_key(content_digest, ksize, scaled))
+        if filename is not None:
+            print(f'Using the cached sketch {filename}')
+            minhashes[ksize] = engine.load_sketch(filename, ksize)
+        else:
+            missing.append(ksize)
+
+    if missing:
+        for ksize, minhash in sketch_multi_function(mg_filename, missing, scaled).items():
+            filename = cache.put_minhash(cache_key(content_digest, ksize, scaled), minhash, name=mg_filename)
+            print(f'Sketch of the metagenome has been cached to {filename}')
+            minhashes[ksize] = minhash
+    return minhashes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the cache of metagenome sketches used by funcprofiler --cache.")
+    parser.add_argument("--cache_dir", type=str, help=f"Cache directory (default: ${CACHE_DIR_ENV}, or ~/.cache/fmhfunprofiler/sketches)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List the cached sketches, least recently used first")
+    prune = subparsers.add_parser("prune", help="Remove the least recently used sketches until the cache fits in a size")
+    prune.add_argument("max_size", type=str, help="Maximum size of the cache, e.g. 500M or 20G")
+    subparsers.add_parser("clear", help="Remove all the cached sketches")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cache = SketchCache(args.cache_dir)
+
+    if args.command == 'list':
+        for key, size, last_used in cache.entries():
+            print(f'{key}\t{size}\t{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last_used))}')
+        print(f'{len(cache.entries())} sketches, {cache.total_size()} bytes in {cache.cache_dir}')
+    elif args.command == 'prune':
+        try:
+            max_size = parse_size(args.max_size)
+        except ValueError:
+            print(f'Error: cache size {args.max_size} is not valid. Exiting...')
+            sys.exit(1)
+        removed = cache.evict(max_size)
+        print(f'Removed {len(removed)} sketches from {cache.cache_dir}')
+    elif args.command == 'clear':
+        removed = cache.clear()
+        print(f'Removed {len(removed)} sketches from {cache.cache_dir}')
+
+
+if __name__ == '__main__':
+    main()
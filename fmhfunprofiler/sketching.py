@@ -0,0 +1,128 @@
+"""
+Streaming, parallel sketching of a metagenome sample. The reads are read from the gzip or plain
+FASTA/FASTQ file in chunks of about chunk_bases bases, and every chunk is six-frame translated
+and hashed into its own FracMinHash by a pool of worker processes. The per-chunk sketches are
+then merged: with scaled sketches, this is the union of the hashes below the max hash, with
+their abundances summed, so the result is the same as sketching the whole file at once.
+
+At most two chunks per worker are in flight at any time, so memory use is bounded by the chunk
+size and the number of workers, not by the size of the sample.
+
+Several protein kmer sizes can be sketched in the same pass, so that the reads are read and
+translated once for a sweep over ksizes.
+
+With keep_hashes (a sorted array of the hashes of the KO reference for every ksize), the hashes
+of every chunk that no KO contains are dropped in the worker, before the chunk sketch is sent
+back and merged: the sample sketch only holds the hashes that can match a KO.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import screed
+from fmhfunprofiler import engine, reads
+
+
+# number of bases in a chunk of reads handed to a worker
+DEFAULT_CHUNK_BASES = 10_000_000
+
+
+"""
+Read the sequences of a FASTA/FASTQ file (gzip is handled by screed), or of the read files of a
+sample one after the other (see reads.py), in lists holding about chunk_bases bases each.
+"""
+def read_chunks(mg_filename, chunk_bases=DEFAULT_CHUNK_BASES):
+    chunk = []
+    n_bases = 0
+    for filename in reads.read_files(mg_filename):
+        with screed.open(filename) as records:
+            for record in records:
+                chunk.append(record.sequence)
+                n_bases += len(record.sequence)
+                if n_bases >= chunk_bases:
+                    yield chunk
+                    chunk = []
+                    n_bases = 0
+    if chunk:
+        yield chunk
+
+
+"""
+Keep only the hashes of a minhash that are in keep_hashes, a sorted uint64 array.
+"""
+def filter_minhash(minhash, keep_hashes):
+    hashes, abunds = engine.minhash_to_arrays(minhash)
+    filtered = minhash.copy_and_clear()
+    if len(keep_hashes) == 0 or len(hashes) == 0:
+        return filtered
+    positions = np.minimum(np.searchsorted(keep_hashes, hashes), len(keep_hashes) - 1)
+    found = keep_hashes[positions] == hashes
+    filtered.set_abundances(dict(zip(hashes[found].tolist(), abunds[found].tolist())))
+    return filtered
+
+
+"""
+Translate and sketch one chunk of sequences, at every protein kmer size. Runs in a worker
+process. Returns the list of minhashes, in the order of ksizes, filtered with keep_hashes (a
+dictionary ksize -> sorted hashes) if given.
+"""
+def sketch_chunk(sequences, ksizes, scaled, keep_hashes=None):
+    minhashes = [engine.new_translate_minhash(ksize, scaled) for ksize in ksizes]
+    for sequence in sequences:
+        for minhash in minhashes:
+            minhash.add_sequence(sequence, force=True)
+    if keep_hashes is not None:
+        minhashes = [filter_minhash(minhash, keep_hashes[ksize]) for ksize, minhash in zip(ksizes, minhashes)]
+    return minhashes
+
+
+# keep_hashes of the worker processes, set once per worker instead of being sent with every chunk
+_worker_keep_hashes = None
+
+
+def _init_worker(keep_hashes):
+    global _worker_keep_hashes
+    _worker_keep_hashes = keep_hashes
+
+
+def _sketch_chunk_in_worker(sequences, ksizes, scaled):
+    return sketch_chunk(sequences, ksizes, scaled, _worker_keep_hashes)
+
+
+"""
+Sketch the metagenome sample at several protein kmer sizes in a single pass over the reads,
+with a pool of processes. Returns a dictionary ksize -> FracMinHash (with abundances), holding
+only the hashes in keep_hashes[ksize] if keep_hashes is given.
+"""
+def sketch_metagenome_multi(mg_filename, ksizes, scaled, processes=1, chunk_bases=DEFAULT_CHUNK_BASES, keep_hashes=None):
+    ksizes = list(dict.fromkeys(ksizes))
+    minhashes = {ksize: engine.new_translate_minhash(ksize, scaled) for ksize in ksizes}
+
+    def merge(chunk_minhashes):
+        for ksize, chunk_minhash in zip(ksizes, chunk_minhashes):
+            minhashes[ksize].merge(chunk_minhash)
+
+    if processes <= 1:
+        for chunk in read_chunks(mg_filename, chunk_bases):
+            merge(sketch_chunk(chunk, ksizes, scaled, keep_hashes))
+        return minhashes
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(keep_hashes,)) as pool:
+        pending = set()
+        for chunk in read_chunks(mg_filename, chunk_bases):
+            # wait for a chunk to finish before reading more than two chunks per worker
+            while len(pending) >= 2 * processes:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    merge(future.result())
+            pending.add(pool.submit(_sketch_chunk_in_worker, chunk, ksizes, scaled))
+        for future in pending:
+            merge(future.result())
+    return minhashes
+
+
+"""
+Sketch the metagenome sample with a pool of processes. Returns the same FracMinHash (with
+abundances) as engine.sketch_metagenome.
+"""
+def sketch_metagenome_parallel(mg_filename, ksize, scaled, processes, chunk_bases=DEFAULT_CHUNK_BASES):
+    return sketch_metagenome_multi(mg_filename, [ksize], scaled, processes, chunk_bases)[ksize]
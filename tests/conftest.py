@@ -0,0 +1,69 @@
+"""
+Shared fixtures: a tiny synthetic KO reference sketch and a metagenome whose reads are
+sampled from some of the KO genes, so that the in-process code paths can be exercised
+without downloading the KEGG sketches.
+"""
+
+import gzip
+import random
+
+import pytest
+
+sourmash = pytest.importorskip("sourmash")
+from sourmash.save_load import SaveSignaturesToLocation  # noqa: E402
+
+
+KO_KSIZES = (7, 11)
+KO_SCALED = 1
+
+
+def _random_dna(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+@pytest.fixture(scope="session")
+def ko_genes():
+    """Eight random 600 bp 'genes', one per KO."""
+    rng = random.Random(1)
+    return {f"K{i:05d}": _random_dna(rng, 600) for i in range(1, 9)}
+
+
+@pytest.fixture(scope="session")
+def ko_sketch(tmp_path_factory, ko_genes):
+    """A .sig.zip with one protein signature per KO and ksize."""
+    path = tmp_path_factory.mktemp("ref") / "kos.sig.zip"
+    with SaveSignaturesToLocation(str(path)) as save_sigs:
+        for name, seq in ko_genes.items():
+            for ksize in KO_KSIZES:
+                mh = sourmash.MinHash(0, ksize, is_protein=True, scaled=KO_SCALED, track_abundance=True)
+                mh.add_sequence(seq, force=True)
+                save_sigs.add(sourmash.SourmashSignature(mh, name=name))
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def metagenome(tmp_path_factory, ko_genes):
+    """A FASTQ with 300 reads of 150 bp from K00001 (most abundant) to K00004."""
+    rng = random.Random(2)
+    genes = list(ko_genes.values())
+    path = tmp_path_factory.mktemp("mg") / "sample.fastq"
+    with open(path, "w") as fp:
+        for i in range(300):
+            gene = genes[rng.choice([0, 0, 0, 1, 1, 2, 3])]
+            start = rng.randrange(0, len(gene) - 150)
+            read = gene[start:start + 150]
+            fp.write(f"@read{i}\n{read}\n+\n{'I' * len(read)}\n")
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def split_metagenome(tmp_path_factory, metagenome):
+    """The reads of the metagenome split into two files, the second one gzipped, as for paired-end reads."""
+    with open(metagenome) as fp:
+        lines = fp.readlines()
+    directory = tmp_path_factory.mktemp("split")
+    first, second = directory / "sample_R1.fastq", directory / "sample_R2.fastq.gz"
+    first.write_text("".join(lines[:400]))
+    with gzip.open(second, "wt") as fp:
+        fp.write("".join(lines[400:]))
+    return [str(first), str(second)]
@@ -0,0 +1,159 @@
+"""
+Unit tests for fmhfunprofiler.checkpoint, the atomic writes and the run manifest.
+"""
+
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from fmhfunprofiler import checkpoint
+
+
+# ---------------------------------------------------------------------------
+# atomic_write
+# ---------------------------------------------------------------------------
+
+def test_atomic_write_keeps_extension(tmp_path):
+    output = tmp_path / "profile.csv.gz"
+
+    def write(tmp_filename):
+        assert tmp_filename.endswith("profile.csv.gz")
+        with gzip.open(tmp_filename, "wt") as fp:
+            fp.write("ko_id,abundance\n")
+
+    checkpoint.atomic_write(str(output), write)
+    assert gzip.open(output, "rt").read() == "ko_id,abundance\n"
+    assert os.listdir(tmp_path) == ["profile.csv.gz"]
+
+
+def test_atomic_write_failure_leaves_previous_output(tmp_path):
+    output = tmp_path / "profile.csv"
+    output.write_text("previous\n")
+
+    def write(tmp_filename):
+        with open(tmp_filename, "w") as fp:
+            fp.write("partial")
+        raise RuntimeError("killed")
+
+    with pytest.raises(RuntimeError):
+        checkpoint.atomic_write(str(output), write)
+    assert output.read_text() == "previous\n"
+    assert os.listdir(tmp_path) == ["profile.csv"]
+
+
+# ---------------------------------------------------------------------------
+# Manifest
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def finished_sample(tmp_path):
+    mg, output = tmp_path / "sample.fastq", tmp_path / "profile.csv"
+    mg.write_text("@r\nACGT\n+\nIIII\n")
+    output.write_text("ko_id,abundance\nK00001,1.0\n")
+    manifest = checkpoint.Manifest(str(tmp_path / "manifest.jsonl"))
+    manifest.record(str(mg), str(output), {"ksize": 7})
+    return manifest, str(mg), str(output)
+
+
+def test_manifest_current_after_reload(finished_sample):
+    manifest, mg, output = finished_sample
+    reloaded = checkpoint.Manifest(manifest.filename)
+    assert reloaded.is_current(mg, output, {"ksize": 7})
+    assert not reloaded.is_current(mg, output, {"ksize": 11})
+    assert not reloaded.is_current(mg, output + ".other", {"ksize": 7})
+
+
+def test_manifest_detects_changed_files(finished_sample):
+    manifest, mg, output = finished_sample
+    # touching the input without changing it keeps the sample current
+    os.utime(mg, ns=(0, 0))
+    assert manifest.is_current(mg, output, {"ksize": 7})
+    with open(mg, "w") as fp:
+        fp.write("@r\nACGA\n+\nIIII\n")
+    assert not manifest.is_current(mg, output, {"ksize": 7})
+
+
+def test_manifest_detects_truncated_output(finished_sample):
+    manifest, mg, output = finished_sample
+    with open(output, "w") as fp:
+        fp.write("ko_id,abundance\n")
+    assert not manifest.is_current(mg, output, {"ksize": 7})
+    os.remove(output)
+    assert not manifest.is_current(mg, output, {"ksize": 7})
+
+
+def test_manifest_sample_of_several_read_files(tmp_path):
+    first, second, output = tmp_path / "R1.fastq", tmp_path / "R2.fastq", tmp_path / "profile.csv"
+    first.write_text("@r1\nACGT\n+\nIIII\n")
+    second.write_text("@r2\nTTGA\n+\nIIII\n")
+    output.write_text("ko_id,abundance\nK00001,1.0\n")
+    mg = f"{first},{second}"
+    manifest = checkpoint.Manifest(str(tmp_path / "manifest.jsonl"))
+    manifest.record(mg, str(output), {"ksize": 7})
+    assert manifest.is_current(mg, str(output), {"ksize": 7})
+    # a change in any of the read files is detected
+    second.write_text("@r2\nTTGC\n+\nIIII\n")
+    assert not manifest.is_current(mg, str(output), {"ksize": 7})
+    os.remove(second)
+    assert not manifest.is_current(mg, str(output), {"ksize": 7})
+
+
+def test_manifest_reuses_digest_of_unchanged_input(finished_sample, monkeypatch):
+    manifest, mg, output = finished_sample
+    digest = manifest.entries[(mg, output)]["input_digest"]
+
+    def fail(mg_filename):
+        raise AssertionError("the unchanged input was hashed again")
+    monkeypatch.setattr(checkpoint, "content_digest", fail)
+    manifest.record(mg, output, {"ksize": 11})
+    assert manifest.entries[(mg, output)]["input_digest"] == digest
+    assert manifest.is_current(mg, output, {"ksize": 11})
+
+
+def test_manifest_ignores_partial_last_line(finished_sample):
+    manifest, mg, output = finished_sample
+    with open(manifest.filename, "a") as fp:
+        fp.write('{"mg_filename": "other.fa')
+    assert checkpoint.Manifest(manifest.filename).is_current(mg, output, {"ksize": 7})
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler-many --resume
+# ---------------------------------------------------------------------------
+
+@pytest.mark.skipif(shutil.which("sourmash") is None, reason="sourmash CLI not available")
+def test_funcprofiler_many_resume(tmp_path, metagenome, ko_sketch):
+    for name in ("a", "b"):
+        shutil.copyfile(metagenome, tmp_path / f"{name}.fastq")
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("".join(f"{tmp_path / name}.fastq,{tmp_path / name}.csv\n" for name in ("a", "b")))
+    cmd = [sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10", str(filelist), "50", "-j", "2", "--resume"]
+
+    subprocess.run(cmd, check=True, capture_output=True)
+    assert len((tmp_path / "files.csv.manifest.jsonl").read_text().splitlines()) == 2
+
+    res = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    assert "2 of 2 samples are up to date" in res.stdout
+
+    # a damaged output is profiled again
+    (tmp_path / "b.csv").write_text("ko_id,abundance\n")
+    res = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    assert "1 of 2 samples are up to date" in res.stdout
+    assert len((tmp_path / "b.csv").read_text().splitlines()) > 1
+
+
+@pytest.mark.skipif(shutil.which("sourmash") is None, reason="sourmash CLI not available")
+def test_funcprofiler_many_resume_after_moving_cache(tmp_path, metagenome, ko_sketch):
+    shutil.copyfile(metagenome, tmp_path / "a.fastq")
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{tmp_path / 'a.fastq'},{tmp_path / 'a.csv'}\n")
+    cmd = [sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10", str(filelist), "50", "--resume"]
+
+    subprocess.run(cmd + ["--cache_dir", str(tmp_path / "cache")], check=True, capture_output=True)
+    # the cache location does not change the outputs
+    res = subprocess.run(cmd + ["--cache_dir", str(tmp_path / "moved_cache")], check=True, capture_output=True, text=True)
+    assert "1 of 1 samples are up to date" in res.stdout
@@ -0,0 +1,182 @@
+"""
+Unit tests for fmhfunprofiler.cluster, the array-job backend of funcprofiler-many.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from fmhfunprofiler import cluster, cohort
+
+
+def _run_many(*args, env=None):
+    return subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", *args],
+                          capture_output=True, text=True, env=env)
+
+
+@pytest.fixture
+def cohort_filelist(tmp_path, metagenome):
+    """A file list of four copies of the metagenome, with sample ids."""
+    lines = []
+    for name in ("a", "b", "c", "d"):
+        shutil.copyfile(metagenome, tmp_path / f"{name}.fastq")
+        lines.append(f"{tmp_path / name}.fastq,{name}\n")
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("".join(lines))
+    return filelist
+
+
+# ---------------------------------------------------------------------------
+# shards
+# ---------------------------------------------------------------------------
+
+def test_shard_samples_balances_sizes(tmp_path):
+    samples = []
+    for name, size in [("a", 100), ("b", 10), ("c", 60), ("d", 50)]:
+        (tmp_path / name).write_bytes(b"x" * size)
+        samples.append((str(tmp_path / name), name))
+    shards = cluster.shard_samples(samples, 2)
+    assert [[sample_id for _, sample_id in shard] for shard in shards] == [["a", "b"], ["c", "d"]]
+    # never more shards than samples
+    assert len(cluster.shard_samples(samples, 10)) == 4
+
+
+def test_prepare_shards_refuses_other_shards(tmp_path):
+    workdir = str(tmp_path / "work")
+    samples = [(str(tmp_path / "a.fastq"), "a"), (str(tmp_path / "b.fastq"), "b")]
+    (tmp_path / "a.fastq").write_bytes(b"x" * 100)
+    (tmp_path / "b.fastq").write_bytes(b"x" * 10)
+    assert cluster.prepare_shards(workdir, samples, 2) == [[samples[0]], [samples[1]]]
+    assert cluster.read_shard(workdir, 1) == [[str(tmp_path / "b.fastq"), "b"]]
+    # the same samples again are accepted, in any order
+    assert cluster.prepare_shards(workdir, samples[::-1], 2) == [[samples[0]], [samples[1]]]
+    with pytest.raises(SystemExit):
+        cluster.prepare_shards(workdir, samples, 1)
+    with pytest.raises(SystemExit):
+        cluster.prepare_shards(workdir, samples + [(str(tmp_path / "c.fastq"), "c")], 2)
+
+
+def test_prepare_shards_of_missing_inputs(tmp_path):
+    # missing inputs all weigh 0, and go to the first shard
+    samples = [("a.fastq", "a"), ("b.fastq", "b")]
+    workdir = str(tmp_path / "work")
+    assert cluster.prepare_shards(workdir, samples, 2) == [samples, []]
+    assert cluster.prepare_shards(workdir, samples, 2) == [samples, []]
+
+
+def test_prepare_shards_keeps_assignment_when_sizes_change(tmp_path):
+    samples = []
+    for name, size in [("a", 100), ("b", 10), ("c", 60), ("d", 50)]:
+        (tmp_path / name).write_bytes(b"x" * size)
+        samples.append((str(tmp_path / name), name))
+    workdir = str(tmp_path / "work")
+    shards = cluster.prepare_shards(workdir, samples, 2)
+    (tmp_path / "a").unlink()
+    (tmp_path / "b").write_bytes(b"x" * 1000)
+    assert cluster.shard_samples(samples, 2) != shards
+    assert cluster.prepare_shards(workdir, samples, 2) == shards
+
+
+def test_array_script(tmp_path):
+    script = cluster.array_script(str(tmp_path), ["ko.sig.zip", "7", "10", "50", "-j", "2"], matrix=True,
+                                  sbatch_options=["--time=1:00:00"])
+    assert script.startswith("#!/bin/bash\n")
+    assert "#SBATCH --time=1:00:00" in script
+    assert "shard_${SLURM_ARRAY_TASK_ID}.csv 50 -j 2 --matrix" in script
+    assert f"touch {tmp_path}/done/shard_${{SLURM_ARRAY_TASK_ID}}.done" in script
+
+
+def test_merge_matrices():
+    part_1 = (["K1", "K3"], ["s1"], cohort.build_matrix([{"K1": 0.5, "K3": 0.5}])[1])
+    part_2 = (["K2"], ["s2"], cohort.build_matrix([{"K2": 1.0}])[1])
+    ko_ids, sample_ids, matrix = cohort.merge_matrices([part_1, part_2], sample_order=["s2", "s0", "s1"])
+    assert ko_ids == ["K1", "K2", "K3"]
+    assert sample_ids == ["s2", "s1"]
+    assert matrix.toarray().tolist() == [[0, 0.5], [1.0, 0], [0, 0.5]]
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler-many --backend
+# ---------------------------------------------------------------------------
+
+def test_local_backend_matches_single_run(tmp_path, ko_sketch, cohort_filelist):
+    workdir = tmp_path / "work"
+    sharded = tmp_path / "sharded.npz"
+    res = _run_many(ko_sketch, "7", "10", str(cohort_filelist), "50", "--matrix", str(sharded), "-j", "1",
+                    "--backend", "local", "--shards", "3", "--workdir", str(workdir), "--metrics", str(tmp_path / "metrics.jsonl"))
+    assert res.returncode == 0, res.stdout + res.stderr
+    assert sorted(os.listdir(workdir / "done")) == ["shard_0.done", "shard_1.done", "shard_2.done"]
+
+    single = tmp_path / "single.npz"
+    _run_many(ko_sketch, "7", "10", str(cohort_filelist), "50", "--matrix", str(single), "-j", "1")
+    ko_ids, sample_ids, matrix = cohort.load_matrix_npz(str(sharded))
+    expected_ko_ids, expected_sample_ids, expected = cohort.load_matrix_npz(str(single))
+    assert (ko_ids, sample_ids) == (expected_ko_ids, expected_sample_ids) == (ko_ids, ["a", "b", "c", "d"])
+    assert np.allclose(matrix.toarray(), expected.toarray())
+    assert "profile" in (tmp_path / "metrics.jsonl").read_text()
+
+    # a second run only merges
+    res = _run_many(ko_sketch, "7", "10", str(cohort_filelist), "50", "--matrix", str(sharded), "-j", "1",
+                    "--backend", "local", "--shards", "3", "--workdir", str(workdir))
+    assert res.returncode == 0
+    assert "shards to run" not in res.stdout
+
+
+def test_local_backend_merges_after_input_removed(tmp_path, ko_sketch, cohort_filelist):
+    workdir = tmp_path / "work"
+    args = [ko_sketch, "7", "10", str(cohort_filelist), "50", "--matrix", str(tmp_path / "m.npz"), "-j", "1",
+            "--backend", "local", "--shards", "3", "--workdir", str(workdir)]
+    res = _run_many(*args)
+    assert res.returncode == 0, res.stdout + res.stderr
+    shards = [cluster.read_shard(str(workdir), shard) for shard in range(3)]
+
+    # the input of a done shard is removed from scratch storage: the shards are kept, and merged
+    (tmp_path / "a.fastq").unlink()
+    res = _run_many(*args)
+    assert res.returncode == 0, res.stdout + res.stderr
+    assert "All the 3 shards are done" in res.stdout
+    assert [cluster.read_shard(str(workdir), shard) for shard in range(3)] == shards
+    assert cohort.load_matrix_npz(str(tmp_path / "m.npz"))[1] == ["a", "b", "c", "d"]
+
+
+def test_local_backend_reruns_failed_shards(tmp_path, ko_sketch, metagenome):
+    filelist = tmp_path / "files.csv"
+    missing = tmp_path / "late.fastq"
+    filelist.write_text(f"{metagenome},a\n{missing},b\n")
+    workdir = tmp_path / "work"
+    args = [ko_sketch, "7", "10", str(filelist), "50", "--matrix", str(tmp_path / "m.npz"), "-j", "1",
+            "--backend", "local", "--shards", "2", "--workdir", str(workdir)]
+    res = _run_many(*args)
+    assert res.returncode == 1
+    assert len(os.listdir(workdir / "done")) == 1
+
+    # the file appears: only the failed shard runs again
+    shutil.copyfile(metagenome, missing)
+    done_before = set(os.listdir(workdir / "done"))
+    res = _run_many(*args)
+    assert res.returncode == 0, res.stdout
+    assert "1 of 2 shards to run" in res.stdout
+    assert len(os.listdir(workdir / "done")) == 2 and done_before < set(os.listdir(workdir / "done"))
+
+
+def test_slurm_backend_submits_pending_shards(tmp_path, ko_sketch, cohort_filelist):
+    # a fake sbatch that records its arguments
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    sbatch = bin_dir / "sbatch"
+    sbatch.write_text(f"#!/bin/sh\necho \"$@\" > {tmp_path / 'sbatch_args'}\necho Submitted batch job 42\n")
+    sbatch.chmod(0o755)
+    env = {**os.environ, "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}"}
+
+    workdir = tmp_path / "work"
+    (workdir / "done").mkdir(parents=True)
+    (workdir / "done" / "shard_1.done").touch()
+    res = _run_many(ko_sketch, "7", "10", str(cohort_filelist), "50", "--matrix", str(tmp_path / "m.npz"),
+                    "--backend", "slurm", "--shards", "3", "--workdir", str(workdir), env=env)
+    assert res.returncode == 0, res.stdout + res.stderr
+    assert "Submitted batch job 42" in res.stdout
+    assert (tmp_path / "sbatch_args").read_text().split() == ["--array=0,2", str(workdir / cluster.SCRIPT_NAME)]
@@ -0,0 +1,103 @@
+"""
+Unit tests for fmhfunprofiler.cohort, the KO x sample matrix of a cohort.
+"""
+
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+from fmhfunprofiler import cohort, engine, server
+
+
+# ---------------------------------------------------------------------------
+# matrix
+# ---------------------------------------------------------------------------
+
+def test_ko_abundances():
+    df = pd.DataFrame({"match_name": ["K1", "K2"], "f_match_query": [0.3, 0.1]})
+    assert cohort.ko_abundances(df) == pytest.approx({"K1": 0.75, "K2": 0.25})
+    assert cohort.ko_abundances(df.iloc[:0]) == {}
+
+
+def test_build_matrix():
+    ko_ids, matrix = cohort.build_matrix([{"K2": 0.5, "K1": 0.5}, {}, {"K3": 1.0}])
+    assert ko_ids == ["K1", "K2", "K3"]
+    assert matrix.shape == (3, 3)
+    assert matrix.toarray().tolist() == [[0.5, 0, 0], [0.5, 0, 0], [0, 0, 1.0]]
+
+
+def test_npz_round_trip(tmp_path):
+    ko_ids, matrix = cohort.build_matrix([{"K1": 1.0}, {"K1": 0.25, "K2": 0.75}])
+    filename = str(tmp_path / "matrix.npz")
+    cohort.save_matrix(filename, ko_ids, ["s1", "s2"], matrix)
+
+    # readable with scipy alone
+    assert (scipy.sparse.load_npz(filename).toarray() == matrix.toarray()).all()
+    loaded_ko_ids, sample_ids, loaded = cohort.load_matrix_npz(filename)
+    assert loaded_ko_ids == ["K1", "K2"]
+    assert sample_ids == ["s1", "s2"]
+    assert (loaded.toarray() == matrix.toarray()).all()
+
+
+def test_biom_output(tmp_path):
+    biom = pytest.importorskip("biom")
+    ko_ids, matrix = cohort.build_matrix([{"K1": 1.0}, {"K1": 0.25, "K2": 0.75}])
+    filename = str(tmp_path / "matrix.biom")
+    cohort.save_matrix(filename, ko_ids, ["s1", "s2"], matrix)
+    table = biom.load_table(filename)
+    assert list(table.ids(axis="observation")) == ["K1", "K2"]
+    assert list(table.ids(axis="sample")) == ["s1", "s2"]
+
+
+# ---------------------------------------------------------------------------
+# profile_cohort
+# ---------------------------------------------------------------------------
+
+def test_profile_cohort_matches_single_samples(tmp_path, metagenome, ko_sketch):
+    copy = str(tmp_path / "copy.fastq")
+    shutil.copyfile(metagenome, copy)
+    ko_database = server.KODatabase(ko_sketch, 7, 10)
+    samples = [(metagenome, "a"), (str(tmp_path / "missing.fastq"), "b"), (copy, "c")]
+    ko_ids, sample_ids, matrix, failed = cohort.profile_cohort(samples, ko_database, 50, n_workers=2)
+
+    assert sample_ids == ["a", "c"]
+    assert failed == [(str(tmp_path / "missing.fastq"), "b")]
+    expected = cohort.ko_abundances(ko_database.prefetch(engine.sketch_metagenome(metagenome, 7, 10), 50))
+    assert ko_ids == sorted(expected)
+    dense = matrix.toarray()
+    assert np.allclose(dense[:, 0], [expected[ko_id] for ko_id in ko_ids])
+    assert np.allclose(dense[:, 0], dense[:, 1])
+
+
+def test_funcprofiler_many_matrix(tmp_path, metagenome, ko_sketch):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{metagenome},sample_1\n")
+    output = tmp_path / "cohort.npz"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10",
+                    str(filelist), "50", "--matrix", str(output), "-j", "1"],
+                   check=True, capture_output=True)
+    ko_ids, sample_ids, matrix = cohort.load_matrix_npz(str(output))
+    assert sample_ids == ["sample_1"]
+    assert ko_ids == ["K00001", "K00002", "K00003", "K00004"]
+    assert matrix.sum() == pytest.approx(1.0)
+
+
+def test_funcprofiler_many_matrix_read_files_without_sample_id(tmp_path, metagenome, split_metagenome, ko_sketch):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{';'.join(split_metagenome)}\n")
+    output = tmp_path / "cohort.npz"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10",
+                    str(filelist), "50", "--matrix", str(output), "-j", "1"],
+                   check=True, capture_output=True)
+    ko_ids, sample_ids, matrix = cohort.load_matrix_npz(str(output))
+    # the sample is named after its first read file, and profiled from both
+    assert sample_ids == [split_metagenome[0].split("/")[-1]]
+    ko_database = server.KODatabase(ko_sketch, 7, 10)
+    expected = cohort.ko_abundances(ko_database.prefetch(engine.sketch_metagenome(metagenome, 7, 10), 50))
+    assert ko_ids == sorted(expected)
+    assert np.allclose(matrix.toarray()[:, 0], [expected[ko_id] for ko_id in ko_ids])
@@ -0,0 +1,124 @@
+"""
+Unit tests for fmhfunprofiler.distance, the pairwise distances between KO profiles.
+"""
+
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+from scipy.spatial.distance import cdist
+
+from fmhfunprofiler import cohort, distance
+
+
+def _random_samples(n_samples=23, n_kos=40, seed=0):
+    rng = np.random.default_rng(seed)
+    dense = rng.random((n_samples, n_kos)) * (rng.random((n_samples, n_kos)) < 0.3)
+    dense[dense.sum(axis=1) == 0, 0] = 1.0
+    return dense / dense.sum(axis=1, keepdims=True)
+
+
+def _weighted_jaccard(dense):
+    minima = np.minimum(dense[:, None, :], dense[None, :, :]).sum(axis=2)
+    maxima = np.maximum(dense[:, None, :], dense[None, :, :]).sum(axis=2)
+    return 1 - minima / maxima
+
+
+# ---------------------------------------------------------------------------
+# distances
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("block_size, processes", [(256, 1), (5, 1), (4, 3)])
+def test_braycurtis_equals_scipy(tmp_path, block_size, processes):
+    dense = _random_samples()
+    filename = str(tmp_path / "distances.npy")
+    distance.compute_distances(scipy.sparse.csr_matrix(dense), filename, 'braycurtis', block_size, processes)
+    assert np.allclose(np.load(filename), cdist(dense, dense, 'braycurtis'))
+
+
+@pytest.mark.parametrize("block_size, processes", [(256, 1), (4, 2)])
+def test_weighted_jaccard(tmp_path, block_size, processes):
+    dense = _random_samples(seed=1)
+    filename = str(tmp_path / "distances.npy")
+    distance.compute_distances(scipy.sparse.csr_matrix(dense), filename, 'weighted_jaccard', block_size, processes)
+    assert np.allclose(np.load(filename), _weighted_jaccard(dense))
+
+
+def test_sum_of_minima_of_two_blocks():
+    dense = _random_samples(n_kos=150)
+    a, b = dense[:9], dense[9:]
+    expected = np.minimum(a[:, None, :], b[None, :, :]).sum(axis=2)
+    assert np.allclose(distance.sum_of_minima(scipy.sparse.csr_matrix(a), scipy.sparse.csr_matrix(b)), expected)
+
+
+def test_empty_profiles():
+    samples = scipy.sparse.csr_matrix(np.array([[0.0, 0.0], [0.5, 0.5], [0.0, 0.0]]))
+    for name in distance.DISTANCES:
+        block = distance.block_distances(samples, np.arange(3), np.arange(3), name)
+        assert block.tolist() == [[0.0, 1.0, 0.0], [1.0, 0.0, 1.0], [0.0, 1.0, 0.0]]
+
+
+# ---------------------------------------------------------------------------
+# inputs and outputs
+# ---------------------------------------------------------------------------
+
+def _write_profiles(tmp_path, dense):
+    rows = []
+    for i, profile in enumerate(dense):
+        filename = tmp_path / f"sample_{i}.csv"
+        kos = np.flatnonzero(profile)
+        pd.DataFrame({"ko_id": [f"K{ko:05d}" for ko in kos], "abundance": profile[kos]}).to_csv(filename, index=False)
+        rows.append((str(filename), f"s{i}"))
+    filelist = tmp_path / "profiles.csv"
+    pd.DataFrame(rows).to_csv(filelist, header=False, index=False)
+    return str(filelist)
+
+
+def test_profiles_and_matrix_inputs_agree(tmp_path):
+    dense = _random_samples(n_samples=6)
+    filelist = _write_profiles(tmp_path, dense)
+    sample_ids, samples = distance.load_samples(filelist)
+    assert sample_ids == [f"s{i}" for i in range(6)]
+
+    matrix_filename = str(tmp_path / "cohort.npz")
+    ko_ids = [f"K{ko:05d}" for ko in range(dense.shape[1])]
+    cohort.save_matrix(matrix_filename, ko_ids, sample_ids, scipy.sparse.csr_matrix(dense.T))
+    matrix_ids, matrix_samples = distance.load_samples(matrix_filename)
+    assert matrix_ids == sample_ids
+    for name in distance.DISTANCES:
+        assert np.allclose(distance.block_distances(samples, np.arange(6), np.arange(6), name),
+                           distance.block_distances(matrix_samples, np.arange(6), np.arange(6), name))
+
+
+def test_funcprofiler_distance_command(tmp_path):
+    dense = _random_samples(n_samples=9)
+    filelist = _write_profiles(tmp_path, dense)
+    output = str(tmp_path / "distances.npy")
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.distance", filelist, output, "--block_size", "4", "-j", "2"],
+                   check=True, capture_output=True)
+    sample_ids, distances = distance.load_distance_matrix(output)
+    assert isinstance(distances, np.memmap)
+    assert sample_ids == [f"s{i}" for i in range(9)]
+    assert np.allclose(distances, cdist(dense, dense, 'braycurtis'))
+    assert [path.name for path in tmp_path.iterdir() if path.name.startswith(".tmp_")] == []
+
+
+def test_read_filelist(tmp_path):
+    filelist = tmp_path / "profiles.csv"
+    filelist.write_text("a/ko_profiles.csv,s1\nb/ko_profiles.csv\n")
+    assert distance.read_filelist(str(filelist)) == [("a/ko_profiles.csv", "s1"), ("b/ko_profiles.csv", "ko_profiles.csv")]
+    filelist.write_text("a/ko_profiles.csv,s1,extra\n")
+    with pytest.raises(SystemExit):
+        distance.read_filelist(str(filelist))
+
+
+def test_check_args_output_not_npy(tmp_path, monkeypatch):
+    filelist = tmp_path / "profiles.csv"
+    filelist.write_text("")
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-distance", str(filelist), str(tmp_path / "distances.csv")])
+    with pytest.raises(SystemExit) as exc:
+        distance.check_args(distance.parse_args())
+    assert exc.value.code == 1
@@ -0,0 +1,134 @@
+"""
+Unit tests for fmhfunprofiler.engine, the in-process sketching and prefetch engine.
+"""
+
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fmhfunprofiler import engine
+
+
+# ---------------------------------------------------------------------------
+# sketching and loading
+# ---------------------------------------------------------------------------
+
+def test_sketch_metagenome(metagenome):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    assert mh.ksize == 7
+    assert mh.scaled == 10
+    assert mh.moltype == "protein"
+    assert mh.track_abundance
+    assert len(mh) > 0
+
+
+def test_load_ko_sketches_selects_ksize_and_downsamples(ko_sketch):
+    ko_sigs = engine.load_ko_sketches(ko_sketch, 11, 10)
+    assert len(ko_sigs) == 8
+    assert all(sig.minhash.ksize == 11 for sig in ko_sigs)
+    assert all(sig.minhash.scaled == 10 for sig in ko_sigs)
+
+
+def test_debiased_containment_is_clipped():
+    values = engine.debiased_containment([0, 5, 10], [10, 10, 10], 1)
+    assert np.allclose(values, [0.0, 0.5, 1.0])
+    assert engine.debiased_containment([0], [0], 10)[0] == 0.0
+
+
+# ---------------------------------------------------------------------------
+# prefetch
+# ---------------------------------------------------------------------------
+
+def test_prefetch_finds_sampled_kos(metagenome, ko_sketch):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    ko_sigs = engine.load_ko_sketches(ko_sketch, 7, 10)
+    df = engine.prefetch(mh, ko_sigs, 7, 10, threshold_bp=50)
+    assert list(df.columns) == engine.PREFETCH_COLUMNS
+    assert sorted(df["match_name"]) == ["K00001", "K00002", "K00003", "K00004"]
+    assert (df["intersect_bp"] >= 50).all()
+
+
+def test_prefetch_unattainable_threshold_is_empty(metagenome, ko_sketch):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    ko_sigs = engine.load_ko_sketches(ko_sketch, 7, 10)
+    df = engine.prefetch(mh, ko_sigs, 7, 10, threshold_bp=10**9)
+    assert len(df) == 0
+    assert list(df.columns) == engine.PREFETCH_COLUMNS
+
+
+def test_prefetch_thresholds_equal_separate_runs(metagenome, ko_sketch):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    ko_sigs = engine.load_ko_sketches(ko_sketch, 7, 10)
+    tables = engine.prefetch_thresholds(mh, ko_sigs, 7, 10, [50, 500, 10**9])
+    assert list(tables) == [50, 500, 10**9]
+    for threshold_bp, df in tables.items():
+        pd.testing.assert_frame_equal(df, engine.prefetch(mh, ko_sigs, 7, 10, threshold_bp))
+    assert len(tables[10**9]) == 0
+
+
+def test_count_shared_abundances():
+    query_hashes = np.array([2, 5, 9], dtype=np.uint64)
+    query_abunds = np.array([1, 10, 100], dtype=np.int64)
+    ko_hashes = [np.array([5, 9], dtype=np.uint64), np.array([1, 3], dtype=np.uint64), np.array([2, 9, 11], dtype=np.uint64)]
+    n_common, sum_abund = engine.count_shared_abundances(query_hashes, query_abunds, ko_hashes)
+    assert n_common.tolist() == [2, 0, 2]
+    assert sum_abund.tolist() == [110, 0, 101]
+
+
+def test_prefetch_weighted_sums_multiplicities(metagenome, ko_sketch):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    ko_sigs = engine.load_ko_sketches(ko_sketch, 7, 10)
+    df = engine.prefetch(mh, ko_sigs, 7, 10, threshold_bp=50, weighted=True)
+    unweighted = engine.prefetch(mh, ko_sigs, 7, 10, threshold_bp=50)
+    assert list(df.columns) == engine.PREFETCH_COLUMNS + engine.WEIGHTED_COLUMNS
+    pd.testing.assert_frame_equal(df[engine.PREFETCH_COLUMNS].drop(columns="query_abundance"),
+                                  unweighted.drop(columns="query_abundance"))
+
+    abunds = mh.hashes
+    for sig in ko_sigs:
+        row = df[df["match_name"] == sig.name]
+        if len(row):
+            expected = sum(abunds.get(h, 0) for h in sig.minhash.hashes)
+            assert row["sum_abund"].iloc[0] == expected
+    assert (df["average_abund"] >= 1).all()
+
+
+@pytest.mark.skipif(shutil.which("sourmash") is None, reason="sourmash CLI not available")
+def test_prefetch_matches_sourmash_cli(tmp_path, metagenome, ko_sketch):
+    """The in-process prefetch has the columns of `sourmash prefetch`, with the same values."""
+    sketch = str(tmp_path / "sample.sig.zip")
+    cli_out = str(tmp_path / "prefetch.csv")
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    engine.save_sketch(mh, metagenome, sketch)
+    subprocess.run(["sourmash", "prefetch", sketch, ko_sketch, "-o", cli_out, "-k", "7",
+                    "--scaled", "10", "--protein", "--threshold-bp", "50"],
+                   check=True, capture_output=True)
+    expected = pd.read_csv(cli_out)
+
+    df = engine.prefetch(mh, engine.load_ko_sketches(ko_sketch, 7, 10), 7, 10, threshold_bp=50)
+    assert list(df.columns) == list(expected.columns)
+    columns = ["f_match_query", "f_query_match", "query_containment_ani", "match_containment_ani",
+               "average_containment_ani", "max_containment_ani", "potential_false_negative"]
+    pd.testing.assert_frame_equal(df.set_index("match_name")[columns].sort_index(),
+                                  expected.set_index("match_name")[columns].sort_index(), check_dtype=False)
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler --in_process
+# ---------------------------------------------------------------------------
+
+def test_funcprofiler_in_process(tmp_path, metagenome, ko_sketch):
+    output = tmp_path / "ko_profiles.csv"
+    prefetch_out = tmp_path / "prefetch.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(output), "-t", "50", "-p", str(prefetch_out), "--in_process"],
+                   check=True, capture_output=True)
+    df = pd.read_csv(output)
+    assert list(df.columns) == ["ko_id", "abundance"]
+    assert df["abundance"].sum() == pytest.approx(1.0)
+    assert sorted(df["ko_id"]) == ["K00001", "K00002", "K00003", "K00004"]
+    assert prefetch_out.exists()
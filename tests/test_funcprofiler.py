@@ -2,26 +2,54 @@
 Unit tests for fmh_funprofiler.funcprofiler.
 
 Tests focus on argument validation (check_args) and argument parsing (parse_args),
-which are the testable units that do not require sourmash or real sketch files.
+which are the testable units that do not require sourmash or real sketch files. The
+options that change what the command writes are checked end to end, on the small
+test metagenome and KO sketch.
 """
 
 import argparse
+import importlib.util
+import os
+import shutil
+import subprocess
 import sys
 
+import pandas as pd
 import pytest
 
-from fmhfunprofiler.funcprofiler import check_args, parse_args
+from fmhfunprofiler import funcprofiler
+from fmhfunprofiler.funcprofiler import check_args, combination_filename, parse_args, read_prefetch_weights, sanity_check, write_ko_profiles
 
 
-def _make_args(mg_filename, ko_sketch, ksize=11, scaled=1000, threshold_bp=1000):
+def _make_args(mg_filename, ko_sketch, ksize=11, scaled=1000, threshold_bp=1000, processes=1, cache_max_size=None,
+               ksizes=None, thresholds=None, index=False, em_tolerance=1e-6, em_max_iterations=1000, output='ko_profiles.csv',
+               prefilter=False, cache=False, scaled_values=None, ko_subset=None, pipe=False, scratch_dir=None):
     """Return a Namespace that mirrors what parse_args() would produce."""
     return argparse.Namespace(
         mg_filename=mg_filename,
         ko_sketch=ko_sketch,
         ksize=ksize,
         scaled=scaled,
+        output=output,
         threshold_bp=threshold_bp,
         prefetch_file=None,
+        processes=processes,
+        cache_max_size=cache_max_size,
+        ksizes=ksizes,
+        scaled_values=scaled_values,
+        thresholds=thresholds,
+        index=index,
+        em_tolerance=em_tolerance,
+        em_max_iterations=em_max_iterations,
+        prefilter=prefilter,
+        cache=cache,
+        cache_dir=None,
+        ko_subset=ko_subset,
+        pipe=pipe,
+        scratch_dir=scratch_dir,
+        in_process=False,
+        abundance_weighted=False,
+        reassign=None,
     )
 
 
@@ -129,6 +157,165 @@ def test_check_args_invalid_threshold_bp(tmp_path, threshold_bp):
     assert exc.value.code == 1
 
 
+# ---------------------------------------------------------------------------
+# check_args – processes and cache size validation
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("processes", [0, -1])
+def test_check_args_invalid_processes(tmp_path, processes):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ref.sig.zip"
+    mg.write_bytes(b"")
+    ko.write_bytes(b"")
+    args = _make_args(mg_filename=str(mg), ko_sketch=str(ko), processes=processes)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+@pytest.mark.parametrize("cache_max_size", ["lots", "-1G", "G"])
+def test_check_args_invalid_cache_max_size(tmp_path, cache_max_size):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ref.sig.zip"
+    mg.write_bytes(b"")
+    ko.write_bytes(b"")
+    args = _make_args(mg_filename=str(mg), ko_sketch=str(ko), cache_max_size=cache_max_size)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+@pytest.mark.parametrize("ksizes, thresholds, index", [
+    ([7, 10], None, False),
+    ([], None, False),
+    (None, [100, 0], False),
+    ([7, 11], None, True),
+])
+def test_check_args_invalid_lists(tmp_path, ksizes, thresholds, index):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ref.sig.zip"
+    mg.write_bytes(b"")
+    ko.write_bytes(b"")
+    args = _make_args(mg_filename=str(mg), ko_sketch=str(ko), ksizes=ksizes, thresholds=thresholds, index=index)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+def test_check_args_valid_lists(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ref.sig.zip"
+    mg.write_bytes(b"")
+    ko.write_bytes(b"")
+    args = _make_args(mg_filename=str(mg), ko_sketch=str(ko), ksizes=[7, 11, 15], thresholds=[100, 500, 1000])
+    assert check_args(args) is True
+
+
+@pytest.mark.parametrize("scaled_values, index", [
+    ([10, 0], False),
+    ([], False),
+    ([10, 100], True),
+])
+def test_check_args_invalid_scaled_values(tmp_path, scaled_values, index):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ref.sig.zip"
+    mg.write_bytes(b"")
+    ko.write_bytes(b"")
+    args = _make_args(mg_filename=str(mg), ko_sketch=str(ko), scaled_values=scaled_values, index=index)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+def test_check_args_scaled_placeholder(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    mg.write_bytes(b"")
+    (tmp_path / "ko_10.idx").write_bytes(b"")
+    ko = str(tmp_path / "ko_{scaled}.idx")
+    assert check_args(_make_args(mg_filename=str(mg), ko_sketch=ko, scaled_values=[10], index=True)) is True
+    # the KO index of scaled 100 is missing
+    with pytest.raises(SystemExit):
+        check_args(_make_args(mg_filename=str(mg), ko_sketch=ko, scaled_values=[10, 100], index=True))
+
+
+def test_check_args_prefilter_with_cache(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ko.sig.zip"
+    mg.write_text("")
+    ko.write_bytes(b"")
+    with pytest.raises(SystemExit):
+        check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), prefilter=True, cache=True))
+
+
+def test_check_args_pipe(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ko.sig.zip"
+    mg.write_text("")
+    ko.write_bytes(b"")
+    assert check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), pipe=True)) is True
+    for options in [{"cache": True}, {"index": True}, {"thresholds": [50, 100]}]:
+        with pytest.raises(SystemExit):
+            check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), pipe=True, **options))
+
+
+def test_check_args_scratch_dir(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ko.sig.zip"
+    mg.write_text("")
+    ko.write_bytes(b"")
+    assert check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), scratch_dir=str(tmp_path))) is True
+    for options in [{"index": True}, {"thresholds": [50, 100]}]:
+        with pytest.raises(SystemExit):
+            check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), scratch_dir=str(tmp_path), **options))
+
+
+def test_check_args_ko_subset(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ko.sig.zip"
+    mg.write_text("")
+    ko.write_bytes(b"")
+    panel = tmp_path / "panel.txt"
+    with pytest.raises(SystemExit):
+        check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), ko_subset=str(panel)))
+    panel.write_text("# an empty panel\n")
+    with pytest.raises(SystemExit):
+        check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), ko_subset=str(panel)))
+    panel.write_text("K00001\n")
+    assert check_args(_make_args(mg_filename=str(mg), ko_sketch=str(ko), ko_subset=str(panel))) is True
+
+
+# ---------------------------------------------------------------------------
+# sanity_check
+# ---------------------------------------------------------------------------
+
+def _no_subprocess(*args, **kwargs):
+    raise AssertionError("sanity_check started a process")
+
+
+def test_sanity_check_runs_no_process(monkeypatch):
+    monkeypatch.setattr(funcprofiler.subprocess, "call", _no_subprocess)
+    monkeypatch.setattr(funcprofiler.subprocess, "run", _no_subprocess)
+    funcprofiler.command_available.cache_clear()
+    sanity_check(require_cli=True)
+    sanity_check(require_cli=False)
+    assert funcprofiler.command_available.cache_info().hits == 0
+    sanity_check(require_cli=True)
+    assert funcprofiler.command_available.cache_info().hits == 1
+
+
+def test_sanity_check_missing_cli(monkeypatch):
+    monkeypatch.setenv("PATH", "")
+    funcprofiler.command_available.cache_clear()
+    try:
+        with pytest.raises(SystemExit) as exc:
+            sanity_check(require_cli=True)
+        assert exc.value.code == 1
+        # the in-process engine only needs the Python package
+        sanity_check(require_cli=False)
+    finally:
+        funcprofiler.command_available.cache_clear()
+
+
 # ---------------------------------------------------------------------------
 # parse_args
 # ---------------------------------------------------------------------------
@@ -165,3 +352,225 @@ def test_parse_args_optional_prefetch(tmp_path, monkeypatch):
     )
     args = parse_args()
     assert args.prefetch_file == "prefetch.csv"
+
+
+def test_parse_args_skip_checks(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["funcprofiler", "sample.fastq", "ref.sig.zip", "11", "1000", "out.csv"])
+    assert parse_args().skip_checks is False
+    monkeypatch.setattr(sys, "argv", ["funcprofiler", "sample.fastq", "ref.sig.zip", "11", "1000", "out.csv", "--skip_checks"])
+    assert parse_args().skip_checks is True
+
+
+def test_parse_args_ksizes_and_thresholds(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        sys, "argv",
+        ["funcprofiler", "sample.fastq", "ref.sig.zip", "11", "1000", "out.csv", "--ksizes", "7,11,15", "--thresholds", "100,500"],
+    )
+    args = parse_args()
+    assert args.ksizes == [7, 11, 15]
+    assert args.thresholds == [100, 500]
+
+
+# ---------------------------------------------------------------------------
+# KO profile output
+# ---------------------------------------------------------------------------
+
+def _write_prefetch(path):
+    pd.DataFrame({
+        "intersect_bp": [30, 10, 60],
+        "match_name": ["K00001", "K00002", "K00003"],
+        "match_md5": ["a" * 32, "b" * 32, "c" * 32],
+        "f_match_query": [0.3, 0.1, 0.6],
+        "query_filename": ["sample.fastq"] * 3,
+    }).to_csv(path, index=False)
+
+
+def test_read_prefetch_weights_parses_two_columns(tmp_path):
+    prefetch = tmp_path / "prefetch.csv"
+    _write_prefetch(prefetch)
+    df = read_prefetch_weights(str(prefetch))
+    assert list(df.columns) == ["match_name", "f_match_query"]
+    assert df["match_name"].tolist() == ["K00001", "K00002", "K00003"]
+    assert df["f_match_query"].tolist() == pytest.approx([0.3, 0.1, 0.6])
+
+
+def test_read_prefetch_weights_header_only(tmp_path):
+    prefetch = tmp_path / "prefetch.csv"
+    prefetch.write_text("intersect_bp,match_name,f_match_query\n")
+    assert len(read_prefetch_weights(str(prefetch))) == 0
+
+
+def test_write_ko_profiles_compressed(tmp_path):
+    prefetch = tmp_path / "prefetch.csv"
+    _write_prefetch(prefetch)
+    output = str(tmp_path / "ko_profiles.csv.gz")
+    write_ko_profiles(read_prefetch_weights(str(prefetch)), output)
+    with open(output, "rb") as fp:
+        assert fp.read(2) == b"\x1f\x8b"
+    profile = pd.read_csv(output)
+    assert list(profile.columns) == ["ko_id", "abundance"]
+    assert profile["abundance"].tolist() == pytest.approx([0.3, 0.1, 0.6])
+
+
+def test_write_ko_profiles_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    prefetch = tmp_path / "prefetch.csv"
+    _write_prefetch(prefetch)
+    output = str(tmp_path / "ko_profiles.parquet")
+    write_ko_profiles(read_prefetch_weights(str(prefetch)), output)
+    assert pd.read_parquet(output)["ko_id"].tolist() == ["K00001", "K00002", "K00003"]
+
+
+@pytest.mark.skipif(importlib.util.find_spec("pyarrow") is not None, reason="pyarrow is installed")
+def test_check_args_parquet_without_pyarrow(tmp_path):
+    mg = tmp_path / "sample.fastq"
+    ko = tmp_path / "ko.sig.zip"
+    mg.write_text("")
+    ko.write_bytes(b"")
+    args = _make_args(mg_filename=str(mg), ko_sketch=str(ko), output=str(tmp_path / "ko_profiles.parquet"))
+    with pytest.raises(SystemExit):
+        check_args(args)
+
+
+@pytest.mark.parametrize("filename, expected", [
+    ("out.csv", "out_k7_t50.csv"),
+    ("out.csv.gz", "out_k7_t50.csv.gz"),
+    ("out.parquet", "out_k7_t50.parquet"),
+    ("out.zst", "out_k7_t50.zst"),
+    ("dir.v2/out", "dir.v2/out_k7_t50"),
+    ("out.txt", "out_k7_t50.txt"),
+    ("out.v2", "out.v2_k7_t50"),
+])
+def test_combination_filename_keeps_extension(filename, expected):
+    assert combination_filename(filename, 7, 50, 2) == expected
+    assert combination_filename(filename, 7, 50, 1) == filename
+
+
+def test_combination_filename_with_scaled():
+    assert combination_filename("out.csv.bz2", 11, 100, 4, scaled=10) == "out_k11_s10_t100.csv.bz2"
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler options, end to end
+# ---------------------------------------------------------------------------
+
+def test_funcprofiler_ksizes_and_thresholds(tmp_path, metagenome, ko_sketch):
+    output = tmp_path / "ko_profiles.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(output), "--ksizes", "7,11", "--thresholds", "50,100"],
+                   check=True, capture_output=True)
+    for ksize in (7, 11):
+        for threshold_bp in (50, 100):
+            df = pd.read_csv(tmp_path / f"ko_profiles_k{ksize}_t{threshold_bp}.csv")
+            assert df["abundance"].sum() == pytest.approx(1.0)
+    assert not output.exists()
+
+
+@pytest.mark.parametrize("extension", [".csv.gz", ".parquet"])
+def test_funcprofiler_combinations_keep_format(tmp_path, metagenome, ko_sketch, extension):
+    if extension == ".parquet":
+        pytest.importorskip("pyarrow")
+    output = tmp_path / f"ko_profiles{extension}"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(output), "--thresholds", "50,100"],
+                   check=True, capture_output=True)
+    for threshold_bp in (50, 100):
+        combination = tmp_path / f"ko_profiles_k7_t{threshold_bp}{extension}"
+        if extension == ".parquet":
+            df = pd.read_parquet(combination)
+        else:
+            with open(combination, "rb") as fp:
+                assert fp.read(2) == b"\x1f\x8b"
+            df = pd.read_csv(combination)
+        assert df["abundance"].sum() == pytest.approx(1.0)
+
+
+def test_funcprofiler_scaled_values_equal_separate_runs(tmp_path, metagenome, ko_sketch):
+    # one KO sketch per scaled value, found through the {scaled} placeholder
+    for scaled in (10, 50):
+        shutil.copyfile(ko_sketch, tmp_path / f"ko_{scaled}.sig.zip")
+    output = tmp_path / "ko_profiles.csv"
+    prefetch_out = tmp_path / "prefetch.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, str(tmp_path / "ko_{scaled}.sig.zip"),
+                    "7", "10", str(output), "-t", "50", "-p", str(prefetch_out), "--scaled_values", "50,10"],
+                   check=True, capture_output=True)
+    assert not output.exists()
+    for scaled in (10, 50):
+        single = tmp_path / f"single_{scaled}.csv"
+        single_prefetch = tmp_path / f"single_prefetch_{scaled}.csv"
+        subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", str(scaled),
+                        str(single), "-t", "50", "-p", str(single_prefetch), "--in_process"],
+                       check=True, capture_output=True)
+        derived = pd.read_csv(tmp_path / f"ko_profiles_k7_s{scaled}_t50.csv")
+        pd.testing.assert_frame_equal(derived, pd.read_csv(single))
+        pd.testing.assert_frame_equal(pd.read_csv(tmp_path / f"prefetch_k7_s{scaled}_t50.csv"), pd.read_csv(single_prefetch))
+
+
+@pytest.mark.parametrize("extra", [[], ["--in_process"]])
+def test_funcprofiler_read_files_same_profile(tmp_path, metagenome, split_metagenome, ko_sketch, extra):
+    profiles = []
+    for name, mg_filename in [("whole", metagenome), ("split", ",".join(split_metagenome))]:
+        output = tmp_path / f"{name}.csv"
+        subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", mg_filename, ko_sketch, "7", "10",
+                        str(output), "-t", "50", *extra],
+                       check=True, capture_output=True)
+        profiles.append(pd.read_csv(output))
+    pd.testing.assert_frame_equal(profiles[0], profiles[1])
+
+
+def test_funcprofiler_ko_subset(tmp_path, metagenome, ko_sketch):
+    full = tmp_path / "full.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(full), "-t", "50", "--in_process"],
+                   check=True, capture_output=True)
+    panel = tmp_path / "panel.txt"
+    panel.write_text("K00001\nK00003\nK00008\n")
+    subset_dir = tmp_path / "subsets"
+    for _ in range(2):
+        output = tmp_path / "subset.csv"
+        subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                        str(output), "-t", "50", "--ko_subset", str(panel), "--subset_dir", str(subset_dir)],
+                       check=True, capture_output=True)
+        # the panel KOs, with their abundances renormalized over the panel
+        expected = pd.read_csv(full)
+        expected = expected[expected["ko_id"].isin(["K00001", "K00003", "K00008"])].reset_index(drop=True)
+        expected["abundance"] = expected["abundance"] / expected["abundance"].sum()
+        df = pd.read_csv(output)
+        assert df["ko_id"].tolist() == expected["ko_id"].tolist()
+        assert df["abundance"].tolist() == pytest.approx(expected["abundance"].tolist())
+    assert len(list(subset_dir.iterdir())) == 1
+
+
+@pytest.mark.skipif(shutil.which("sourmash") is None, reason="sourmash CLI not available")
+def test_funcprofiler_cli_leaves_no_intermediates(tmp_path, metagenome, ko_sketch):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    mg_filename = str(inputs / "sample.fastq")
+    shutil.copyfile(metagenome, mg_filename)
+    scratch_dir = tmp_path / "scratch"
+    profiles, prefetch_tables = [], []
+    for name, extra in [("files", []), ("pipe", ["--pipe"])]:
+        output = tmp_path / f"{name}.csv"
+        prefetch_out = tmp_path / f"prefetch_{name}.csv"
+        subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", mg_filename, ko_sketch, "7", "10",
+                        str(output), "-t", "50", "-p", str(prefetch_out), "--scratch_dir", str(scratch_dir), *extra],
+                       check=True, capture_output=True)
+        profiles.append(pd.read_csv(output))
+        prefetch_tables.append(pd.read_csv(prefetch_out)[["match_name", "f_match_query"]])
+    pd.testing.assert_frame_equal(profiles[0], profiles[1])
+    pd.testing.assert_frame_equal(prefetch_tables[0], prefetch_tables[1])
+    # the sketch and the prefetch table were not written next to the input, and the scratch directories are gone
+    assert os.listdir(inputs) == ["sample.fastq"]
+    assert os.listdir(scratch_dir) == []
+
+
+def test_funcprofiler_abundance_weighted(tmp_path, metagenome, ko_sketch):
+    output = tmp_path / "ko_profiles.csv"
+    prefetch_out = tmp_path / "prefetch.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(output), "-t", "50", "-p", str(prefetch_out), "--abundance_weighted"],
+                   check=True, capture_output=True)
+    df = pd.read_csv(output)
+    prefetch_df = pd.read_csv(prefetch_out)
+    expected = prefetch_df["sum_abund"] / prefetch_df["sum_abund"].sum()
+    assert df["abundance"].tolist() == pytest.approx(expected.tolist())
@@ -6,19 +6,43 @@ Tests cover argument validation (check_args) and argument parsing (parse_argumen
 
 import argparse
 import sys
+import threading
 
 import pytest
 
-from fmhfunprofiler.funcprofiler_many import check_args, parse_arguments
+from fmhfunprofiler.funcprofiler_many import (
+    check_args,
+    max_concurrent_jobs,
+    order_by_input_size,
+    parse_arguments,
+    read_filelist,
+    run_all,
+)
 
 
-def _make_args(ko_sketch, ksize=11, scaled=1000, threshold_bp=1000, filelist="files.csv"):
+def _make_args(ko_sketch, ksize=11, scaled=1000, threshold_bp=1000, filelist="files.csv", jobs=4, mem_per_job=None,
+               matrix=None, server=None, metrics=None, backend=None, shards=1, resume=False,
+               in_process=False, ko_subset=None, pipe=False, index=False, cache_dir=None, scratch_dir=None):
     return argparse.Namespace(
         ko_sketch=ko_sketch,
         ksize=ksize,
         scaled=scaled,
         threshold_bp=threshold_bp,
         filelist=filelist,
+        jobs=jobs,
+        mem_per_job=mem_per_job,
+        matrix=matrix,
+        server=server,
+        metrics=metrics,
+        backend=backend,
+        shards=shards,
+        resume=resume,
+        in_process=in_process,
+        ko_subset=ko_subset,
+        pipe=pipe,
+        index=index,
+        cache_dir=cache_dir,
+        scratch_dir=scratch_dir,
     )
 
 
@@ -106,6 +130,186 @@ def test_check_args_invalid_threshold_bp(tmp_path, threshold_bp):
     assert exc.value.code == 1
 
 
+# ---------------------------------------------------------------------------
+# check_args – scheduler options
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("jobs", [0, -2])
+def test_check_args_invalid_jobs(tmp_path, jobs):
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    args = _make_args(ko_sketch=str(ko), jobs=jobs)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+@pytest.mark.parametrize("mem_per_job", [0, -1.5])
+def test_check_args_invalid_mem_per_job(tmp_path, mem_per_job):
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    args = _make_args(ko_sketch=str(ko), mem_per_job=mem_per_job)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+@pytest.mark.parametrize("matrix, server", [(["cohort.csv"], None), (["cohort.npz"], "ko.sock")])
+def test_check_args_invalid_matrix(tmp_path, matrix, server):
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    args = _make_args(ko_sketch=str(ko), matrix=matrix, server=server)
+    with pytest.raises(SystemExit) as exc:
+        check_args(args)
+    assert exc.value.code == 1
+
+
+def test_check_args_ko_subset_with_server(tmp_path):
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    panel = tmp_path / "panel.txt"
+    panel.write_text("K00001\n")
+    assert check_args(_make_args(ko_sketch=str(ko), ko_subset=str(panel))) is True
+    with pytest.raises(SystemExit) as exc:
+        check_args(_make_args(ko_sketch=str(ko), ko_subset=str(panel), server="ko.sock"))
+    assert exc.value.code == 1
+
+
+@pytest.mark.parametrize("options", [{"in_process": True}, {"index": True}, {"cache_dir": "cache"}])
+def test_check_args_pipe(tmp_path, options):
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    assert check_args(_make_args(ko_sketch=str(ko), pipe=True)) is True
+    with pytest.raises(SystemExit) as exc:
+        check_args(_make_args(ko_sketch=str(ko), pipe=True, **options))
+    assert exc.value.code == 1
+
+
+@pytest.mark.parametrize("options", [{"in_process": True}, {"matrix": ["m.npz"]}, {"index": True}, {"server": "ko.sock"}])
+def test_check_args_scratch_dir(tmp_path, options):
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    assert check_args(_make_args(ko_sketch=str(ko), scratch_dir=str(tmp_path))) is True
+    with pytest.raises(SystemExit) as exc:
+        check_args(_make_args(ko_sketch=str(ko), scratch_dir=str(tmp_path), **options))
+    assert exc.value.code == 1
+
+
+# ---------------------------------------------------------------------------
+# scheduling
+# ---------------------------------------------------------------------------
+
+def test_read_filelist(tmp_path):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("a.fastq,a.csv\nb.fastq,b.csv\n")
+    assert read_filelist(str(filelist)) == [("a.fastq", "a.csv"), ("b.fastq", "b.csv")]
+
+
+def test_read_filelist_without_outputs(tmp_path):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("a.fastq\nb.fastq\n")
+    assert read_filelist(str(filelist)) == [("a.fastq", None), ("b.fastq", None)]
+
+
+def test_read_filelist_several_read_files(tmp_path):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text('a_R1.fastq;a_R2.fastq,a.csv\n"b_L1.fastq,b_L2.fastq",b.csv\nc.fastq,c.csv\n')
+    assert read_filelist(str(filelist)) == [("a_R1.fastq,a_R2.fastq", "a.csv"), ("b_L1.fastq,b_L2.fastq", "b.csv"),
+                                            ("c.fastq", "c.csv")]
+
+
+def test_read_filelist_several_read_files_without_sample_id(tmp_path):
+    # with --matrix, the second column is optional: the read files of a sample never take its place
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("r1.fastq;r2.fastq\nc.fastq\n")
+    assert read_filelist(str(filelist)) == [("r1.fastq,r2.fastq", None), ("c.fastq", None)]
+
+
+def test_read_filelist_too_many_columns(tmp_path):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("a_R1.fastq,a_R2.fastq,a.csv\n")
+    with pytest.raises(SystemExit) as exc:
+        read_filelist(str(filelist))
+    assert exc.value.code == 1
+
+
+def test_order_by_input_size(tmp_path):
+    small, large = tmp_path / "small.fastq", tmp_path / "large.fastq"
+    small.write_bytes(b"x" * 10)
+    large.write_bytes(b"x" * 1000)
+    samples = [(str(small), "s.csv"), (str(tmp_path / "missing.fastq"), "m.csv"), (str(large), "l.csv")]
+    assert [out for _, out in order_by_input_size(samples)] == ["l.csv", "s.csv", "m.csv"]
+
+
+def test_max_concurrent_jobs():
+    assert max_concurrent_jobs(8) == 8
+    assert max_concurrent_jobs(8, mem_per_job=4, memory=16 * 1024**3) == 4
+    assert max_concurrent_jobs(2, mem_per_job=4, memory=16 * 1024**3) == 2
+    assert max_concurrent_jobs(8, mem_per_job=64, memory=16 * 1024**3) == 1
+
+
+def test_run_all_reports_failures(tmp_path, capsys):
+    """A failing sample is reported, and does not stop the other samples."""
+    ko = tmp_path / "ref.sig.zip"
+    ko.write_bytes(b"")
+    samples = [(str(tmp_path / "missing_1.fastq"), str(tmp_path / "out_1.csv")),
+               (str(tmp_path / "missing_2.fastq"), str(tmp_path / "out_2.csv"))]
+    failed = run_all(samples, 2, str(ko), 11, 1000, 100)
+    assert sorted(failed) == sorted(samples)
+    out = capsys.readouterr().out
+    assert "[2/2]" in out
+    assert "FAILED" in out
+
+
+def test_run_all_hashes_inputs_in_workers(tmp_path, monkeypatch):
+    from fmhfunprofiler import checkpoint, funcprofiler_many
+    samples = []
+    for i in range(3):
+        mg = tmp_path / f"sample_{i}.fastq"
+        mg.write_text(f"@r{i}\nACGT\n+\nIIII\n")
+        samples.append((str(mg), str(tmp_path / f"out_{i}.csv")))
+
+    def fake_funcprofiler(mg_filename, output_filename, *args):
+        with open(output_filename, "w") as fp:
+            fp.write("ko_id,abundance\n")
+        return True
+    hashing_threads = []
+
+    def content_digest(mg_filename):
+        hashing_threads.append(threading.current_thread())
+        return mg_filename
+    monkeypatch.setattr(funcprofiler_many, "run_funcprofiler", fake_funcprofiler)
+    monkeypatch.setattr(checkpoint, "content_digest", content_digest)
+    manifest = checkpoint.Manifest(str(tmp_path / "manifest.jsonl"))
+    assert run_all(samples, 2, "ref.sig.zip", 11, 1000, 100, manifest=manifest, params={}) == []
+    assert len(hashing_threads) == 3
+    assert threading.main_thread() not in hashing_threads
+    assert all(manifest.is_current(mg, out, {}) for mg, out in samples)
+
+
+def test_run_in_process_hashes_inputs_in_sketch_workers(tmp_path, monkeypatch, metagenome, ko_sketch):
+    import os
+    import shutil
+    from fmhfunprofiler import checkpoint, funcprofiler_many, metrics, reads
+    samples = []
+    for i in range(2):
+        shutil.copyfile(metagenome, tmp_path / f"sample_{i}.fastq")
+        samples.append((str(tmp_path / f"sample_{i}.fastq"), str(tmp_path / f"out_{i}.csv")))
+    main_pid = os.getpid()
+    content_digest = checkpoint.content_digest
+
+    def worker_content_digest(mg_filename):
+        assert os.getpid() != main_pid, "an input was hashed in the main process"
+        return content_digest(mg_filename)
+    monkeypatch.setattr(checkpoint, "content_digest", worker_content_digest)
+    manifest = checkpoint.Manifest(str(tmp_path / "manifest.jsonl"))
+    args = _make_args(ko_sketch, ksize=7, scaled=10, threshold_bp=50)
+    assert funcprofiler_many.run_in_process(samples, 2, args, metrics.Metrics(), manifest, params={}) == []
+    for mg, out in samples:
+        assert manifest.entries[(mg, out)]["input_digest"] == reads.content_digest(mg)
+        assert manifest.is_current(mg, out, {})
+
+
 # ---------------------------------------------------------------------------
 # parse_arguments
 # ---------------------------------------------------------------------------
@@ -121,3 +325,15 @@ def test_parse_arguments(tmp_path, monkeypatch):
     assert args.scaled == 1000
     assert args.filelist == "files.csv"
     assert args.threshold_bp == 500
+    assert args.jobs >= 1
+    assert args.mem_per_job is None
+
+
+def test_parse_arguments_scheduler_options(monkeypatch):
+    monkeypatch.setattr(
+        sys, "argv",
+        ["funcprofiler-many", "ref.sig.zip", "11", "1000", "files.csv", "500", "-j", "3", "--mem_per_job", "2.5"],
+    )
+    args = parse_arguments()
+    assert args.jobs == 3
+    assert args.mem_per_job == 2.5
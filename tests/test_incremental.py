@@ -0,0 +1,140 @@
+"""
+Unit tests for fmhfunprofiler.incremental, the re-profiling after an update of the KO reference.
+"""
+
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import sourmash
+from sourmash.save_load import SaveSignaturesToLocation
+
+from fmhfunprofiler import incremental, ko_index
+
+
+def _save_ko_sketch(path, genes):
+    with SaveSignaturesToLocation(str(path)) as save_sigs:
+        for name, seq in genes.items():
+            mh = sourmash.MinHash(0, 7, is_protein=True, scaled=1, track_abundance=True)
+            mh.add_sequence(seq, force=True)
+            save_sigs.add(sourmash.SourmashSignature(mh, name=name))
+    return str(path)
+
+
+@pytest.fixture
+def old_ko_sketch(tmp_path, ko_genes):
+    """The reference before the update: K00003 shorter, no K00004, and an extra K00009."""
+    genes = dict(ko_genes)
+    genes["K00003"] = genes["K00003"][:300]
+    del genes["K00004"]
+    genes["K00009"] = ko_genes["K00005"][::-1]
+    return _save_ko_sketch(tmp_path / "old_kos.sig.zip", genes)
+
+
+# ---------------------------------------------------------------------------
+# diff
+# ---------------------------------------------------------------------------
+
+def test_index_ko_hashes_round_trip():
+    ko_hashes = [np.array([1, 5, 9], dtype=np.uint64), np.array([], dtype=np.uint64), np.array([5, 7], dtype=np.uint64)]
+    index = ko_index.KOIndex.from_hashes(["K1", "K2", "K3"], ko_hashes, 7, 1)
+    assert [h.tolist() for h in index.ko_hashes()] == [h.tolist() for h in ko_hashes]
+
+
+def test_diff_references():
+    old = (["K1", "K2", "K3"], [np.array([1, 2], dtype=np.uint64), np.array([3], dtype=np.uint64), np.array([4], dtype=np.uint64)])
+    new = (["K2", "K3", "K4"], [np.array([3], dtype=np.uint64), np.array([4, 5], dtype=np.uint64), np.array([6], dtype=np.uint64)])
+    assert incremental.diff_references(*old, *new) == {"added": ["K4"], "removed": ["K1"], "changed": ["K3"]}
+
+
+def test_diff_references_from_sketches(old_ko_sketch, ko_sketch):
+    diff = incremental.diff_references(*incremental.reference_hashes(old_ko_sketch, 7, 10),
+                                       *incremental.reference_hashes(ko_sketch, 7, 10))
+    assert diff == {"added": ["K00004"], "removed": ["K00009"], "changed": ["K00003"]}
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler-update
+# ---------------------------------------------------------------------------
+
+def _profile(path):
+    df = pd.read_csv(path)
+    return dict(zip(df["ko_id"], df["abundance"]))
+
+
+def test_update_matches_full_reprofile(tmp_path, metagenome, ko_sketch, old_ko_sketch):
+    output, prefetch = tmp_path / "ko_profiles.csv", tmp_path / "prefetch.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, old_ko_sketch, "7", "10",
+                    str(output), "-t", "50", "--in_process", "-p", str(prefetch)],
+                   check=True, capture_output=True)
+    assert "K00004" not in _profile(output)
+
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{metagenome},{output},{prefetch}\n")
+    diff = tmp_path / "diff.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.incremental", old_ko_sketch, ko_sketch, "7", "10",
+                    str(filelist), "50", "--cache_dir", str(tmp_path / "cache"), "--diff", str(diff)],
+                   check=True, capture_output=True)
+    assert pd.read_csv(diff)["status"].tolist() == ["added", "removed", "changed"]
+
+    expected = tmp_path / "expected.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(expected), "-t", "50", "--in_process"],
+                   check=True, capture_output=True)
+    updated = _profile(output)
+    assert updated.keys() == _profile(expected).keys()
+    for ko_id, abundance in _profile(expected).items():
+        assert updated[ko_id] == pytest.approx(abundance)
+
+
+def test_update_profiles_samples_without_prefetch_table(tmp_path, metagenome, ko_sketch, old_ko_sketch):
+    output = tmp_path / "ko_profiles.csv"
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{metagenome},{output},{tmp_path / 'prefetch.csv'}\n")
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.incremental", old_ko_sketch, ko_sketch, "7", "10",
+                    str(filelist), "50", "--cache_dir", str(tmp_path / "cache")],
+                   check=True, capture_output=True)
+    assert "K00004" in _profile(output)
+    assert (tmp_path / "prefetch.csv").exists()
+
+
+def test_update_patches_empty_prefetch_table(tmp_path, metagenome, ko_sketch, old_ko_sketch):
+    # the 0-byte table that sourmash prefetch writes when the sample matches no KO
+    output, prefetch = tmp_path / "ko_profiles.csv", tmp_path / "prefetch.csv"
+    prefetch.write_bytes(b"")
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{metagenome},{output},{prefetch}\n")
+    res = subprocess.run([sys.executable, "-m", "fmhfunprofiler.incremental", old_ko_sketch, ko_sketch, "7", "10",
+                          str(filelist), "50", "--cache_dir", str(tmp_path / "cache")],
+                         capture_output=True, text=True)
+    assert res.returncode == 0, res.stdout + res.stderr
+    assert "patched" in res.stdout
+    # only the added and changed KOs are matched
+    assert sorted(_profile(output)) == ["K00003", "K00004"]
+    assert sorted(pd.read_csv(prefetch)["match_name"]) == ["K00003", "K00004"]
+
+
+def test_update_sample_of_several_read_files(tmp_path, split_metagenome, metagenome, ko_sketch, old_ko_sketch):
+    output, prefetch = tmp_path / "ko_profiles.csv", tmp_path / "prefetch.csv"
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{';'.join(split_metagenome)},{output},{prefetch}\n")
+    assert incremental.read_filelist(str(filelist)) == [(",".join(split_metagenome), str(output), str(prefetch))]
+    res = subprocess.run([sys.executable, "-m", "fmhfunprofiler.incremental", old_ko_sketch, ko_sketch, "7", "10",
+                          str(filelist), "50", "--cache_dir", str(tmp_path / "cache")],
+                         capture_output=True, text=True)
+    assert res.returncode == 0, res.stdout + res.stderr
+
+    expected = tmp_path / "expected.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(expected), "-t", "50", "--in_process"],
+                   check=True, capture_output=True)
+    assert _profile(output) == pytest.approx(_profile(expected))
+
+
+def test_read_filelist_too_many_columns(tmp_path):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("r1.fq,r2.fq,out.csv,prefetch.csv\n")
+    with pytest.raises(SystemExit):
+        incremental.read_filelist(str(filelist))
@@ -0,0 +1,204 @@
+"""
+Unit tests for fmhfunprofiler.ko_index, the inverted hash -> KO index.
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fmhfunprofiler import engine, ko_index
+
+
+def _small_index():
+    ko_hashes = [np.array([1, 5, 9], dtype=np.uint64),
+                 np.array([5, 7], dtype=np.uint64),
+                 np.array([2, 5, 9], dtype=np.uint64)]
+    return ko_index.KOIndex.from_hashes(["KA", "KB", "KC"], ko_hashes, ksize=7, scaled=1)
+
+
+# ---------------------------------------------------------------------------
+# KOIndex
+# ---------------------------------------------------------------------------
+
+def test_from_hashes_csr_layout():
+    index = _small_index()
+    assert index.hashes.tolist() == [1, 2, 5, 7, 9]
+    assert index.indptr.tolist() == [0, 1, 2, 5, 6, 8]
+    assert index.ko_ids.tolist() == [0, 2, 0, 1, 2, 1, 0, 2]
+    assert index.ko_n_hashes.tolist() == [3, 2, 3]
+    assert index.n_kos == 3
+
+
+def test_count_shared_hashes():
+    index = _small_index()
+    counts = index.count_shared_hashes(np.array([0, 5, 9, 10], dtype=np.uint64))
+    assert counts.tolist() == [2, 1, 2]
+
+
+def test_count_shared_hashes_no_match():
+    index = _small_index()
+    assert index.count_shared_hashes(np.array([3, 4], dtype=np.uint64)).tolist() == [0, 0, 0]
+    assert index.count_shared_hashes(np.array([], dtype=np.uint64)).tolist() == [0, 0, 0]
+
+
+def test_index_prefetch_matches_engine(ko_sketch, metagenome):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    expected = engine.prefetch(mh, engine.load_ko_sketches(ko_sketch, 7, 10), 7, 10, threshold_bp=50)
+    observed = ko_index.build_index(ko_sketch, 7, 10).prefetch(mh, threshold_bp=50)
+    cols = ["match_name", "intersect_bp", "f_match_query", "f_query_match", "jaccard"]
+    pd.testing.assert_frame_equal(observed[cols].reset_index(drop=True), expected[cols].reset_index(drop=True))
+
+
+def test_index_prefetch_weighted_matches_engine(ko_sketch, metagenome):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    index = ko_index.build_index(ko_sketch, 7, 10)
+    expected = engine.prefetch(mh, engine.load_ko_sketches(ko_sketch, 7, 10), 7, 10, 50, weighted=True)
+    observed = index.prefetch(mh, 50, weighted=True)
+    columns = ["match_name", "intersect_bp", "f_match_query"] + engine.WEIGHTED_COLUMNS
+    pd.testing.assert_frame_equal(observed[columns].sort_values("match_name").reset_index(drop=True),
+                                  expected[columns].sort_values("match_name").reset_index(drop=True))
+
+
+def test_index_downsamples_finer_sample(ko_sketch, metagenome):
+    index = ko_index.build_index(ko_sketch, 7, 10)
+    fine = engine.sketch_metagenome(metagenome, 7, 1)
+    coarse = engine.sketch_metagenome(metagenome, 7, 10)
+    fine_df = index.prefetch(fine, threshold_bp=50)
+    coarse_df = index.prefetch(coarse, threshold_bp=50)
+    assert fine_df["intersect_bp"].tolist() == coarse_df["intersect_bp"].tolist()
+
+
+# ---------------------------------------------------------------------------
+# save / load
+# ---------------------------------------------------------------------------
+
+def test_save_and_load_index(tmp_path, ko_sketch):
+    index = ko_index.build_index(ko_sketch, 11, 10)
+    filename = str(tmp_path / "kos.idx")
+    ko_index.save_index(index, filename)
+    loaded = ko_index.load_index(filename)
+    assert loaded.ksize == 11 and loaded.scaled == 10
+    assert loaded.ko_names.tolist() == index.ko_names.tolist()
+    for name in ["hashes", "indptr", "ko_ids", "ko_n_hashes"]:
+        assert np.array_equal(getattr(loaded, name), getattr(index, name))
+
+
+def test_native_index_is_memory_mapped(tmp_path, ko_sketch):
+    filename = str(tmp_path / "kos.idx")
+    ko_index.save_index(ko_index.build_index(ko_sketch, 7, 10), filename)
+    with open(filename, "rb") as fp:
+        assert fp.read(len(ko_index.INDEX_MAGIC)) == ko_index.INDEX_MAGIC
+    loaded = ko_index.load_index(filename)
+    assert isinstance(loaded.hashes, np.memmap)
+    assert not loaded.hashes.flags.writeable
+    assert loaded.hashes.dtype == np.uint64
+
+
+def test_npz_index_round_trip(tmp_path, ko_sketch, metagenome):
+    index = ko_index.build_index(ko_sketch, 7, 10)
+    native, npz = str(tmp_path / "kos.idx"), str(tmp_path / "kos.npz")
+    ko_index.save_index(index, native)
+    ko_index.save_index(index, npz)
+    with open(npz, "rb") as fp:
+        assert fp.read(2) == b"PK"
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    pd.testing.assert_frame_equal(ko_index.load_index(native).prefetch(mh, 50),
+                                  ko_index.load_index(npz).prefetch(mh, 50))
+
+
+def test_empty_index_round_trip(tmp_path):
+    index = ko_index.KOIndex.from_hashes([], [], ksize=7, scaled=10)
+    filename = str(tmp_path / "empty.idx")
+    ko_index.save_index(index, filename)
+    loaded = ko_index.load_index(filename)
+    assert loaded.n_kos == 0
+    assert loaded.count_shared_hashes(np.array([1, 2], dtype=np.uint64)).tolist() == []
+
+
+def test_load_checked_index_mismatch(tmp_path, ko_sketch):
+    filename = str(tmp_path / "kos.idx")
+    ko_index.save_index(ko_index.build_index(ko_sketch, 11, 10), filename)
+    with pytest.raises(SystemExit) as exc:
+        ko_index.load_checked_index(filename, 7, 10)
+    assert exc.value.code == 1
+
+
+def test_main_builds_index(tmp_path, monkeypatch, ko_sketch):
+    filename = str(tmp_path / "kos.idx")
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-index", ko_sketch, "7", "10", filename])
+    ko_index.main()
+    assert ko_index.load_index(filename).n_kos == 8
+
+
+# ---------------------------------------------------------------------------
+# KO subsets
+# ---------------------------------------------------------------------------
+
+def test_read_ko_list(tmp_path):
+    filename = tmp_path / "panel.txt"
+    filename.write_text("# panel\nK00003\n\nK00001\nK00003\n")
+    assert ko_index.read_ko_list(str(filename)) == ["K00001", "K00003"]
+    profile = tmp_path / "profile.csv"
+    profile.write_text("ko_id,abundance\nK00002,0.5\nK00004,0.5\n")
+    assert ko_index.read_ko_list(str(profile)) == ["K00002", "K00004"]
+
+
+def test_ko_list_digest_ignores_order():
+    assert ko_index.ko_list_digest(["K00002", "K00001"]) == ko_index.ko_list_digest(["K00001", "K00002", "K00001"])
+    assert ko_index.ko_list_digest(["K00001"]) != ko_index.ko_list_digest(["K00001", "K00002"])
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_subset_index_matches_full_index(tmp_path, ko_sketch, metagenome, use_index):
+    reference = ko_sketch
+    if use_index:
+        reference = str(tmp_path / "kos.idx")
+        ko_index.save_index(ko_index.build_index(ko_sketch, 7, 10), reference)
+    subset = ko_index.build_subset_index(reference, 7, 10, ["K00001", "K00003", "K99999"], use_index)
+    assert subset.ko_names.tolist() == ["K00001", "K00003"]
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    full = ko_index.build_index(ko_sketch, 7, 10).prefetch(mh, 50)
+    expected = full[full["match_name"].isin(["K00001", "K00003"])].reset_index(drop=True)
+    pd.testing.assert_frame_equal(subset.prefetch(mh, 50), expected)
+
+
+def test_cached_subset_index_is_reused(tmp_path, monkeypatch, ko_sketch):
+    subset_dir = str(tmp_path / "subsets")
+    filename = ko_index.cached_subset_index(ko_sketch, 7, 10, ["K00001", "K00002"], subset_dir=subset_dir)
+    assert filename.startswith(subset_dir)
+    assert ko_index.load_index(filename).n_kos == 2
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the cached index was built again")
+    monkeypatch.setattr(ko_index, "build_subset_index", fail)
+    assert ko_index.cached_subset_index(ko_sketch, 7, 10, ["K00002", "K00001"], subset_dir=subset_dir) == filename
+    # another list, ksize or scaled has its own index
+    names = {filename,
+             ko_index.subset_index_filename(subset_dir, ko_sketch, 7, 10, ["K00001"]),
+             ko_index.subset_index_filename(subset_dir, ko_sketch, 11, 10, ["K00001", "K00002"]),
+             ko_index.subset_index_filename(subset_dir, ko_sketch, 7, 100, ["K00001", "K00002"])}
+    assert len(names) == 4
+
+
+def test_main_builds_subset_index(tmp_path, monkeypatch, ko_sketch):
+    panel = tmp_path / "panel.txt"
+    panel.write_text("K00001\nK00004\n")
+    filename = str(tmp_path / "panel.idx")
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-index", ko_sketch, "7", "10", filename, "--ko_subset", str(panel)])
+    ko_index.main()
+    assert ko_index.load_index(filename).ko_names.tolist() == ["K00001", "K00004"]
+
+    subset_dir = str(tmp_path / "subsets")
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-index", ko_sketch, "7", "10", "--ko_subset", str(panel), "--subset_dir", subset_dir])
+    ko_index.main()
+    cached = ko_index.subset_index_filename(subset_dir, ko_sketch, 7, 10, ["K00001", "K00004"])
+    assert ko_index.load_index(cached).ko_names.tolist() == ["K00001", "K00004"]
+
+
+def test_main_needs_output_without_subset(monkeypatch, ko_sketch):
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-index", ko_sketch, "7", "10"])
+    with pytest.raises(SystemExit) as exc:
+        ko_index.main()
+    assert exc.value.code == 1
@@ -0,0 +1,119 @@
+"""
+Unit tests for fmhfunprofiler.metrics, the per-stage instrumentation.
+"""
+
+import json
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from fmhfunprofiler import metrics
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+def test_stage_records_time_and_labels():
+    run_metrics = metrics.Metrics(sample="a.fastq")
+    with run_metrics.stage("sketch", ksize=11) as record:
+        sum(range(100000))
+        record["read_bytes"] = 123
+    record, = run_metrics.records
+    assert record["stage"] == "sketch"
+    assert record["sample"] == "a.fastq"
+    assert record["ksize"] == 11
+    assert record["read_bytes"] == 123
+    assert record["hashes"] == 0
+    assert record["wall_seconds"] > 0
+    assert record["cpu_seconds"] >= 0
+    assert record["peak_rss_bytes"] > 1024**2
+
+
+def test_stage_is_recorded_on_error():
+    run_metrics = metrics.Metrics()
+    with pytest.raises(ValueError):
+        with run_metrics.stage("prefetch"):
+            raise ValueError("failed")
+    assert [record["stage"] for record in run_metrics.records] == ["prefetch"]
+
+
+def test_aggregate_over_samples():
+    records = [
+        {"stage": "sketch", "sample": "a", "wall_seconds": 1.0, "cpu_seconds": 2.0, "peak_rss_bytes": 10, "read_bytes": 5, "hashes": 1},
+        {"stage": "sketch", "sample": "b", "wall_seconds": 3.0, "cpu_seconds": 4.0, "peak_rss_bytes": 30, "read_bytes": 5, "hashes": 3},
+        {"stage": "prefetch", "sample": "a", "wall_seconds": 0.5, "cpu_seconds": 0.5, "peak_rss_bytes": 20, "read_bytes": 0, "hashes": 1},
+    ]
+    sketch, prefetch = metrics.aggregate(records)
+    assert sketch["stage"] == "sketch"
+    assert "sample" not in sketch
+    assert sketch["samples"] == 2
+    assert sketch["wall_seconds_sum"] == 4.0
+    assert sketch["wall_seconds_mean"] == 2.0
+    assert sketch["peak_rss_bytes_max"] == 30
+    assert prefetch["samples"] == 1
+
+
+def test_prometheus_format():
+    records = [{"stage": "sketch", "sample": 'a"b.fastq', "ksize": 11, "wall_seconds": 1.5, "hashes": 7}]
+    text = metrics.to_prometheus(records)
+    assert "# TYPE fmhfunprofiler_stage_wall_seconds gauge" in text
+    assert 'fmhfunprofiler_stage_wall_seconds{stage="sketch",sample="a\\"b.fastq",ksize="11"} 1.5' in text
+    assert 'fmhfunprofiler_stage_hashes{stage="sketch",sample="a\\"b.fastq",ksize="11"} 7' in text
+
+
+def test_write_and_read_jsonl(tmp_path):
+    run_metrics = metrics.Metrics()
+    with run_metrics.stage("sketch"):
+        pass
+    filename = str(tmp_path / "metrics.jsonl")
+    run_metrics.write(filename)
+    assert metrics.read_metrics(filename) == run_metrics.records
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler --metrics
+# ---------------------------------------------------------------------------
+
+def test_funcprofiler_writes_stage_metrics(tmp_path, metagenome, ko_sketch):
+    metrics_file = tmp_path / "metrics.jsonl"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(tmp_path / "ko_profiles.csv"), "-t", "50", "--in_process", "--metrics", str(metrics_file)],
+                   check=True, capture_output=True)
+    records = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+    assert [record["stage"] for record in records] == ["sanity_check", "sketch", "prefetch", "abundance"]
+    sketch = records[1]
+    assert sketch["sample"] == metagenome
+    assert sketch["read_bytes"] > 0
+    assert sketch["hashes"] > 0
+
+
+@pytest.mark.skipif(shutil.which("sourmash") is None, reason="sourmash CLI not available")
+@pytest.mark.parametrize("threshold_bp", ["50", "100000000"])
+def test_funcprofiler_cli_counts_hashes(tmp_path, metagenome, ko_sketch, threshold_bp):
+    # the second threshold matches no KO, so the hashes are counted from the sketch
+    from fmhfunprofiler import engine
+    metrics_file = tmp_path / "metrics.jsonl"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(tmp_path / "ko_profiles.csv"), "-t", threshold_bp, "--metrics", str(metrics_file)],
+                   check=True, capture_output=True)
+    records = {record["stage"]: record for record in map(json.loads, metrics_file.read_text().splitlines())}
+    n_hashes = len(engine.sketch_metagenome(metagenome, 7, 10))
+    assert records["sketch"]["hashes"] == n_hashes
+    assert records["prefetch"]["hashes"] == n_hashes
+
+
+@pytest.mark.skipif(shutil.which("sourmash") is None, reason="sourmash CLI not available")
+def test_funcprofiler_many_aggregates_metrics(tmp_path, metagenome, ko_sketch):
+    # the same input twice: every funcprofiler has its own scratch directory, so they do not collide
+    filelist = tmp_path / "files.csv"
+    filelist.write_text("".join(f"{metagenome},{tmp_path / name}.csv\n" for name in ("a", "b")))
+    metrics_file = tmp_path / "metrics.prom"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10",
+                    str(filelist), "50", "--metrics", str(metrics_file), "--metrics_format", "prometheus", "-j", "2"],
+                   check=True, capture_output=True)
+    text = metrics_file.read_text()
+    assert 'fmhfunprofiler_stage_samples{stage="sketch"} 2' in text
+    assert "fmhfunprofiler_stage_wall_seconds_max" in text
@@ -5,6 +5,12 @@ the expected public API and CLI entry points.
 
 import subprocess
 import sys
+import time
+
+import pytest
+
+
+HEAVY_MODULES = ["numpy", "pandas", "scipy", "sourmash", "screed"]
 
 
 def test_package_imports():
@@ -60,3 +66,35 @@ def test_funcprofiler_many_help_flag():
     )
     assert result.returncode == 0
     assert "metagenome" in result.stdout.lower()
+
+
+# ---------------------------------------------------------------------------
+# start-up time of the entry points
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("module", ["fmhfunprofiler.funcprofiler", "fmhfunprofiler.funcprofiler_many"])
+def test_entry_point_imports_no_heavy_module(module):
+    """funcprofiler-many starts one funcprofiler per sample, which must not pay for these imports up front."""
+    result = subprocess.run(
+        [sys.executable, "-c",
+         f"import sys; import {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def _best_import_time(statement, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_funcprofiler_starts_faster_than_pandas_imports():
+    """Relative to the import of pandas alone, so that the test does not depend on the speed of the machine."""
+    startup = _best_import_time("import fmhfunprofiler.funcprofiler")
+    assert startup < _best_import_time("import pandas")
@@ -0,0 +1,114 @@
+"""
+Unit tests for fmhfunprofiler.pipeline, the pipelined sketch / match / write executor.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+
+import pandas as pd
+import pytest
+
+from fmhfunprofiler import pipeline
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for i, size in enumerate([3, 5, 7, 11]):
+        path = tmp_path / f"sample_{i}.fastq"
+        path.write_bytes(b"x" * size)
+        paths.append(str(path))
+    return paths
+
+
+# ---------------------------------------------------------------------------
+# run_pipeline
+# ---------------------------------------------------------------------------
+
+def test_run_pipeline_runs_every_stage(files):
+    written = {}
+
+    def write(sample, result):
+        written[sample[1]] = result
+        return "ok"
+
+    samples = [(path, f"s{i}") for i, path in enumerate(files)]
+    failed = pipeline.run_pipeline(samples, os.path.getsize, lambda sample, size: size * 2, write, n_workers=2, max_pending=1)
+    assert failed == []
+    assert written == {"s0": 6, "s1": 10, "s2": 14, "s3": 22}
+
+
+def test_run_pipeline_reports_failures_of_every_stage(tmp_path, files, capsys):
+    samples = [(str(tmp_path / "missing.fastq"), "sketch")] + [(path, name) for path, name in zip(files, ["match", "write", "ok"])]
+
+    def match(sample, size):
+        if sample[1] == "match":
+            raise ValueError("no match")
+        return size
+
+    def write(sample, result):
+        if sample[1] == "write":
+            raise OSError("disk full")
+
+    failed = pipeline.run_pipeline(samples, os.path.getsize, match, write, n_workers=2)
+    assert [name for _, name in failed] == ["sketch", "match", "write"]
+    out = capsys.readouterr().out
+    assert "[4/4]" in out
+    assert "no match" in out and "disk full" in out
+
+
+def test_writing_overlaps_matching(files):
+    # the first output can only be written once the second sample is being matched
+    second_matched = threading.Event()
+    overlapped = []
+
+    def match(sample, size):
+        if sample[0] == files[1]:
+            second_matched.set()
+        return size
+
+    def write(sample, result):
+        if sample[0] == files[0]:
+            overlapped.append(second_matched.wait(timeout=30))
+
+    samples = [(path,) for path in files[:2]]
+    assert pipeline.run_pipeline(samples, os.path.getsize, match, write, n_workers=1, max_pending=1) == []
+    assert overlapped == [True]
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler-many --in_process
+# ---------------------------------------------------------------------------
+
+def test_funcprofiler_many_in_process(tmp_path, metagenome, ko_sketch):
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{metagenome},{tmp_path / 'a.csv'}\n{tmp_path / 'missing.fastq'},{tmp_path / 'b.csv'}\n")
+    res = subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10", str(filelist), "50",
+                          "--in_process", "-j", "2"], capture_output=True, text=True)
+    assert res.returncode == 1
+    assert "1 of 2 samples have been profiled" in res.stdout
+
+    expected = tmp_path / "expected.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10", str(expected),
+                    "-t", "50", "--in_process"], check=True, capture_output=True)
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "a.csv"), pd.read_csv(expected))
+
+
+def test_funcprofiler_many_ko_subset(tmp_path, metagenome, ko_sketch):
+    panel = tmp_path / "panel.txt"
+    panel.write_text("K00002\nK00004\n")
+    subset_dir = tmp_path / "subsets"
+    filelist = tmp_path / "files.csv"
+    filelist.write_text(f"{metagenome},{tmp_path / 'a.csv'}\n")
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler_many", ko_sketch, "7", "10", str(filelist), "50",
+                    "--in_process", "--ko_subset", str(panel), "--subset_dir", str(subset_dir)], check=True, capture_output=True)
+
+    expected = tmp_path / "expected.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10", str(expected),
+                    "-t", "50", "--ko_subset", str(panel), "--subset_dir", str(subset_dir)], check=True, capture_output=True)
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "a.csv"), pd.read_csv(expected))
+    assert sorted(pd.read_csv(expected)["ko_id"]) == ["K00002", "K00004"]
+    # both runs used the same reduced index
+    assert len(list(subset_dir.iterdir())) == 1
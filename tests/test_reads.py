@@ -0,0 +1,36 @@
+"""
+Unit tests for fmhfunprofiler.reads, the samples made of several read files.
+"""
+
+import os
+
+from fmhfunprofiler import reads, sketch_cache
+
+
+def test_read_files_round_trip():
+    assert reads.read_files("sample.fastq") == ["sample.fastq"]
+    assert reads.read_files("R1.fastq.gz,R2.fastq.gz") == ["R1.fastq.gz", "R2.fastq.gz"]
+    assert reads.join_read_files(["R1.fastq.gz", "R2.fastq.gz"]) == "R1.fastq.gz,R2.fastq.gz"
+
+
+def test_content_digest_is_digest_of_concatenation(tmp_path):
+    first, second, whole = tmp_path / "R1.fastq", tmp_path / "R2.fastq", tmp_path / "sample.fastq"
+    first.write_bytes(b"@r1\nACGT\n+\nIIII\n")
+    second.write_bytes(b"@r2\nTTGA\n+\nIIII\n")
+    whole.write_bytes(first.read_bytes() + second.read_bytes())
+    mg_filename = reads.join_read_files([str(first), str(second)])
+    assert reads.content_digest(mg_filename) == sketch_cache.file_digest(str(whole))
+    assert reads.content_digest(str(whole)) == sketch_cache.file_digest(str(whole))
+
+
+def test_input_size_and_stat(tmp_path):
+    first, second = tmp_path / "R1.fastq", tmp_path / "R2.fastq"
+    first.write_bytes(b"x" * 10)
+    second.write_bytes(b"x" * 30)
+    os.utime(second, ns=(0, 5_000_000_000))
+    os.utime(first, ns=(0, 7_000_000_000))
+    mg_filename = reads.join_read_files([str(first), str(second)])
+    assert reads.input_size(mg_filename) == 40
+    assert reads.input_stat(mg_filename) == (40, 7_000_000_000)
+    missing = str(tmp_path / "missing.fastq")
+    assert reads.missing_read_files(reads.join_read_files([str(first), missing])) == [missing]
@@ -0,0 +1,97 @@
+"""
+Unit tests for fmhfunprofiler.reassign, the reassignment of the hashes shared by several KOs.
+"""
+
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fmhfunprofiler import engine, ko_index, reassign
+
+
+def _table(names, match_bp):
+    return pd.DataFrame({"match_name": names, "match_bp": match_bp, "f_match_query": [0.0] * len(names)})
+
+
+# ---------------------------------------------------------------------------
+# assignments
+# ---------------------------------------------------------------------------
+
+def test_em_splits_shared_hashes():
+    # hashes 0-3 only in KO 0, hash 4 in both KOs, hash 5 only in KO 1
+    hash_positions = np.array([0, 1, 2, 3, 4, 4, 5])
+    ko_ids = np.array([0, 0, 0, 0, 0, 1, 1])
+    matrix = reassign.hash_ko_matrix(hash_positions, ko_ids, 6, 2)
+    responsibilities, n_iterations = reassign.em_assignment(matrix, [5, 2], np.ones(6))
+    assert 1 <= n_iterations < 1000
+    # every hash is fully assigned
+    assert np.allclose(responsibilities.sum(axis=1), 1.0)
+    shared = responsibilities.toarray()[4]
+    assert 0 < shared[0] < 1 and 0 < shared[1] < 1
+
+
+def test_em_stops_at_max_iterations():
+    matrix = reassign.hash_ko_matrix(np.array([0, 0, 1]), np.array([0, 1, 1]), 2, 2)
+    _, n_iterations = reassign.em_assignment(matrix, [1, 2], np.ones(2), tolerance=1e-300, max_iterations=3)
+    assert n_iterations == 3
+
+
+def test_greedy_gives_every_hash_to_one_ko():
+    hash_positions = np.array([0, 1, 2, 2, 3])
+    ko_ids = np.array([0, 0, 0, 1, 1])
+    matrix = reassign.hash_ko_matrix(hash_positions, ko_ids, 4, 2)
+    assignments = reassign.greedy_assignment(matrix).toarray()
+    assert assignments.tolist() == [[1, 0], [1, 0], [1, 0], [0, 1]]
+    # KO 1 keeps a single hash, below min_hashes
+    assert reassign.greedy_assignment(matrix, min_hashes=2).toarray()[:, 1].sum() == 0
+
+
+# ---------------------------------------------------------------------------
+# reassign_shared_hashes
+# ---------------------------------------------------------------------------
+
+def test_reassign_shared_hashes_columns_and_threshold():
+    df = _table(["KA", "KB"], [4, 2])
+    hash_positions = np.array([0, 1, 2, 2, 3])
+    ko_ids = np.array([0, 0, 0, 1, 1])
+    abunds = np.array([1, 1, 1, 6])
+    out, _ = reassign.reassign_shared_hashes(df, hash_positions, ko_ids, ["KA", "KB"], abunds, 1, 1, method="greedy")
+    assert out["match_name"].tolist() == ["KA", "KB"]
+    assert out["unique_intersect_bp"].tolist() == [3, 1]
+    assert out["f_unique_to_query"].tolist() == pytest.approx([0.75, 0.25])
+    assert out["f_unique_weighted"].tolist() == pytest.approx([1 / 3, 2 / 3])
+
+    out, _ = reassign.reassign_shared_hashes(df, hash_positions, ko_ids, ["KA", "KB"], abunds, 1, 2, method="greedy")
+    assert out["match_name"].tolist() == ["KA"]
+
+
+def test_engine_and_index_pairs_agree(metagenome, ko_sketch):
+    query = engine.sketch_metagenome(metagenome, 7, 10)
+    hashes, _ = engine.minhash_to_arrays(query, scaled=10)
+    ko_sigs = engine.load_ko_sketches(ko_sketch, 7, 10)
+    positions, ko_ids = engine.shared_hash_pairs(hashes, [engine.minhash_to_arrays(sig.minhash)[0] for sig in ko_sigs])
+    index = ko_index.build_index(ko_sketch, 7, 10)
+    index_positions, index_ko_ids = index.shared_hash_pairs(hashes)
+    names = [sig.name for sig in ko_sigs]
+    assert sorted(zip(positions, [names[i] for i in ko_ids])) == \
+        sorted(zip(index_positions, [index.ko_names[i] for i in index_ko_ids]))
+
+
+# ---------------------------------------------------------------------------
+# funcprofiler --reassign
+# ---------------------------------------------------------------------------
+
+def test_funcprofiler_reassign_em(tmp_path, metagenome, ko_sketch):
+    output = tmp_path / "ko_profiles.csv"
+    subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", metagenome, ko_sketch, "7", "10",
+                    str(output), "-t", "50", "--reassign", "em", "-p", str(tmp_path / "prefetch.csv")],
+                   check=True, capture_output=True)
+    prefetch = pd.read_csv(tmp_path / "prefetch.csv")
+    assert set(reassign.REASSIGNED_COLUMNS) <= set(prefetch.columns)
+    assert (prefetch["unique_intersect_bp"] <= prefetch["intersect_bp"] + 1e-9).all()
+    assert (prefetch["unique_intersect_bp"] >= 50).all()
+    profile = pd.read_csv(output)
+    assert profile["abundance"].sum() == pytest.approx(1.0)
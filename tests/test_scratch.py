@@ -0,0 +1,56 @@
+"""
+Unit tests for fmhfunprofiler.scratch, the scratch directories of the intermediate files.
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from fmhfunprofiler import scratch
+
+
+def test_scratch_directory_is_removed(tmp_path):
+    with scratch.scratch_directory(str(tmp_path / "scratch")) as path:
+        assert os.path.dirname(path) == str(tmp_path / "scratch")
+        assert os.path.basename(path).startswith(scratch.SCRATCH_PREFIX)
+        (tmp_path / "scratch" / os.path.basename(path) / "sample.sig.zip").write_bytes(b"sketch")
+    assert os.listdir(tmp_path / "scratch") == []
+
+
+def test_scratch_directory_is_removed_on_error(tmp_path):
+    with pytest.raises(SystemExit):
+        with scratch.scratch_directory(str(tmp_path)) as path:
+            open(os.path.join(path, "prefetch.csv"), "w").close()
+            sys.exit(1)
+    assert os.listdir(tmp_path) == []
+
+
+def test_scratch_directories_are_unique(tmp_path):
+    with scratch.scratch_directory(str(tmp_path)) as first, scratch.scratch_directory(str(tmp_path)) as second:
+        assert first != second
+
+
+def test_default_scratch_dir_is_tmpdir(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.setattr(scratch.tempfile, "tempdir", None)
+    with scratch.scratch_directory() as path:
+        assert os.path.dirname(path) == str(tmp_path)
+
+
+def test_scratch_directory_is_removed_on_sigterm(tmp_path):
+    code = textwrap.dedent(f"""
+        import os, signal, time
+        from fmhfunprofiler import scratch
+        with scratch.scratch_directory({str(tmp_path)!r}) as path:
+            print(path, flush=True)
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(10)
+    """)
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert res.returncode == 128 + signal.SIGTERM
+    assert not os.path.exists(res.stdout.strip())
+    assert os.listdir(tmp_path) == []
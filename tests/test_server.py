@@ -0,0 +1,122 @@
+"""
+Unit tests for fmhfunprofiler.server, the persistent KO database server.
+"""
+
+import os
+import socket
+import threading
+
+import pandas as pd
+import pytest
+
+from fmhfunprofiler import engine, server
+
+
+@pytest.fixture(scope="module")
+def ko_database(ko_sketch):
+    return server.KODatabase(ko_sketch, 7, 10, threshold_bp=50)
+
+
+@pytest.fixture
+def running_server(tmp_path, ko_database):
+    socket_path = str(tmp_path / "ko.sock")
+    ko_server = server.make_server(socket_path, ko_database)
+    thread = threading.Thread(target=ko_server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.start()
+    yield socket_path
+    ko_server.shutdown()
+    thread.join()
+    ko_server.server_close()
+
+
+# ---------------------------------------------------------------------------
+# KODatabase
+# ---------------------------------------------------------------------------
+
+def test_run_job_returns_profile(ko_database, metagenome):
+    reply = ko_database.run_job({"mg_filename": metagenome})
+    assert reply["status"] == "ok"
+    assert sorted(name for name, _ in reply["profile"]) == ["K00001", "K00002", "K00003", "K00004"]
+    assert sum(abundance for _, abundance in reply["profile"]) == pytest.approx(1.0)
+
+
+def test_run_job_abundance_weighted(ko_database, metagenome):
+    reply = ko_database.run_job({"mg_filename": metagenome, "abundance_weighted": True})
+    assert reply["status"] == "ok"
+    assert sum(weight for _, weight in reply["profile"]) == pytest.approx(1.0)
+    unweighted = ko_database.run_job({"mg_filename": metagenome})
+    assert dict(reply["profile"]).keys() == dict(unweighted["profile"]).keys()
+
+
+def test_run_job_from_sketch(tmp_path, ko_database, metagenome):
+    sketch = str(tmp_path / "sample.sig.zip")
+    engine.save_sketch(engine.sketch_metagenome(metagenome, 7, 10), metagenome, sketch)
+    from_reads = ko_database.run_job({"mg_filename": metagenome})
+    from_sketch = ko_database.run_job({"sketch": sketch})
+    assert dict(from_sketch["profile"]) == pytest.approx(dict(from_reads["profile"]))
+
+
+def test_run_job_missing_file(tmp_path, ko_database):
+    with pytest.raises(FileNotFoundError):
+        ko_database.run_job({"mg_filename": str(tmp_path / "missing.fastq")})
+
+
+# ---------------------------------------------------------------------------
+# socket protocol
+# ---------------------------------------------------------------------------
+
+def test_submit_job_writes_output(tmp_path, running_server, metagenome):
+    output = tmp_path / "ko_profiles.csv"
+    reply = server.submit_job(running_server, {"mg_filename": metagenome, "output": str(output)})
+    assert reply == {"status": "ok", "output": str(output), "n_kos": 4}
+    df = pd.read_csv(output)
+    assert list(df.columns) == ["ko_id", "abundance"]
+
+
+def test_submit_job_reports_errors(running_server):
+    reply = server.submit_job(running_server, {"output": "out.csv"})
+    assert reply["status"] == "error"
+    assert "mg_filename" in reply["error"]
+
+
+def test_shutdown_command(tmp_path, ko_database):
+    socket_path = str(tmp_path / "ko.sock")
+    ko_server = server.make_server(socket_path, ko_database)
+    thread = threading.Thread(target=ko_server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.start()
+    assert server.submit_job(socket_path, {"command": "shutdown"}) == {"status": "ok"}
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    ko_server.server_close()
+
+
+# ---------------------------------------------------------------------------
+# socket path
+# ---------------------------------------------------------------------------
+
+def test_make_server_keeps_live_server_socket(running_server, ko_database):
+    with pytest.raises(SystemExit) as exc:
+        server.make_server(running_server, ko_database)
+    assert exc.value.code == 1
+    # the first server still answers
+    assert server.submit_job(running_server, {"output": "out.csv"})["status"] == "error"
+
+
+def test_make_server_keeps_regular_file(tmp_path, ko_database):
+    path = tmp_path / "notes.txt"
+    path.write_text("not a socket")
+    with pytest.raises(SystemExit) as exc:
+        server.make_server(str(path), ko_database)
+    assert exc.value.code == 1
+    assert path.read_text() == "not a socket"
+
+
+def test_make_server_replaces_stale_socket(tmp_path, ko_database):
+    socket_path = str(tmp_path / "ko.sock")
+    # a socket file that nothing listens on any more
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert os.path.exists(socket_path)
+    ko_server = server.make_server(socket_path, ko_database)
+    ko_server.server_close()
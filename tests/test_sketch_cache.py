@@ -0,0 +1,133 @@
+"""
+Unit tests for fmhfunprofiler.sketch_cache, the content-addressed cache of metagenome sketches.
+"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+from fmhfunprofiler import engine, sketch_cache
+
+
+# ---------------------------------------------------------------------------
+# helpers
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("size, expected", [("100", 100), ("2K", 2048), ("1.5M", 1572864), ("20G", 20 * 1024**3), ("1gb", 1024**3)])
+def test_parse_size(size, expected):
+    assert sketch_cache.parse_size(size) == expected
+
+
+@pytest.mark.parametrize("size", ["", "lots", "-1G", "10X"])
+def test_parse_size_invalid(size):
+    with pytest.raises(ValueError):
+        sketch_cache.parse_size(size)
+
+
+def test_file_digest_depends_on_content_only(tmp_path):
+    a, b, c = tmp_path / "a.fastq", tmp_path / "b.fastq", tmp_path / "c.fastq"
+    a.write_text("ACGT")
+    b.write_text("ACGT")
+    c.write_text("ACGA")
+    assert sketch_cache.file_digest(str(a)) == sketch_cache.file_digest(str(b))
+    assert sketch_cache.file_digest(str(a)) != sketch_cache.file_digest(str(c))
+
+
+def test_default_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setenv(sketch_cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    assert sketch_cache.default_cache_dir() == str(tmp_path / "cache")
+    monkeypatch.delenv(sketch_cache.CACHE_DIR_ENV)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "xdg"))
+    assert sketch_cache.default_cache_dir() == str(tmp_path / "xdg" / "fmhfunprofiler" / "sketches")
+
+
+# ---------------------------------------------------------------------------
+# SketchCache
+# ---------------------------------------------------------------------------
+
+def test_cached_sketch_reuses_sketch(tmp_path, metagenome):
+    cache = sketch_cache.SketchCache(str(tmp_path / "cache"))
+    calls = []
+
+    def sketch_function(mg_filename, ksize, scaled):
+        calls.append(mg_filename)
+        return engine.sketch_metagenome(mg_filename, ksize, scaled)
+
+    # a copy under another name has the same content, so it hits the cache
+    copy = str(tmp_path / "renamed.fastq")
+    shutil.copyfile(metagenome, copy)
+    first = sketch_cache.cached_sketch(cache, metagenome, 7, 10, sketch_function)
+    second = sketch_cache.cached_sketch(cache, copy, 7, 10, sketch_function)
+    assert calls == [metagenome]
+    assert second.hashes == first.hashes
+
+    # another scaled is another key
+    sketch_cache.cached_sketch(cache, metagenome, 7, 20, sketch_function)
+    assert len(calls) == 2
+    assert len(cache.entries()) == 2
+
+
+def test_cached_sketches_only_sketches_missing_ksizes(tmp_path, metagenome):
+    cache = sketch_cache.SketchCache(str(tmp_path / "cache"))
+    calls = []
+
+    def sketch_multi_function(mg_filename, ksizes, scaled):
+        calls.append(list(ksizes))
+        return {ksize: engine.sketch_metagenome(mg_filename, ksize, scaled) for ksize in ksizes}
+
+    sketch_cache.cached_sketches(cache, metagenome, [7], 10, sketch_multi_function)
+    minhashes = sketch_cache.cached_sketches(cache, metagenome, [7, 11], 10, sketch_multi_function)
+    assert calls == [[7], [11]]
+    assert sorted(minhashes) == [7, 11]
+    assert len(cache.entries()) == 2
+
+
+def test_get_missing_key(tmp_path):
+    cache = sketch_cache.SketchCache(str(tmp_path / "cache"))
+    assert cache.get("missing") is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = sketch_cache.SketchCache(str(tmp_path / "cache"))
+    src = tmp_path / "sketch.sig.zip"
+    src.write_bytes(b"x" * 100)
+    for i, key in enumerate(["old", "mid", "new"]):
+        cache.put_file(key, str(src))
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    # using "old" makes it the most recent
+    assert cache.get("old") is not None
+    assert cache.evict(200) == ["mid"]
+    assert sorted(key for key, _, _ in cache.entries()) == ["new", "old"]
+    assert cache.clear() == ["new", "old"]
+    assert cache.entries() == []
+
+
+def test_max_size_evicts_on_put(tmp_path):
+    cache = sketch_cache.SketchCache(str(tmp_path / "cache"), max_size=250)
+    src = tmp_path / "sketch.sig.zip"
+    src.write_bytes(b"x" * 100)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put_file(key, str(src))
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    assert cache.total_size() <= 250
+    assert cache.get("c") is not None
+
+
+def test_main_prune_and_clear(tmp_path, monkeypatch, capsys):
+    cache_dir = str(tmp_path / "cache")
+    cache = sketch_cache.SketchCache(cache_dir)
+    src = tmp_path / "sketch.sig.zip"
+    src.write_bytes(b"x" * 100)
+    cache.put_file("a", str(src))
+    cache.put_file("b", str(src))
+
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-cache", "--cache_dir", cache_dir, "prune", "150"])
+    sketch_cache.main()
+    assert len(cache.entries()) == 1
+
+    monkeypatch.setattr(sys, "argv", ["funcprofiler-cache", "--cache_dir", cache_dir, "clear"])
+    sketch_cache.main()
+    assert cache.entries() == []
+    assert "Removed 1 sketches" in capsys.readouterr().out
@@ -0,0 +1,116 @@
+"""
+Unit tests for fmhfunprofiler.sketching, the streaming parallel sketcher.
+"""
+
+import gzip
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fmhfunprofiler import engine, ko_index, sketching
+
+
+def test_read_chunks_bounds_chunk_size(metagenome):
+    chunks = list(sketching.read_chunks(metagenome, chunk_bases=1000))
+    # 300 reads of 150 bp, 7 reads per chunk of at least 1000 bases
+    assert len(chunks) == 43
+    assert all(sum(len(seq) for seq in chunk) >= 1000 for chunk in chunks[:-1])
+    assert sum(len(chunk) for chunk in chunks) == 300
+
+
+def test_parallel_sketch_equals_serial(metagenome):
+    serial = engine.sketch_metagenome(metagenome, 7, 1)
+    parallel = sketching.sketch_metagenome_parallel(metagenome, 7, 1, processes=3, chunk_bases=2000)
+    assert parallel.hashes == serial.hashes
+
+
+def test_parallel_sketch_reads_gzip(tmp_path, metagenome):
+    gz = str(tmp_path / "sample.fastq.gz")
+    with open(metagenome, "rb") as src, gzip.open(gz, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    serial = engine.sketch_metagenome(metagenome, 11, 10)
+    parallel = sketching.sketch_metagenome_parallel(gz, 11, 10, processes=2, chunk_bases=5000)
+    assert parallel.hashes == serial.hashes
+
+
+def test_single_process_is_serial(metagenome):
+    mh = sketching.sketch_metagenome_parallel(metagenome, 7, 10, processes=1)
+    assert mh.hashes == engine.sketch_metagenome(metagenome, 7, 10).hashes
+
+
+def test_multi_ksize_sketch_equals_single(metagenome):
+    minhashes = sketching.sketch_metagenome_multi(metagenome, [7, 11, 7], 10, processes=2, chunk_bases=5000)
+    assert list(minhashes) == [7, 11]
+    for ksize, mh in minhashes.items():
+        assert mh.ksize == ksize
+        assert mh.hashes == engine.sketch_metagenome(metagenome, ksize, 10).hashes
+
+
+def test_read_files_sketched_together(metagenome, split_metagenome):
+    mg_filename = ",".join(split_metagenome)
+    assert sum(len(chunk) for chunk in sketching.read_chunks(mg_filename, chunk_bases=1000)) == 300
+    expected = engine.sketch_metagenome(metagenome, 7, 10).hashes
+    assert engine.sketch_metagenome(mg_filename, 7, 10).hashes == expected
+    assert sketching.sketch_metagenome_multi(mg_filename, [7], 10, processes=2, chunk_bases=2000)[7].hashes == expected
+
+
+def test_filter_minhash_keeps_abundances(metagenome):
+    mh = engine.sketch_metagenome(metagenome, 7, 10)
+    hashes, abunds = engine.minhash_to_arrays(mh)
+    keep = hashes[::3]
+    filtered = sketching.filter_minhash(mh, keep)
+    assert filtered.hashes == {h: a for h, a in zip(hashes[::3].tolist(), abunds[::3].tolist())}
+    assert len(sketching.filter_minhash(mh, np.zeros(0, dtype=np.uint64))) == 0
+
+
+@pytest.fixture
+def contaminated_metagenome(tmp_path, metagenome):
+    """The metagenome, with 100 random 'host' reads that match no KO."""
+    rng = np.random.default_rng(3)
+    path = tmp_path / "contaminated.fastq"
+    shutil.copyfile(metagenome, path)
+    with open(path, "a") as fp:
+        for i in range(100):
+            read = "".join(rng.choice(list("ACGT"), 150))
+            fp.write(f"@host{i}\n{read}\n+\n{'I' * len(read)}\n")
+    return str(path)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_prefiltered_sketch_keeps_ko_hashes(contaminated_metagenome, ko_sketch, processes):
+    keep = ko_index.load_hash_set(ko_sketch, 7, 10)
+    full = engine.sketch_metagenome(contaminated_metagenome, 7, 10)
+    filtered = sketching.sketch_metagenome_multi(contaminated_metagenome, [7], 10, processes=processes, chunk_bases=5000,
+                                                 keep_hashes={7: keep})[7]
+    assert 0 < len(filtered) < len(full)
+    assert filtered.hashes == {h: a for h, a in full.hashes.items() if h in set(keep.tolist())}
+
+
+def test_funcprofiler_prefilter_same_profile(tmp_path, contaminated_metagenome, ko_sketch):
+    profiles = {}
+    for name, extra in [("full", []), ("prefilter", ["--prefilter"])]:
+        output = tmp_path / f"{name}.csv"
+        subprocess.run([sys.executable, "-m", "fmhfunprofiler.funcprofiler", contaminated_metagenome, ko_sketch, "7", "10",
+                        str(output), "-t", "50", "--in_process", *extra],
+                       check=True, capture_output=True)
+        profiles[name] = pd.read_csv(output).set_index("ko_id")["abundance"]
+    assert list(profiles["prefilter"].index) == list(profiles["full"].index)
+    assert np.allclose(profiles["prefilter"], profiles["full"])
+
+
+def test_prefilter_loads_ko_sketch_once(contaminated_metagenome, ko_sketch, monkeypatch):
+    from fmhfunprofiler import funcprofiler
+    loaded = []
+    load_ko_sketches = engine.load_ko_sketches
+    def counting_load(*args):
+        loaded.append(args)
+        return load_ko_sketches(*args)
+    monkeypatch.setattr(engine, "load_ko_sketches", counting_load)
+    tables = funcprofiler.run_in_process(contaminated_metagenome, ko_sketch, [7], 10, [50], prefilter=True)
+    assert len(loaded) == 1
+    expected = funcprofiler.run_in_process(contaminated_metagenome, ko_sketch, [7], 10, [50])
+    assert list(tables[(7, 10, 50)]["match_name"]) == list(expected[(7, 10, 50)]["match_name"])